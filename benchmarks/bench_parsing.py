@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+"""
+Micro-benchmark of the extraction of units from subsection pages.
+
+Compares extract_units with the implementation it replaced (kept here as
+reference) and with the streamed parsing of the page (UnitParser fed 64 KB
+chunks), and checks that all of them give the same units. Run it from the
+root of the repository with:
+
+    python -m benchmarks.bench_parsing
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import re
+import timeit
+
+try:
+    import tracemalloc
+except ImportError:  # python 2
+    tracemalloc = None
+
+from edx_dl.common import YOUTUBE_VIDEO_ID_LENGTH, Unit
+from edx_dl.parsing import UnitParser, extract_units, parse_chunks
+
+from .fixtures import subsection_page
+
+BASE_URL = 'https://courses.edx.org'
+CHUNK_SIZE = 64 * 1024
+
+
+def legacy_extract_units(page, base_url):
+    """
+    The extraction done by extract_subsection before the parsing module.
+    """
+    re_splitter = re.compile(r'data-streams=(?:&#34;|").*1.0[0]*:')
+    re_subs = re.compile(r'data-transcript-translation-url=(?:&#34;|")([^"&]*)(?:&#34;|")')
+    re_units = re_splitter.split(page)[1:]
+    units = []
+    for unit_html in re_units:
+        video_id = unit_html[:YOUTUBE_VIDEO_ID_LENGTH]
+        sub_url = None
+        match_subs = re_subs.search(unit_html)
+        if match_subs:
+            sub_url = base_url + match_subs.group(1) + "/en" + "?videoId=" + video_id
+        units.append(Unit(video_youtube_url='http://youtube.com/watch?v=' + video_id,
+                          sub_url=sub_url))
+
+    re_extra_youtube = re.compile(r'//w{0,3}\.youtube.com/embed/([^ \?&]*)[\?& ]')
+    extra_ids = re_extra_youtube.findall(page)
+    for extra_id in extra_ids:
+        units.append(Unit(video_youtube_url='http://youtube.com/watch?v=' + extra_id[:YOUTUBE_VIDEO_ID_LENGTH],
+                          sub_url=None))
+    return units
+
+
+def streamed_extract_units(page, base_url):
+    chunks = (page[i:i + CHUNK_SIZE] for i in range(0, len(page), CHUNK_SIZE))
+    return list(parse_chunks(UnitParser(base_url), chunks))
+
+
+def best_time(func, page, repeat=5):
+    timer = timeit.Timer(lambda: func(page, BASE_URL))
+    number = max(1, int(0.2 / max(timer.timeit(1), 1e-6)))
+    return min(timer.repeat(repeat, number)) / number
+
+
+def peak_memory(func, page):
+    """
+    Return the peak memory allocated by func(page) in bytes, or None if
+    tracemalloc is not available.
+    """
+    if tracemalloc is None:
+        return None
+    tracemalloc.start()
+    try:
+        func(page, BASE_URL)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def main():
+    cases = [
+        ('small', subsection_page(5)),
+        ('large', subsection_page(200)),
+        ('huge', subsection_page(1000, filler_lines=100)),
+        ('minified', subsection_page(200, minified=True)),
+        ('unescaped', subsection_page(200, escaped=False)),
+        ('html5', subsection_page(200, html5_units=200)),
+        ('html5-min', subsection_page(50, minified=True, html5_units=2000,
+                                      filler_lines=10)),
+    ]
+    print('%-10s %10s %6s %10s %10s %8s %10s %10s %10s %10s' % (
+        'page', 'bytes', 'units', 'legacy ms', 'new ms', 'speedup',
+        'stream ms', 'legacy KB', 'new KB', 'stream KB'))
+    for name, page in cases:
+        expected = legacy_extract_units(page, BASE_URL)
+        units = extract_units(page, BASE_URL)
+        assert units == expected, 'different units for %s page' % name
+        assert streamed_extract_units(page, BASE_URL) == expected, \
+            'different streamed units for %s page' % name
+        legacy = best_time(legacy_extract_units, page)
+        new = best_time(extract_units, page)
+        streamed = best_time(streamed_extract_units, page)
+        peaks = [peak_memory(func, page)
+                 for func in (legacy_extract_units, extract_units,
+                              streamed_extract_units)]
+        print('%-10s %10d %6d %10.3f %10.3f %7.1fx %10.3f %10s %10s %10s' % (
+            (name, len(page), len(units), legacy * 1000, new * 1000,
+             legacy / new, streamed * 1000) +
+            tuple(peak // 1024 if peak is not None else '-'
+                  for peak in peaks)))
+
+
+if __name__ == '__main__':
+    main()
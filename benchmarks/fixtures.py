@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+"""
+Synthetic OpenEdX pages used by the benchmarks.
+"""
+
+from __future__ import unicode_literals
+
+import random
+
+FILLER = ('<p class="problem-text">Lorem ipsum dolor sit amet, consectetur '
+          'adipiscing elit, sed do eiusmod tempor incididunt ut labore.</p>')
+
+
+def video_id(i):
+    return ('vid%08d' % i)[-11:]
+
+
+def subsection_page(num_units, filler_lines=50, escaped=True, minified=False,
+                    html5_units=0, seed=0, first_id=0):
+    """
+    Return a subsection page with num_units videos, each one surrounded by
+    filler_lines of unrelated html. With escaped the attributes are html
+    escaped, as in the seq_contents of the courseware; with minified the
+    whole page is a single line. html5_units adds non YouTube videos, which
+    have an empty data-streams attribute, at the end of the page. The
+    video ids are numbered from first_id.
+    """
+    rng = random.Random(seed)
+    quote = '&#34;' if escaped else '"'
+    lines = ['<html><body><section class="course-content">']
+    for i in range(first_id, first_id + num_units):
+        lines.extend(FILLER for _ in range(rng.randint(filler_lines // 2,
+                                                        filler_lines)))
+        lines.append(
+            '<div id="video_%d" class="video" data-streams=%s0.75:%s,1.00:%s%s '
+            'data-transcript-translation-url=%s/courses/X/Y/Z/xblock/%d/handler/'
+            'transcript/translation%s data-speed=%s1.0%s></div>' %
+            (i, quote, video_id(i + 10 ** 6), video_id(i), quote, quote, i,
+             quote, quote, quote))
+        if i % 10 == 0:
+            lines.append('<iframe src="//www.youtube.com/embed/%s?rel=0" '
+                         'width="560"></iframe>' % video_id(i + 2 * 10 ** 6))
+    for i in range(html5_units):
+        lines.append(FILLER)
+        lines.append('<div id="html5_%d" class="video" data-streams=%s%s '
+                     'data-sources=%s/static/video_%d.mp4%s></div>' %
+                     (i, quote, quote, quote, i, quote))
+    lines.append('</section></body></html>')
+    return ('' if minified else '\n').join(lines)
+
+
+def dashboard_page(num_courses, started=None):
+    """
+    Return a dashboard with num_courses courses, as parsed by
+    get_courses_info. Only the first started courses (all by default) have
+    a link to the course.
+    """
+    started = num_courses if started is None else started
+    lines = ['<html><body><section class="my-courses">']
+    for i in range(num_courses):
+        link = ''
+        if i < started:
+            link = '<a href="/courses/Org/C%d/2015/info">View Course</a>' % i
+        lines.append('<article class="course"><h3 class="course-title">'
+                     'Course number %d</h3>%s%s</article>' % (i, FILLER, link))
+    lines.append('</section></body></html>')
+    return '\n'.join(lines)
+
+
+def courseware_page(course, num_sections, subsections_per_section=3):
+    """
+    Return the courseware page of course ('Org/C0/2015') with the chapters
+    parsed by get_available_sections.
+    """
+    lines = ['<html><body><nav aria-label="Course Navigation">']
+    for i in range(num_sections):
+        lines.append('<div class="chapter"><h3><a href="#">Week %d</a></h3><ul>'
+                     % (i + 1))
+        for j in range(subsections_per_section):
+            lines.append('<li><a href="/courses/%s/courseware/week%d/seq%d/">'
+                         'Lesson %d</a></li>' % (course, i, j, j))
+        lines.append('</ul></div>')
+    lines.append('</nav></body></html>')
+    return '\n'.join(lines)
+
+
+def transcript(num_cues, seed=0):
+    """
+    Return the transcript of a video with num_cues cues, as the json
+    object served by the transcript handler of the platform.
+    """
+    rng = random.Random(seed)
+    start, end, text = [], [], []
+    position = 0
+    for i in range(num_cues):
+        duration = rng.randint(800, 6000)
+        start.append(position)
+        end.append(position + duration)
+        text.append('' if i % 50 == 7 else 'Sentence number %d of the lecture.' % i)
+        position += duration + rng.randint(0, 300)
+    return {'start': start, 'end': end, 'text': text}
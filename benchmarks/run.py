@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+
+"""
+Offline benchmarks of the hot paths of edx-dl.
+
+The pages are served by the local stand-in server of benchmarks.server,
+so no network access is needed. Run it from the root of the repository:
+
+    python -m benchmarks.run
+    python -m benchmarks.run --latency 0.05 --json results.json
+    python -m benchmarks.run --compare results.json
+
+With --compare the run fails if a benchmark got slower than the given
+results by more than --tolerance.
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+try:
+    import tracemalloc
+except ImportError:  # python 2
+    tracemalloc = None
+
+import argparse
+import io
+import json
+import sys
+import time
+import warnings
+
+from edx_dl import edx_dl
+from edx_dl.session import Session
+
+from . import fixtures
+from .server import PASSWORD, USERNAME, Platform, StandInServer
+
+
+class _Quiet(object):
+    """
+    Swallow what edx_dl prints while a benchmark runs.
+    """
+
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = io.StringIO()
+
+    def __exit__(self, *exc_info):
+        sys.stdout = self.stdout
+
+
+def measure(func, min_time=0.5):
+    """
+    Call func until min_time seconds are spent. Returns the seconds per
+    call, the result of the last call and the peak memory of one call in
+    bytes (None without tracemalloc).
+    """
+    with _Quiet():
+        calls = 0
+        started = time.time()
+        while True:
+            result = func()
+            calls += 1
+            elapsed = time.time() - started
+            if elapsed >= min_time:
+                break
+        peak = None
+        if tracemalloc is not None:
+            tracemalloc.start()
+            try:
+                func()
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+    return elapsed / calls, result, peak
+
+
+def logged_in(platform):
+    """
+    Start a server for platform and log in to it. Returns the server, the
+    session and the headers.
+    """
+    server = StandInServer(platform).start()
+    edx_dl.OPENEDX_SITES['benchmark'] = {
+        'url': server.url,
+        'courseware-selector': ('nav', {'aria-label': 'Course Navigation'}),
+    }
+    edx_dl.change_openedx_site('benchmark')
+    session = Session()
+    headers = edx_dl.edx_get_headers(session)
+    resp = edx_dl.edx_login(edx_dl.LOGIN_API, headers, USERNAME, PASSWORD,
+                            session)
+    assert resp.get('success'), resp
+    return server, session, headers
+
+
+def bench_dashboard(num_courses):
+    server, session, headers = logged_in(Platform(num_courses=num_courses))
+    try:
+        seconds, courses, peak = measure(
+            lambda: edx_dl.get_courses_info(edx_dl.DASHBOARD, headers, session))
+    finally:
+        server.stop()
+    return seconds, 1, len(courses), peak
+
+
+def bench_courseware(num_sections):
+    server, session, headers = logged_in(Platform(num_sections=num_sections))
+    url = server.url + '/courses/Org/C0/2015/courseware'
+    try:
+        seconds, sections, peak = measure(
+            lambda: edx_dl.get_available_sections(url, headers, session))
+    finally:
+        server.stop()
+    return seconds, 1, len(sections), peak
+
+
+def bench_subsection(num_units, filler_lines):
+    platform = Platform(units_per_subsection=num_units,
+                        filler_lines=filler_lines)
+    server, session, headers = logged_in(platform)
+    url = server.url + '/courses/Org/C0/2015/courseware/week0/seq0/'
+    try:
+        seconds, subsection, peak = measure(
+            lambda: edx_dl.extract_subsection(url, headers, session))
+    finally:
+        server.stop()
+    return seconds, 1, len(subsection.units), peak
+
+
+def bench_crawl(num_sections, latency, parse_processes=0):
+    platform = Platform(num_sections=num_sections, latency=latency)
+    edx_dl.start_parse_pool(argparse.Namespace(
+        parse_processes=parse_processes))
+    server, session, headers = logged_in(platform)
+    url = server.url + '/courses/Org/C0/2015/courseware'
+    try:
+        def crawl():
+            sections = edx_dl.get_available_sections(url, headers, session)
+            return edx_dl.extract_all_subsections([s.url for s in sections],
+                                                  headers, session)
+        seconds, (video_urls, _), peak = measure(crawl)
+    finally:
+        server.stop()
+        edx_dl.stop_parse_pool()
+    return seconds, num_sections + 1, len(video_urls), peak
+
+
+def bench_json2srt(num_cues):
+    transcript = fixtures.transcript(num_cues)
+    seconds, _, peak = measure(lambda: edx_dl.edx_json2srt(transcript))
+    return seconds, 1, num_cues, peak
+
+
+def run_benchmarks(latency):
+    cases = [
+        ('dashboard-10', bench_dashboard, (10,)),
+        ('dashboard-200', bench_dashboard, (200,)),
+        ('courseware-10', bench_courseware, (10,)),
+        ('courseware-100', bench_courseware, (100,)),
+        ('subsection-10', bench_subsection, (10, 50)),
+        ('subsection-200', bench_subsection, (200, 50)),
+        ('crawl-50', bench_crawl, (50, latency)),
+        ('crawl-50-parse4', bench_crawl, (50, latency, 4)),
+        ('json2srt-600', bench_json2srt, (600,)),
+        ('json2srt-20000', bench_json2srt, (20000,)),
+    ]
+    results = {}
+    print('%-16s %12s %12s %10s' % ('benchmark', 'pages/sec', 'units/sec',
+                                     'peak KB'))
+    for name, bench, params in cases:
+        seconds, pages, units, peak = bench(*params)
+        results[name] = {
+            'pages_per_sec': pages / seconds,
+            'units_per_sec': units / seconds,
+            'peak_kb': peak // 1024 if peak is not None else None,
+        }
+        print('%-16s %12.1f %12.1f %10s' % (
+            name, pages / seconds, units / seconds,
+            results[name]['peak_kb'] if peak is not None else '-'))
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Return the names of the benchmarks slower than in baseline.
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        expected = baseline.get(name)
+        if expected is None:
+            continue
+        if result['units_per_sec'] < expected['units_per_sec'] * (1 - tolerance):
+            print('[regression] %s: %.1f units/sec, was %.1f' % (
+                name, result['units_per_sec'], expected['units_per_sec']))
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmarks of edx-dl')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='latency of the stand-in server for the crawl '
+                        'benchmark in seconds (default: %(default)s)')
+    parser.add_argument('--json', dest='json_file',
+                        help='write the results to this file')
+    parser.add_argument('--compare', dest='baseline',
+                        help='fail if slower than the results in this file')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed slowdown for --compare (default: %(default)s)')
+    args = parser.parse_args()
+
+    warnings.simplefilter('ignore')
+    results = run_benchmarks(args.latency)
+    if args.json_file:
+        with open(args.json_file, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
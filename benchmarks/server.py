@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+
+"""
+Local stand-in for an OpenEdX platform, serving the synthetic pages of
+benchmarks.fixtures.
+
+It emulates what edx-dl relies on: the csrftoken cookie set by the first
+page, the login_ajax endpoint (which checks the X-CSRFToken header), the
+dashboard, the courseware and subsection pages and the transcripts. Every
+response can be delayed to emulate the network latency, and the platform
+can be made to answer 503 for a while.
+"""
+
+from __future__ import unicode_literals
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+try:
+    from urllib.parse import parse_qs, urlsplit
+except ImportError:
+    from urlparse import parse_qs, urlsplit
+
+import gzip
+import hashlib
+import io
+import json
+import re
+import threading
+import time
+import zlib
+
+from . import fixtures
+
+USERNAME = 'student@example.com'
+PASSWORD = 'secret'
+CSRF_TOKEN = 'benchmark-csrf-token'
+SESSION_ID = 'benchmark-session'
+
+RE_SUBSECTION = re.compile(r'^/courses/(.+)/courseware/week(\d+)/seq(\d+)/$')
+RE_COURSEWARE = re.compile(r'^/courses/(.+)/(?:courseware|info)/?$')
+RE_TRANSCRIPT = re.compile(r'^/courses/X/Y/Z/xblock/(\d+)/handler/transcript/translation/(\w+)$')
+
+
+class Platform(object):
+    """
+    The content served by the stand-in server. The next busy requests are
+    answered 503 with a Retry-After of retry_after seconds.
+    """
+
+    def __init__(self, num_courses=3, num_sections=10, units_per_subsection=10,
+                 filler_lines=50, cues_per_transcript=600, latency=0.0):
+        self.num_courses = num_courses
+        self.num_sections = num_sections
+        self.units_per_subsection = units_per_subsection
+        self.filler_lines = filler_lines
+        self.cues_per_transcript = cues_per_transcript
+        self.latency = latency
+        self.requests = 0
+        self.bytes_sent = 0
+        self.connections = 0
+        self.logins = 0
+        self.busy = 0
+        self.retry_after = 1
+        self._pages = {}
+        self._lock = threading.Lock()
+
+    def page(self, key, build):
+        """
+        Return the page for key, building it once.
+        """
+        with self._lock:
+            page = self._pages.get(key)
+        if page is None:
+            page = build().encode('utf-8')
+            with self._lock:
+                self._pages[key] = page
+        return page
+
+    def count(self, size):
+        with self._lock:
+            self.requests += 1
+            self.bytes_sent += size
+
+    def connected(self):
+        with self._lock:
+            self.connections += 1
+
+    def logged_in(self):
+        with self._lock:
+            self.logins += 1
+
+    def throttled(self):
+        """
+        Return True if the request must be answered 503 (see busy).
+        """
+        with self._lock:
+            if self.busy > 0:
+                self.busy -= 1
+                return True
+        return False
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, avoid the delayed ACK stall
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def platform(self):
+        return self.server.platform
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.platform.connected()
+
+    def _cookies(self):
+        cookies = {}
+        for part in (self.headers.get('Cookie') or '').split(';'):
+            if '=' in part:
+                name, value = part.strip().split('=', 1)
+                cookies[name] = value
+        return cookies
+
+    def _send(self, status, body, content_type='text/html; charset=utf-8',
+              cookies=(), headers=()):
+        time.sleep(self.platform.latency)
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        if status == 200 and self.headers.get('If-None-Match') == etag:
+            status, body = 304, b''
+        encoding = None
+        accepted = self.headers.get('Accept-Encoding') or ''
+        if body and 'gzip' in accepted:
+            buf = io.BytesIO()
+            with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+                f.write(body)
+            body, encoding = buf.getvalue(), 'gzip'
+        elif body and 'deflate' in accepted:
+            body, encoding = zlib.compress(body), 'deflate'
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if status in (200, 304):
+            self.send_header('ETag', etag)
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        for cookie in cookies:
+            self.send_header('Set-Cookie', cookie)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        # counted before the client can see the response
+        self.platform.count(len(body))
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.platform.throttled():
+            return self._send(503, b'busy', headers=[
+                ('Retry-After', str(self.platform.retry_after))])
+        path = urlsplit(self.path).path
+        if path == '/login_ajax':
+            return self._send(200, b'<html>login</html>',
+                              cookies=['csrftoken=%s; Path=/' % CSRF_TOKEN])
+        if self._cookies().get('sessionid') != SESSION_ID:
+            return self._send(302, b'', headers=[('Location', '/login_ajax')])
+
+        platform = self.platform
+        if path == '/dashboard':
+            return self._send(200, platform.page('dashboard', lambda: fixtures.dashboard_page(platform.num_courses)))
+        match = RE_SUBSECTION.match(path)
+        if match:
+            seed = zlib.crc32(path.encode('utf-8')) & 0xffff
+            return self._send(200, platform.page(path, lambda: fixtures.subsection_page(
+                platform.units_per_subsection, platform.filler_lines, seed=seed,
+                first_id=seed * platform.units_per_subsection)))
+        match = RE_COURSEWARE.match(path)
+        if match:
+            course = match.group(1)
+            return self._send(200, platform.page(path, lambda: fixtures.courseware_page(
+                course, platform.num_sections)))
+        match = RE_TRANSCRIPT.match(path)
+        if match:
+            seed = int(match.group(1))
+            return self._send(200, platform.page(path, lambda: json.dumps(fixtures.transcript(
+                platform.cues_per_transcript, seed))), 'application/json')
+        return self._send(404, b'not found')
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        form = parse_qs(self.rfile.read(length).decode('utf-8'))
+        if urlsplit(self.path).path != '/login_ajax':
+            return self._send(404, b'not found')
+        if (self.headers.get('X-CSRFToken') != CSRF_TOKEN or
+                self._cookies().get('csrftoken') != CSRF_TOKEN):
+            return self._send(403, b'CSRF verification failed')
+        ok = (form.get('email') == [USERNAME] and
+              form.get('password') == [PASSWORD])
+        body = {'success': True} if ok else {'success': False,
+                                             'value': 'Email or password is incorrect.'}
+        cookies = []
+        if ok:
+            cookies.append('sessionid=%s; Path=/' % SESSION_ID)
+            self.platform.logged_in()
+        return self._send(200, json.dumps(body).encode('utf-8'),
+                          'application/json', cookies=cookies)
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    """
+    Serves a Platform on 127.0.0.1 from a background thread:
+
+        server = StandInServer(Platform(latency=0.05))
+        server.start()
+        ...  # use server.url
+        server.stop()
+    """
+    daemon_threads = True
+
+    def __init__(self, platform=None, port=0):
+        HTTPServer.__init__(self, ('127.0.0.1', port), Handler)
+        self.platform = platform or Platform()
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
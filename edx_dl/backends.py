@@ -0,0 +1,349 @@
+# -*- coding: utf-8 -*-
+
+"""
+Backends that run youtube-dl to download the videos.
+
+subprocess runs one youtube-dl process per video. library imports
+youtube_dl once in each of a few long lived worker processes, and batch
+hands several videos to a single youtube-dl process, so that neither pays
+the interpreter startup and the import of the extractors for every video.
+All of them write the same files.
+
+With a rate, each youtube-dl limits its download speed to rate bytes per
+second (youtube-dl throttles itself, edx-dl only gives each process its
+share of the bandwidth limit).
+"""
+
+from __future__ import unicode_literals
+
+import os
+import re
+import shutil
+import sys
+
+from collections import namedtuple
+
+from .common import youtube_id
+
+BACKENDS = ('subprocess', 'library', 'batch')
+DEFAULT_BACKEND = 'subprocess'
+DEFAULT_BATCH_SIZE = 10
+
+# where the batch backend downloads the videos before renaming them
+BATCH_DIR = '.edx-dl-batch'
+
+# A video to download to target_dir/prefix-<title>.<ext>, with youtube-dl
+# format selection format, and its YouTube subtitles if write_sub is set.
+DownloadRequest = namedtuple('DownloadRequest', ['url', 'target_dir', 'prefix',
+                                                 'format', 'write_sub'])
+
+RE_YOUTUBE_DL_DESTINATION = re.compile(
+    r'^\[download\] Destination: (.+)$'
+    r'|^\[download\] (.+) has already been downloaded'
+    r'|^\[ffmpeg\] Merging formats into "(.+)"$', re.M)
+
+# the files of the single formats that are merged into the video
+RE_FORMAT_FILE = re.compile(r'\.f\d+\.\w+$')
+
+NOT_VIDEO_EXTENSIONS = ('.srt', '.vtt', '.part', '.ytdl')
+
+
+def output_template(request):
+    """
+    Return the youtube-dl output template of request.
+    """
+    return os.path.join(request.target_dir,
+                        request.prefix + '-%(title)s.%(ext)s')
+
+
+def _options(request, rate=None):
+    options = ['-f', request.format]
+    if request.write_sub:
+        options.append('--write-sub')
+    if rate:
+        options.extend(['--limit-rate', '%d' % rate])
+    return options
+
+
+def downloaded_filenames(output):
+    """
+    Return the basenames of the files youtube-dl reports in its output, in
+    order (the last one of a video is its final file, e.g. after merging
+    the formats).
+    """
+    if isinstance(output, bytes):
+        output = output.decode('utf-8', 'replace')
+    return [os.path.basename([m for m in match if m][0].strip())
+            for match in RE_YOUTUBE_DL_DESTINATION.findall(output)]
+
+
+def downloaded_filename(output):
+    """
+    Return the basename of the video file youtube-dl reports in its output,
+    or None if it could not be found.
+    """
+    filenames = downloaded_filenames(output)
+    return filenames[-1] if filenames else None
+
+
+def is_video(name):
+    """
+    Return True if the file name looks like a final video, not like its
+    subtitles, partial download or single formats.
+    """
+    return not (os.path.splitext(name)[1] in NOT_VIDEO_EXTENSIONS or
+                RE_FORMAT_FILE.search(name))
+
+
+def is_partial(name):
+    """
+    Return True if the file name looks like what an interrupted youtube-dl
+    leaves behind: a partial download, or the single formats of a video
+    that were not merged yet.
+    """
+    return name.endswith('.part') or bool(RE_FORMAT_FILE.search(name))
+
+
+def find_video(directory, prefix, names=None):
+    """
+    Return the name of the video file in directory whose name starts with
+    prefix, or None. names is the listing of directory if already known.
+    """
+    if names is None:
+        if not os.path.isdir(directory):
+            return None
+        names = os.listdir(directory)
+    for name in names:
+        if name.startswith(prefix) and is_video(name):
+            return name
+    return None
+
+
+def _replace(src, dst):
+    try:
+        os.rename(src, dst)
+    except OSError:  # windows does not overwrite on rename
+        os.remove(dst)
+        os.rename(src, dst)
+
+
+class SubprocessBackend(object):
+    """
+    Runs a youtube-dl process for each video.
+
+    execute(cmd, echo) must run cmd and return its exit status and output.
+    """
+
+    batch_size = 1
+
+    def __init__(self, execute, rate=None):
+        self.execute = execute
+        self.rate = rate
+
+    def download(self, requests, echo=True):
+        """
+        Download the videos of requests. Returns a list with the exit
+        status and the video filename (None if unknown) of each request.
+        """
+        results = []
+        for request in requests:
+            cmd = (['youtube-dl', '-o', output_template(request)] +
+                   _options(request, self.rate) + [request.url])
+            returncode, output = self.execute(cmd, echo)
+            filename = downloaded_filename(output) if returncode == 0 else None
+            results.append((returncode, filename))
+        return results
+
+    def close(self):
+        pass
+
+
+def library_available():
+    """
+    Return True if youtube_dl can be imported.
+    """
+    try:
+        import youtube_dl  # noqa
+    except ImportError:
+        return False
+    return True
+
+
+_youtube_dl = None
+
+
+def _init_library_worker():
+    global _youtube_dl
+    import youtube_dl
+    _youtube_dl = youtube_dl
+
+
+def _library_download(requests, echo, rate=None):
+    # runs in the worker processes of LibraryBackend
+    results = []
+    for request in requests:
+        params = {
+            'outtmpl': output_template(request),
+            'format': request.format,
+            'writesubtitles': request.write_sub,
+            'quiet': not echo,
+            'noprogress': not echo,
+        }
+        if rate:
+            params['ratelimit'] = rate
+        try:
+            with _youtube_dl.YoutubeDL(params) as ydl:
+                info = ydl.extract_info(request.url)
+                filename = os.path.basename(ydl.prepare_filename(info))
+        except _youtube_dl.utils.DownloadError:
+            # youtube_dl already reported it
+            results.append((1, None))
+            continue
+        except Exception as e:
+            sys.stderr.write('ERROR: %s: %s\n' % (request.url, e))
+            results.append((1, None))
+            continue
+        if not os.path.exists(os.path.join(request.target_dir, filename)):
+            filename = None
+        results.append((0, filename))
+    return results
+
+
+class LibraryBackend(object):
+    """
+    Runs youtube_dl as a library in a pool of worker processes, which
+    import it once and then download one video after another.
+
+    The processes are started right away, so create the backend before
+    starting other threads.
+    """
+
+    batch_size = 1
+
+    def __init__(self, processes, rate=None):
+        self.rate = rate
+        import multiprocessing
+        self._pool = multiprocessing.Pool(processes,
+                                          initializer=_init_library_worker)
+
+    def download(self, requests, echo=True):
+        """
+        Download the videos of requests. Returns a list with the exit
+        status and the video filename (None if unknown) of each request.
+        """
+        return self._pool.apply(_library_download,
+                                (list(requests), echo, self.rate))
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+
+class BatchBackend(object):
+    """
+    Runs a single youtube-dl process for a batch of videos.
+
+    youtube-dl takes a single output template, so the videos are downloaded
+    to a directory in BATCH_DIR with their YouTube id in place of the
+    prefix, and renamed (with their subtitles) to their names in the target
+    directory. All the requests of a batch must have the same target_dir.
+
+    execute(cmd, echo, name) must run cmd and return its exit status and
+    output.
+    """
+
+    def __init__(self, execute, batch_size=DEFAULT_BATCH_SIZE, rate=None):
+        self.execute = execute
+        self.batch_size = batch_size
+        self.rate = rate
+
+    def download(self, requests, echo=True):
+        """
+        Download the videos of requests. Returns a list with the exit
+        status and the video filename (None if unknown) of each request.
+        """
+        if not requests:
+            return []
+        # one process per format, e.g. when they are chosen to fit a budget
+        groups = {}
+        for i, request in enumerate(requests):
+            groups.setdefault((request.format, request.write_sub),
+                              []).append(i)
+        if len(groups) > 1:
+            results = [None] * len(requests)
+            for indexes in sorted(groups.values()):
+                outcomes = self.download([requests[i] for i in indexes], echo)
+                for i, outcome in zip(indexes, outcomes):
+                    results[i] = outcome
+            return results
+        first = requests[0]
+        # one directory per batch, the batches can run at the same time
+        staging = os.path.join(first.target_dir, BATCH_DIR, first.prefix)
+        if not os.path.isdir(staging):
+            os.makedirs(staging)
+        urls = []
+        for request in requests:
+            if request.url not in urls:
+                urls.append(request.url)
+        cmd = (['youtube-dl', '--ignore-errors', '-o',
+                os.path.join(staging, '%(id)s-%(title)s.%(ext)s')] +
+               _options(first, self.rate) + urls)
+        name = first.prefix
+        if len(requests) > 1:
+            name += '..' + requests[-1].prefix
+        returncode, output = self.execute(cmd, echo, name)
+
+        reported = downloaded_filenames(output)
+        names = os.listdir(staging)
+        moved = {}
+        results = []
+        for request in requests:
+            video_id = youtube_id(request.url)
+            if video_id in moved:
+                # the same video in another unit, youtube-dl got it once
+                filename = self._copy(request, *moved[video_id])
+            else:
+                filename, rests = self._move(staging, names, reported,
+                                             request, video_id)
+                if filename is not None:
+                    moved[video_id] = (request.prefix, rests)
+            results.append((0, filename) if filename is not None
+                           else (returncode or 1, None))
+        for directory in (staging, os.path.dirname(staging)):
+            try:
+                os.rmdir(directory)
+            except OSError:  # not empty, e.g. the partial downloads
+                break
+        return results
+
+    def _move(self, staging, names, reported, request, video_id):
+        # returns the video filename and the names of the moved files
+        # without the prefix (video first, then the subtitles)
+        start = video_id + '-'
+        video = None
+        for filename in reversed(reported):
+            if filename.startswith(start) and filename in names:
+                video = filename
+                break
+        if video is None:
+            video = find_video(staging, start, names)
+        if video is None:
+            return None, []
+        rests = [video[len(video_id):]]
+        rests.extend(name[len(video_id):] for name in names
+                     if name.startswith(start) and name != video and
+                     os.path.splitext(name)[1] in ('.srt', '.vtt'))
+        for rest in rests:
+            _replace(os.path.join(staging, video_id + rest),
+                     os.path.join(request.target_dir, request.prefix + rest))
+        return request.prefix + rests[0], rests
+
+    def _copy(self, request, prefix, rests):
+        for rest in rests:
+            shutil.copyfile(os.path.join(request.target_dir, prefix + rest),
+                            os.path.join(request.target_dir,
+                                         request.prefix + rest))
+        return request.prefix + rests[0]
+
+    def close(self):
+        pass
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+
+"""
+On-disk cache of the pages downloaded from the OpenEdX platforms.
+
+The cached responses are revalidated with conditional requests (ETag and
+Last-Modified), so re-crawling a course that did not change is cheap.
+"""
+
+from __future__ import unicode_literals
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+from collections import namedtuple
+
+DEFAULT_TTL = 0
+DEFAULT_MAX_SIZE = 200 * 1024 * 1024
+
+CacheEntry = namedtuple('CacheEntry', ['url', 'stored', 'etag',
+                                       'last_modified', 'content_type',
+                                       'body'])
+
+
+def default_cache_dir():
+    """
+    Return the directory where edx-dl keeps its caches for this user.
+    """
+    base = os.environ.get('XDG_CACHE_HOME') or os.environ.get('LOCALAPPDATA')
+    if not base:
+        base = os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'edx-dl')
+
+
+def ensure_private_dir(directory):
+    """
+    Create directory (readable only by the user) if it does not exist.
+    """
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory, 0o700)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+
+
+def _replace(tmp_path, path):
+    try:
+        os.rename(tmp_path, path)
+    except OSError:  # windows does not overwrite on rename
+        os.remove(path)
+        os.rename(tmp_path, path)
+
+
+def atomic_write(path, data):
+    """
+    Write data (bytes) to path so that readers never see a partial file.
+    """
+    directory = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        _replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class EntryWriter(object):
+    """
+    Writes the body of a cache entry a chunk at a time, to a temporary file
+    that replaces the entry on commit().
+    """
+
+    def __init__(self, cache, url, meta):
+        self.cache = cache
+        self.url = url
+        fd, self.tmp_path = tempfile.mkstemp(dir=cache.directory,
+                                             prefix='.tmp-')
+        self._file = os.fdopen(fd, 'wb')
+        self._file.write(json.dumps(meta).encode('utf-8') + b'\n')
+
+    def write(self, chunk):
+        self._file.write(chunk)
+
+    def commit(self):
+        self._file.close()
+        self.cache._commit(self.url, self.tmp_path)
+
+    def abort(self):
+        self._file.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+class ResponseCache(object):
+    """
+    Stores response bodies with their validators, one file per url.
+
+    Entries are keyed by the url and an identity string (the platform and
+    the user), because the same page is different for different users. The
+    total size is bounded by max_size; the least recently used entries are
+    evicted first. Entries younger than ttl seconds are used without asking
+    the server. With refresh set, the cached entries are ignored (but new
+    responses are still stored).
+    """
+
+    def __init__(self, directory, identity='', ttl=DEFAULT_TTL,
+                 max_size=DEFAULT_MAX_SIZE, refresh=False):
+        self.directory = directory
+        self.identity = identity
+        self.ttl = ttl
+        self.max_size = max_size
+        self.refresh = refresh
+        self._size = None
+        self._lock = threading.Lock()
+        ensure_private_dir(directory)
+
+    def _path(self, url):
+        key = '%s\n%s' % (self.identity, url)
+        return os.path.join(self.directory,
+                            hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def get(self, url, stream=False):
+        """
+        Return the CacheEntry for url or None if it is not cached. With
+        stream set, its body is the file of the entry, open at the start of
+        the body (the caller closes it).
+        """
+        if self.refresh:
+            return None
+        path = self._path(url)
+        try:
+            f = open(path, 'rb')
+        except (IOError, OSError):
+            return None
+        try:
+            meta = json.loads(f.readline().decode('utf-8'))
+            body = f if stream else f.read()
+            os.utime(path, None)  # mark as recently used
+        except (IOError, OSError, ValueError):
+            f.close()
+            return None
+        finally:
+            if not stream:
+                f.close()
+        if meta.get('url') != url:
+            if stream:
+                f.close()
+            return None
+        return CacheEntry(url=url, stored=meta['stored'], etag=meta['etag'],
+                          last_modified=meta['last_modified'],
+                          content_type=meta['content_type'], body=body)
+
+    def is_fresh(self, entry):
+        """
+        Return True if entry can be used without revalidating it.
+        """
+        return time.time() - entry.stored < self.ttl
+
+    def put(self, url, body, etag=None, last_modified=None,
+            content_type=None):
+        """
+        Store (or replace) the entry for url.
+        """
+        writer = self.writer(url, etag, last_modified, content_type)
+        try:
+            writer.write(body)
+        except Exception:
+            writer.abort()
+            raise
+        writer.commit()
+
+    def writer(self, url, etag=None, last_modified=None, content_type=None):
+        """
+        Return an EntryWriter that stores (or replaces) the entry for url
+        with the body written to it.
+        """
+        meta = {'url': url, 'stored': time.time(), 'etag': etag,
+                'last_modified': last_modified, 'content_type': content_type}
+        return EntryWriter(self, url, meta)
+
+    def _commit(self, url, tmp_path):
+        path = self._path(url)
+        new_size = os.path.getsize(tmp_path)
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for _, size, _ in self._entries())
+            try:
+                old_size = os.path.getsize(path)
+            except OSError:
+                old_size = 0
+            try:
+                _replace(tmp_path, path)
+            except OSError:
+                os.remove(tmp_path)
+                raise
+            self._size += new_size - old_size
+            if self._size > self.max_size:
+                self._evict()
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.startswith('.'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def _evict(self):
+        entries = sorted(self._entries())
+        self._size = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if self._size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self._size -= size
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+
+"""
+Records describing the structure of a course, shared by the modules of
+edx-dl.
+"""
+
+from collections import namedtuple
+
+YOUTUBE_VIDEO_ID_LENGTH = 11
+
+Course = namedtuple('Course', ['name', 'url', 'state'])
+Section = namedtuple('Section', ['position', 'name', 'url'])
+SubSection = namedtuple('SubSection', ['url', 'units'])
+Unit = namedtuple('Unit', ['video_youtube_url', 'sub_url'])
+
+
+def youtube_id(video_url):
+    """
+    Return the YouTube id of a http://youtube.com/watch?v=ID url.
+    """
+    return video_url.rsplit('v=', 1)[-1]
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+"""
+Links to the videos that are already downloaded.
+
+The same YouTube video is often in several units (e.g. as a video player
+and as an embedded iframe) or in several courses. It is downloaded once per
+output directory and format, and the other units get a link to that file
+under their own name.
+"""
+
+from __future__ import unicode_literals
+
+import os
+import shutil
+
+LINK_MODES = ('hardlink', 'symlink', 'copy', 'off')
+DEFAULT_LINK_MODE = 'hardlink'
+
+# the files next to a video that belong to it, e.g. video.en.vtt
+SIDE_EXTENSIONS = ('.srt', '.vtt')
+
+
+def link_file(src, dst, mode=DEFAULT_LINK_MODE):
+    """
+    Make dst a hard link, a (relative) symbolic link or a copy of src,
+    according to mode. Where links are not supported, e.g. on another
+    filesystem, src is copied.
+    """
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        if mode == 'hardlink':
+            os.link(src, dst)
+            return
+        if mode == 'symlink':
+            os.symlink(os.path.relpath(src, os.path.dirname(dst)), dst)
+            return
+    except (AttributeError, NotImplementedError, OSError):
+        pass
+    shutil.copyfile(src, dst)
+
+
+def link_video(path, target_dir, prefix, mode=DEFAULT_LINK_MODE,
+               subtitles=False):
+    """
+    Link the video at path (a <prefix>-<title>.<ext> file), and its
+    subtitles if subtitles is set, to target_dir with prefix instead of
+    its own. Returns the filename of the linked video.
+    """
+    directory, filename = os.path.split(path)
+    names = [filename]
+    if subtitles:
+        basename = os.path.splitext(filename)[0] + '.'
+        names.extend(name for name in sorted(os.listdir(directory))
+                     if name.startswith(basename) and
+                     os.path.splitext(name)[1] in SIDE_EXTENSIONS)
+    if not os.path.isdir(target_dir):
+        os.makedirs(target_dir)
+    for name in names:
+        dst = os.path.join(target_dir, prefix + '-' + name.partition('-')[2])
+        src = os.path.join(directory, name)
+        if os.path.abspath(src) != os.path.abspath(dst):
+            link_file(src, dst, mode)
+    return prefix + '-' + filename.partition('-')[2]
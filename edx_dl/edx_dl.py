@@ -11,29 +11,20 @@ except ImportError:
     import __builtin__ as builtins
 
 try:
-    from http.cookiejar import CookieJar
+    from urllib.parse import urlencode, urlparse
 except ImportError:
-    from cookielib import CookieJar
+    from urllib import urlencode
+    from urlparse import urlparse
 
 try:
-    from urllib.parse import urlencode
+    from urllib.error import HTTPError, URLError
 except ImportError:
-    from urllib import urlencode
+    from urllib2 import HTTPError, URLError
 
 try:
-    from urllib.request import urlopen
-    from urllib.request import build_opener
-    from urllib.request import install_opener
-    from urllib.request import HTTPCookieProcessor
-    from urllib.request import Request
-    from urllib.request import URLError
+    from queue import Queue
 except ImportError:
-    from urllib2 import urlopen
-    from urllib2 import build_opener
-    from urllib2 import install_opener
-    from urllib2 import HTTPCookieProcessor
-    from urllib2 import Request
-    from urllib2 import URLError
+    from Queue import Queue
 
 # we alias the raw_input function for python 3 compatibility
 try:
@@ -43,20 +34,45 @@ except NameError:
 
 import argparse
 import getpass
+import hashlib
 import json
+import netrc
 import os
 import os.path
 import re
+import socket
 import sys
+import threading
+import time
 
 
-from collections import namedtuple
-from datetime import timedelta, datetime
+from collections import deque, namedtuple
 from functools import partial
-from multiprocessing.dummy import Pool as ThreadPool
-from subprocess import Popen, PIPE
-
-from bs4 import BeautifulSoup
+from itertools import islice
+
+from .backends import BACKENDS, DEFAULT_BACKEND, DEFAULT_BATCH_SIZE
+from .backends import BatchBackend, DownloadRequest, LibraryBackend
+from .backends import SubprocessBackend, find_video, library_available
+from .cache import DEFAULT_MAX_SIZE, DEFAULT_TTL
+from .common import YOUTUBE_VIDEO_ID_LENGTH
+from .common import Course, Section, SubSection, Unit, youtube_id
+from .dedup import DEFAULT_LINK_MODE, LINK_MODES, link_video
+from .formats import DEFAULT_SPEED, DEFAULT_TTL as DEFAULT_FORMATS_TTL
+from .formats import DEFAULT_WORKERS as DEFAULT_PROBE_WORKERS
+from .formats import FormatCache, choose_format, common_formats, describe
+from .formats import fit_budget, format_size, plan_lines, probe_videos
+from .index import CourseIndex, course_structure, export_index, index_filename
+from .index import course_list_filename, load_course_list, save_course_list
+from .metrics import Metrics, profile, write_prometheus, write_report
+from . import subtitles
+from .cache import ResponseCache, default_cache_dir, ensure_private_dir
+from .priority import DEFAULT_PRIORITY, PRIORITIES, order_jobs
+from .priority import parse_priority
+from .throttle import DEFAULT_BACKOFF, DEFAULT_MAX_PER_HOST, DEFAULT_RETRIES
+from .throttle import AIMDController
+from .throttle import TokenBucket, parse_rate
+from .watch import WatchStatus, jittered, parse_interval
+from .workqueue import DEFAULT_LEASE
 
 OPENEDX_SITES = {
     'edx': {
@@ -90,12 +106,27 @@ LOGIN_API = BASE_URL + '/login_ajax'
 DASHBOARD = BASE_URL + '/dashboard'
 COURSEWARE_SEL = OPENEDX_SITES['edx']['courseware-selector']
 
-YOUTUBE_VIDEO_ID_LENGTH = 11
+Site = namedtuple('Site', ['name', 'url', 'login_api', 'dashboard',
+                           'courseware_selector'])
+
+# e.g. courses/BerkeleyX/CS191x/2013_Spring or courses/course-v1:MITx+6.00x+2T2015
+RE_COURSE_ID = re.compile(r'/courses/(course-v1:[^/]+|[^/]+/[^/]+/[^/]+)')
+
+DEFAULT_COURSE_JOBS = 2
+
+_default_session = None
+_metrics = Metrics()
+_bandwidth = None
+_parse_pool = None
+_runner = None
+_runner_lock = threading.Lock()
+_directories_lock = threading.Lock()
 
-Course = namedtuple('Course', ['name', 'url', 'state'])
-Section = namedtuple('Section', ['position', 'name', 'url'])
-SubSection = namedtuple('SubSection', ['url', 'units'])
-Unit = namedtuple('Unit', ['video_youtube_url', 'sub_url'])
+# duplicate_of is the path (relative to the output directory) of the video
+# the unit was linked to instead of downloading it again
+DownloadResult = namedtuple('DownloadResult', ['prefix', 'unit', 'returncode',
+                                               'subtitles_ok', 'filename',
+                                               'skipped', 'duplicate_of'])
 
 
 # To replace the print function, the following function must be placed
@@ -136,7 +167,24 @@ def print(*objects, **kwargs):
     return builtins.print(*texts, **kwargs)
 
 
+def get_site(site_name):
+    """
+    Return the Site of the platform site_name of OPENEDX_SITES.
+    """
+    base_url = OPENEDX_SITES[site_name]['url']
+    return Site(name=site_name, url=base_url,
+                login_api=base_url + '/login_ajax',
+                dashboard=base_url + '/dashboard',
+                courseware_selector=OPENEDX_SITES[site_name]['courseware-selector'])
+
+
 def change_openedx_site(site_name):
+    """
+    Make site_name the platform of the module defaults (LOGIN_API,
+    DASHBOARD, ...). The functions that crawl a platform take the base url
+    from the urls they are given, so several platforms can be crawled at
+    the same time with a Site each.
+    """
     global BASE_URL
     global EDX_HOMEPAGE
     global LOGIN_API
@@ -147,11 +195,20 @@ def change_openedx_site(site_name):
         print("OpenEdX platform should be one of: %s" % ', '.join(OPENEDX_SITES.keys()))
         sys.exit(2)
 
-    BASE_URL = OPENEDX_SITES[site_name]['url']
-    EDX_HOMEPAGE = BASE_URL + '/login_ajax'
-    LOGIN_API = BASE_URL + '/login_ajax'
-    DASHBOARD = BASE_URL + '/dashboard'
-    COURSEWARE_SEL = OPENEDX_SITES[site_name]['courseware-selector']
+    site = get_site(site_name)
+    BASE_URL = site.url
+    EDX_HOMEPAGE = site.login_api
+    LOGIN_API = site.login_api
+    DASHBOARD = site.dashboard
+    COURSEWARE_SEL = site.courseware_selector
+
+
+def _base_url(url):
+    """
+    Return the scheme and host of url, e.g. https://courses.edx.org.
+    """
+    parts = urlparse(url)
+    return '%s://%s' % (parts.scheme, parts.netloc)
 
 
 def display_courses(courses):
@@ -164,28 +221,19 @@ def display_courses(courses):
         print('%d - [%s] - %s' % (i, state, name))
 
 
-def get_courses_info(url, headers):
+def get_courses_info(url, headers, session=None):
     """
     Extracts the courses information from the dashboard.
     """
-    dash = get_page_contents(url, headers)
-    soup = BeautifulSoup(dash)
-    courses_soup = soup.find_all('article', 'course')
-    courses = []
-    for course_soup in courses_soup:
-        course_name = course_soup.h3.text.strip()
-        course_url = None
-        course_state = 'Not yet'
-        try:
-            # started courses include the course link in the href attribute
-            course_url = BASE_URL + course_soup.a['href']
-            if course_url.endswith('info') or course_url.endswith('info/'):
-                course_state = 'Started'
-        except KeyError:
-            pass
-
-        courses.append(Course(name=course_name, url=course_url, state=course_state))
-    return courses
+    return fetch_records(url, headers, session, 'dashboard')
+
+
+def parse_courses(dash, base_url):
+    """
+    Extracts the courses information from the contents of the dashboard.
+    """
+    from .parsing import CourseParser
+    return parse_page(CourseParser(base_url), [dash], 'dashboard')
 
 
 def get_selected_course(courses):
@@ -211,7 +259,18 @@ def get_selected_course(courses):
     return selected_course
 
 
-def _get_initial_token(url):
+def get_default_session():
+    """
+    Return the session used by the functions that are not given one.
+    """
+    global _default_session
+    if _default_session is None:
+        from .session import Session
+        _default_session = Session(metrics=_metrics)
+    return _default_session
+
+
+def _get_initial_token(url, session=None):
     """
     Create initial connection to get authentication token for future
     requests.
@@ -220,49 +279,110 @@ def _get_initial_token(url):
     X-CSRFToken header or the empty string if we didn't find any token in
     the cookies.
     """
-    cj = CookieJar()
-    opener = build_opener(HTTPCookieProcessor(cj))
-    install_opener(opener)
-    opener.open(url)
+    session = session or get_default_session()
+    session.get(url)
+    return session.cookie('csrftoken') or ''
 
-    for cookie in cj:
-        if cookie.name == 'csrftoken':
-            return cookie.value
 
-    return ''
+def get_available_sections(url, headers, session=None):
+    with _metrics.phase('sections'):
+        return fetch_records(url, headers, session, 'courseware')
 
 
-def get_available_sections(url, headers):
+def parse_sections(courseware, base_url):
+    """
+    Extracts the sections from the contents of the courseware page.
+    """
+    from .parsing import SectionParser
+    return parse_page(SectionParser(base_url), [courseware], 'courseware')
 
-    def _make_url(section_soup):  # FIXME: Extract from here and test
-        return BASE_URL + section_soup.ul.find('a')['href']
 
-    def _get_section_name(section_soup):  # FIXME: Extract from here and test
-        return section_soup.h3.a.string.strip()
+def get_page_contents(url, headers, session=None):
+    """
+    Get the contents of the page at the URL given by url. While making the
+    request, we use the headers given in the dictionary in headers.
+    """
+    session = session or get_default_session()
+    return session.get(url, headers, use_cache=True).text()
 
-    courseware = get_page_contents(url, headers)
-    soup = BeautifulSoup(courseware)
-    sections_soup = soup.find_all('div', attrs={'class': 'chapter'})
 
-    sections = [Section(position=idx,
-                        name=_get_section_name(section_soup),
-                        url=_make_url(section_soup))
-                for idx, section_soup in enumerate(sections_soup, 1)]
+def iter_page_contents(url, headers, session=None):
+    """
+    Yield the contents of the page at url a chunk at a time, as they are
+    received, so that the page is never in memory as a whole.
+    """
+    session = session or get_default_session()
+    return _iter_text(session.get(url, headers, use_cache=True, stream=True))
 
-    return sections
 
+def _iter_text(response):
+    try:
+        for text in response.iter_text():
+            yield text
+    finally:
+        response.close()
 
-def get_page_contents(url, headers):
+
+def fetch_records(url, headers, session, page, known=None):
     """
-    Get the contents of the page at the URL given by url. While making the
-    request, we use the headers given in the dictionary in headers.
+    Return the records of the page at url, of kind page ('subsection',
+    'courseware' or 'dashboard'). The page is parsed as it is received or,
+    with --parse-processes, fetched as a whole and handed to the parse pool.
+    known are the records of the page when it was last parsed: they are
+    returned if the page cache has it unchanged (it is still fresh, or the
+    platform answered 304 to the conditional request).
     """
-    result = urlopen(Request(url, None, headers))
-    try:
-        charset = result.headers.get_content_charset(failobj="utf-8")  # for python3
-    except:
-        charset = result.info().getparam('charset') or 'utf-8'
-    return result.read().decode(charset)
+    session = session or get_default_session()
+    response = session.get(url, headers, use_cache=True,
+                           stream=_parse_pool is None)
+    if known is not None and response.cached:
+        response.close()
+        return known
+    if _parse_pool is None:
+        from .parsing import PARSERS
+        return parse_page(PARSERS[page](_base_url(url)),
+                          _iter_text(response), page)
+    records, seconds = _parse_pool.parse(page, response.read(),
+                                         response.charset(), _base_url(url))
+    _metrics.observe('parse_seconds', seconds, page=page)
+    return records
+
+
+def start_parse_pool(args):
+    """
+    Start the processes of --parse-processes that parse the pages fetched by
+    the threads, if any.
+    """
+    global _parse_pool
+    if args.parse_processes and _parse_pool is None:
+        from .parsing import ParsePool
+        _parse_pool = ParsePool(args.parse_processes)
+
+
+def stop_parse_pool():
+    global _parse_pool
+    if _parse_pool is not None:
+        _parse_pool.close()
+        _parse_pool = None
+
+
+def parse_page(parser, chunks, page):
+    """
+    Return the records (units, sections or courses) that parser finds in
+    the chunks of a page. The time spent parsing is observed as the
+    parse_seconds of page.
+    """
+    records = []
+    seconds = 0.0
+    for chunk in chunks:
+        started = time.time()
+        records.extend(parser.feed(chunk))
+        seconds += time.time() - started
+    started = time.time()
+    records.extend(parser.close())
+    _metrics.observe('parse_seconds', seconds + time.time() - started,
+                     page=page)
+    return records
 
 
 def directory_name(initial_name):
@@ -276,50 +396,64 @@ def directory_name(initial_name):
 
 
 def edx_json2srt(o):
-    output = ''
-    for i, (s, e, t) in enumerate(zip(o['start'], o['end'], o['text'])):
-        if t == "":
-            continue
-        output += str(i) + '\n'
-        s = datetime(1, 1, 1) + timedelta(seconds=s/1000.)
-        e = datetime(1, 1, 1) + timedelta(seconds=e/1000.)
-        output += "%02d:%02d:%02d,%03d --> %02d:%02d:%02d,%03d" % \
-            (s.hour, s.minute, s.second, s.microsecond/1000,
-             e.hour, e.minute, e.second, e.microsecond/1000) + '\n'
-        output += t + "\n\n"
-    return output
+    return subtitles.convert(o, 'srt')
 
 
-def edx_get_subtitle(url, headers):
+def edx_get_transcript(url, headers, session=None):
     """
-    Return a string with the subtitles content from the url or None if no
+    Return the transcript json object from the url or None if no
     subtitles are available.
     """
     try:
-        json_string = get_page_contents(url, headers)
-        json_object = json.loads(json_string)
-        return edx_json2srt(json_object)
+        with _metrics.phase('subtitles'):
+            json_string = get_page_contents(url, headers, session)
+        return json.loads(json_string)
     except URLError as e:
         print('[warning] edX subtitles (error:%s)' % e.reason)
         return None
     except ValueError as e:
-        print('[warning] edX subtitles (error:%s)' % e.message)
+        print('[warning] edX subtitles (error:%s)' % e)
+        return None
+
+
+def edx_get_subtitle(url, headers, session=None, fmt='srt'):
+    """
+    Return a string with the subtitles content from the url or None if no
+    subtitles are available.
+    """
+    transcript = edx_get_transcript(url, headers, session)
+    if transcript is None:
         return None
+    return subtitles.convert(transcript, fmt)
 
 
-def edx_login(url, headers, username, password):
+def edx_login(url, headers, username, password, session=None):
+    session = session or get_default_session()
     post_data = urlencode({'email': username,
                            'password': password,
                            'remember': False}).encode('utf-8')
-    request = Request(url, post_data, headers)
-    response = urlopen(request)
-    resp = json.loads(response.read().decode('utf-8'))
+    response = session.post(url, post_data, headers)
+    resp = json.loads(response.body.decode('utf-8'))
     return resp
 
 
-def parse_args():
+def parse_site_connections(value):
     """
-    Parse the arguments/options passed to the program on the command line.
+    Parse the site=connections,... value of --site-connections.
+    """
+    limits = {}
+    for item in value.split(','):
+        site_name, sep, connections = item.partition('=')
+        if not sep or not connections.isdigit() or int(connections) < 1:
+            raise argparse.ArgumentTypeError('%r is not site=connections' % item)
+        limits[site_name.strip()] = int(connections)
+    return limits
+
+
+def parse_args(argv=None):
+    """
+    Parse the arguments/options passed to the program on the command line
+    (or in argv).
     """
     parser = argparse.ArgumentParser(prog='edx-dl',
                                      description='Get videos from the OpenEdX platform',
@@ -330,8 +464,11 @@ def parse_args():
                         nargs='*',
                         action='store',
                         default=None,
-                        help='target course id '
-                        '(e.g., https://courses.edx.org/courses/BerkeleyX/CS191x/2013_Spring/info/)'
+                        help='target course urls or ids, downloaded without '
+                        'asking anything. Ids are of the --platform unless '
+                        'prefixed with another one, e.g. stanford:Org/Course/Run '
+                        '(e.g., https://courses.edx.org/courses/BerkeleyX/CS191x/2013_Spring/info/), '
+                        'or worker to download the units of a --queue'
                         )
 
     # optional
@@ -355,12 +492,37 @@ def parse_args():
                         action='store_true',
                         default=False,
                         help='download subtitles with the videos')
+    parser.add_argument('--subtitles-format',
+                        dest='subtitles_format',
+                        action='store',
+                        choices=subtitles.FORMATS,
+                        default='srt',
+                        help='format of the edX subtitles (default: %(default)s)')
+    parser.add_argument('--subtitles-lang',
+                        dest='subtitles_languages',
+                        action='store',
+                        type=lambda languages: languages.split(','),
+                        default=list(subtitles.DEFAULT_LANGUAGES),
+                        help='comma separated languages of the edX subtitles, '
+                        'e.g. en,es (default: en)')
     parser.add_argument('-o',
                         '--output-dir',
                         action='store',
                         dest='output_dir',
                         help='store the files to the specified directory',
                         default='Downloaded')
+    parser.add_argument('--netrc',
+                        dest='netrc',
+                        action='store_true',
+                        default=False,
+                        help='take the username and password of each platform '
+                        'from ~/.netrc (by host name)')
+    parser.add_argument('--no-save-session',
+                        dest='save_session',
+                        action='store_false',
+                        default=True,
+                        help='do not keep the login session in the cache '
+                        'directory for the next runs')
     parser.add_argument('-x',
                         '--platform',
                         action='store',
@@ -372,52 +534,359 @@ def parse_args():
                         dest='list',
                         action='store_true',
                         default=False,
-                        help='list available courses without downloading')
-
-    args = parser.parse_args()
+                        help='list available courses without downloading, '
+                        'from the list saved by the last run unless '
+                        '--refresh is given')
+    parser.add_argument('-j',
+                        '--jobs',
+                        dest='jobs',
+                        action='store',
+                        type=int,
+                        default=1,
+                        help='number of videos to download in parallel')
+    parser.add_argument('--stream',
+                        dest='stream',
+                        action='store_true',
+                        default=False,
+                        help='start downloading while the course is still '
+                        'being crawled')
+    parser.add_argument('--backend',
+                        dest='backend',
+                        action='store',
+                        choices=BACKENDS,
+                        default=DEFAULT_BACKEND,
+                        help='how youtube-dl is run: a process per video '
+                        '(subprocess), imported in long lived worker '
+                        'processes (library, needs the youtube_dl module) or '
+                        'a process per batch of videos (batch) '
+                        '(default: %(default)s)')
+    parser.add_argument('--batch-size',
+                        dest='batch_size',
+                        action='store',
+                        type=int,
+                        default=DEFAULT_BATCH_SIZE,
+                        help='videos per youtube-dl process with --backend '
+                        'batch (default: %(default)s)')
+    parser.add_argument('--limit-rate',
+                        dest='limit_rate',
+                        action='store',
+                        type=parse_rate,
+                        default=None,
+                        metavar='RATE',
+                        help='maximum bandwidth of the whole run in bytes '
+                        'per second (e.g. 500K or 4.2M), split statically: '
+                        'each youtube-dl gets RATE divided by the downloads '
+                        'that can run at the same time, even when fewer of '
+                        'them are running')
+    parser.add_argument('--priority',
+                        dest='priority',
+                        action='store',
+                        type=parse_priority,
+                        default=DEFAULT_PRIORITY,
+                        metavar='POLICIES',
+                        help='order of the downloads, comma separated '
+                        'policies among %s: course order, last sections '
+                        'first, smallest videos first (default: course)' %
+                        ', '.join(PRIORITIES))
+    parser.add_argument('--subtitles-first',
+                        dest='subtitles_first',
+                        action='store_true',
+                        default=False,
+                        help='with -s, fetch all the edX subtitles of a '
+                        'course before downloading its videos')
+    parser.add_argument('--dedup',
+                        dest='dedup',
+                        action='store',
+                        choices=LINK_MODES,
+                        default=DEFAULT_LINK_MODE,
+                        help='how a video already downloaded for another unit '
+                        'is reused: hard link, symbolic link or copy, or off '
+                        'to download it again (default: %(default)s)')
+    parser.add_argument('--plan',
+                        dest='plan',
+                        action='store_true',
+                        default=False,
+                        help='probe the formats of the videos and show the '
+                        'sizes to download before downloading')
+    parser.add_argument('--plan-only',
+                        dest='plan_only',
+                        action='store_true',
+                        default=False,
+                        help='show the plan of --plan and exit')
+    parser.add_argument('--max-size',
+                        dest='max_size',
+                        action='store',
+                        type=float,
+                        default=None,
+                        help='download the best format with video and audio '
+                        'of at most this many MB for each video')
+    parser.add_argument('--max-total',
+                        dest='max_total',
+                        action='store',
+                        type=float,
+                        default=None,
+                        help='choose smaller formats for the largest videos '
+                        'until the course takes at most this many MB')
+    parser.add_argument('--expected-speed',
+                        dest='expected_speed',
+                        action='store',
+                        type=float,
+                        default=DEFAULT_SPEED,
+                        help='download speed in MB/s for the time estimates '
+                        'of the plan (default: %(default)s)')
+    parser.add_argument('--probe-workers',
+                        dest='probe_workers',
+                        action='store',
+                        type=int,
+                        default=DEFAULT_PROBE_WORKERS,
+                        help='youtube-dl processes probing the formats at the '
+                        'same time (default: %(default)s)')
+    parser.add_argument('--formats-ttl',
+                        dest='formats_ttl',
+                        action='store',
+                        type=int,
+                        default=DEFAULT_FORMATS_TTL,
+                        help='seconds during which the probed formats of a '
+                        'video are reused (default: %(default)s)')
+    parser.add_argument('--course-jobs',
+                        dest='course_jobs',
+                        action='store',
+                        type=int,
+                        default=DEFAULT_COURSE_JOBS,
+                        help='courses crawled and downloaded at the same time '
+                        'when several are given (default: %(default)s)')
+    parser.add_argument('--site-connections',
+                        dest='site_connections',
+                        action='store',
+                        type=parse_site_connections,
+                        default={},
+                        help='connections per host for some platforms, e.g. '
+                        'edx=8,fun=2 (the others use --connections-per-host)')
+    parser.add_argument('--connections-per-host',
+                        dest='connections_per_host',
+                        action='store',
+                        type=int,
+                        default=DEFAULT_MAX_PER_HOST,
+                        help='maximum number of simultaneous connections to '
+                        'the platform (default: %(default)s)')
+    parser.add_argument('--crawl-workers',
+                        dest='crawl_workers',
+                        action='store',
+                        type=int,
+                        default=20,
+                        help='number of threads fetching the course pages '
+                        '(default: %(default)s)')
+    parser.add_argument('--parse-processes',
+                        dest='parse_processes',
+                        action='store',
+                        type=int,
+                        default=0,
+                        help='number of processes parsing the pages fetched '
+                        'by the --crawl-workers threads, 0 to parse them in '
+                        'those threads as they are received '
+                        '(default: %(default)s)')
+    parser.add_argument('--no-adaptive',
+                        dest='adaptive',
+                        action='store_false',
+                        default=True,
+                        help='always use --connections-per-host connections '
+                        'instead of adapting to the latency and throttling '
+                        'of the platform')
+    parser.add_argument('--retries',
+                        dest='retries',
+                        action='store',
+                        type=int,
+                        default=DEFAULT_RETRIES,
+                        help='times a failed or throttled page request is '
+                        'retried (default: %(default)s)')
+    parser.add_argument('--backoff',
+                        dest='backoff',
+                        action='store',
+                        type=float,
+                        default=DEFAULT_BACKOFF,
+                        help='initial delay in seconds before retrying a '
+                        'request, doubled on each retry (default: %(default)s)')
+    parser.add_argument('--export-index',
+                        dest='export_index',
+                        action='store',
+                        default=None,
+                        metavar='FILE',
+                        help='write the structure of the courses (sections '
+                        'and units) to FILE as json')
+    parser.add_argument('--queue',
+                        dest='queue',
+                        action='store',
+                        default=None,
+                        metavar='FILE',
+                        help='add the units of the courses to the work queue '
+                        'FILE (SQLite) instead of downloading them; '
+                        '"edx-dl worker --queue FILE" downloads them, any '
+                        'number of workers at the same time')
+    parser.add_argument('--lease',
+                        dest='lease',
+                        action='store',
+                        type=int,
+                        default=DEFAULT_LEASE,
+                        help='seconds a worker keeps the units it claimed '
+                        'if it stops renewing them, e.g. because it crashed '
+                        '(default: %(default)s)')
+    parser.add_argument('--watch',
+                        dest='watch',
+                        action='store',
+                        type=parse_interval,
+                        default=None,
+                        metavar='INTERVAL',
+                        help='keep running and download the new videos of '
+                        'the courses (all the started ones of --platform if '
+                        'none is given) every INTERVAL seconds, or e.g. 30m '
+                        'or 6h, give or take 10%%')
+    parser.add_argument('--status',
+                        dest='status',
+                        action='store',
+                        default=None,
+                        metavar='FILE',
+                        help='with --watch, keep the status of the run in '
+                        'FILE as json: the last sync, the next one and the '
+                        'number of videos still to download')
+    parser.add_argument('--verify',
+                        dest='verify',
+                        action='store_true',
+                        default=False,
+                        help='check the videos already downloaded to the '
+                        'output directory and queue the missing or corrupt '
+                        'ones to be downloaded again by the next run')
+    parser.add_argument('--verify-processes',
+                        dest='verify_processes',
+                        action='store',
+                        type=int,
+                        default=None,
+                        help='processes hashing the videos with --verify '
+                        '(default: one per CPU)')
+    parser.add_argument('--report',
+                        dest='report',
+                        action='store',
+                        default=None,
+                        metavar='FILE',
+                        help='write the timings of the phases of the run, '
+                        'the latencies and bytes of the requests, the parse '
+                        'times and the download throughput to FILE as json')
+    parser.add_argument('--prometheus',
+                        dest='prometheus',
+                        action='store',
+                        default=None,
+                        metavar='FILE',
+                        help='write the same metrics to FILE in the '
+                        'Prometheus text format (e.g. for the textfile '
+                        'collector of node_exporter)')
+    parser.add_argument('--profile',
+                        dest='profile',
+                        action='store',
+                        default=None,
+                        metavar='FILE',
+                        help='run under cProfile (and tracemalloc) and dump '
+                        'the statistics to FILE, with a summary in FILE.txt')
+    parser.add_argument('--cache-dir',
+                        dest='cache_dir',
+                        action='store',
+                        default=default_cache_dir(),
+                        help='directory for the cached pages '
+                        '(default: %(default)s)')
+    parser.add_argument('--cache-ttl',
+                        dest='cache_ttl',
+                        action='store',
+                        type=int,
+                        default=DEFAULT_TTL,
+                        help='seconds during which a cached page is used '
+                        'without revalidating it (default: %(default)s)')
+    parser.add_argument('--cache-size',
+                        dest='cache_size',
+                        action='store',
+                        type=int,
+                        default=DEFAULT_MAX_SIZE // (1024 * 1024),
+                        help='maximum size of the page cache in MB '
+                        '(default: %(default)s)')
+    parser.add_argument('--no-cache',
+                        dest='use_cache',
+                        action='store_false',
+                        default=True,
+                        help='do not use the page cache')
+    parser.add_argument('--refresh',
+                        dest='refresh',
+                        action='store_true',
+                        default=False,
+                        help='ignore the cached pages and fetch them again '
+                        '(with --verify, hash all the videos again, with '
+                        '--list, fetch the list of courses)')
+
+    args = parser.parse_args(argv)
+
+    # edx-dl worker --queue FILE
+    args.worker = args.course_id[:1] == ['worker']
+    if args.worker:
+        args.course_id = args.course_id[1:]
+        if not args.queue:
+            parser.error('the worker needs a --queue')
+        if args.watch:
+            parser.error('the worker can not --watch')
+    elif args.queue and not args.course_id and not args.watch:
+        parser.error('--queue needs the courses to add to the queue')
     return args
 
 
-def edx_get_headers():
+def edx_get_headers(session=None, site=None):
+    homepage = site.login_api if site is not None else EDX_HOMEPAGE
+    return edx_make_headers(homepage,
+                            _get_initial_token(homepage, session))
+
+
+def edx_make_headers(homepage, token):
+    """
+    Return the headers of the requests to the platform, given the CSRF token
+    we got from homepage.
+    """
     headers = {
         'User-Agent': 'edX-downloader/0.01',
         'Accept': 'application/json, text/javascript, */*; q=0.01',
         'Content-Type': 'application/x-www-form-urlencoded;charset=utf-8',
-        'Referer': EDX_HOMEPAGE,
+        'Referer': homepage,
         'X-Requested-With': 'XMLHttpRequest',
-        'X-CSRFToken': _get_initial_token(EDX_HOMEPAGE),
+        'X-CSRFToken': token,
     }
     return headers
 
 
-def extract_subsection(url, headers):
+def edx_logged_in_dashboard(url, headers, session=None, use_cache=False):
+    """
+    Return the contents of the dashboard at url if the session is logged
+    in, or None if the platform sends us to log in. This is how a saved
+    session is checked, the dashboard is needed anyway. With use_cache the
+    dashboard in the page cache is revalidated instead of fetched again.
+    """
+    session = session or get_default_session()
+    try:
+        response = session.get(url, headers, use_cache=use_cache)
+    except HTTPError as e:
+        if e.code in (401, 403):
+            return None
+        raise
+    if urlparse(response.url).path.rstrip('/') != urlparse(url).path.rstrip('/'):
+        return None
+    return response.text()
+
+
+def extract_subsection(url, headers, session=None, known=None):
     """
     Parses a webpag and extracts its resources e.g. video_url, sub_url, etc.
+    known is the SubSection of the page when it was last crawled, returned
+    as it is if the page did not change.
     """
     print("Processing '%s'..." % url)
-    page = get_page_contents(url, headers)
-
-    re_splitter = re.compile(r'data-streams=(?:&#34;|").*1.0[0]*:')
-    re_subs = re.compile(r'data-transcript-translation-url=(?:&#34;|")([^"&]*)(?:&#34;|")')
-    re_units = re_splitter.split(page)[1:]
-    units = []
-    for unit_html in re_units:
-        video_id = unit_html[:YOUTUBE_VIDEO_ID_LENGTH]
-        sub_url = None
-        match_subs = re_subs.search(unit_html)
-        if match_subs:
-            sub_url = BASE_URL + match_subs.group(1) + "/en" + "?videoId=" + video_id
-        units.append(Unit(video_youtube_url='http://youtube.com/watch?v=' + video_id,
-                          sub_url=sub_url))
-
-    # Try to download some extra videos which is referred by iframe
-    re_extra_youtube = re.compile(r'//w{0,3}\.youtube.com/embed/([^ \?&]*)[\?& ]')
-    extra_ids = re_extra_youtube.findall(page)
-    for extra_id in extra_ids:
-        units.append(Unit(video_youtube_url='http://youtube.com/watch?v=' + extra_id[:YOUTUBE_VIDEO_ID_LENGTH]))
-
-    section_info = SubSection(url=url, units=units)
-    return section_info
+    with _metrics.phase('crawl'):
+        units = fetch_records(url, headers, session, 'subsection',
+                              known.units if known is not None else None)
+    if known is not None and units is known.units:
+        return known
+    return SubSection(url=url, units=units)
 
 
 def _extract_urls_from_subsections(subsections):
@@ -435,12 +904,13 @@ def _extract_urls_from_subsections(subsections):
     return video_urls, sub_urls
 
 
-def extract_all_subsections(urls, headers):
+def extract_all_subsections(urls, headers, session=None, workers=20):
     # for development purposes you may want to uncomment this line
     # to test serial execution, and comment all the pool related ones
     # all_resources = [extract_subsection(url, headers) for url in urls]
-    mapfunc = partial(extract_subsection, headers=headers)
-    pool = ThreadPool(20)
+    mapfunc = partial(extract_subsection, headers=headers, session=session)
+    from multiprocessing.dummy import Pool as ThreadPool
+    pool = ThreadPool(workers)
     all_resources = pool.map(mapfunc, urls)
     pool.close()
     pool.join()
@@ -448,6 +918,144 @@ def extract_all_subsections(urls, headers):
     return video_urls, sub_urls
 
 
+def crawl_subsections(urls, headers, session=None, workers=20, known=None):
+    """
+    Return the SubSection of each url, in order. The ones in the dict known
+    (by url) are reused if their pages did not change.
+    """
+    known = known or {}
+    from multiprocessing.dummy import Pool as ThreadPool
+    pool = ThreadPool(workers)
+    subsections = pool.map(
+        lambda url: extract_subsection(url, headers, session, known.get(url)),
+        urls)
+    pool.close()
+    pool.join()
+    return subsections
+
+
+def iter_subsections(urls, headers, session=None, workers=20, window=None,
+                     known=None):
+    """
+    Yields the SubSection of each url in order, as soon as it and all the
+    previous ones are parsed. At most window pages are fetched ahead of
+    what the consumer has taken, so a slow consumer slows the crawl down.
+    The ones in the dict known (by url) are reused if their pages did not
+    change.
+    """
+    window = window or workers
+    known = known or {}
+    urls = iter(urls)
+    from multiprocessing.dummy import Pool as ThreadPool
+    pool = ThreadPool(workers)
+    pending = deque()
+
+    def submit(url):
+        return pool.apply_async(extract_subsection,
+                                (url, headers, session, known.get(url)))
+
+    try:
+        for url in islice(urls, window):
+            pending.append(submit(url))
+        while pending:
+            subsection = pending.popleft().get()
+            for url in islice(urls, 1):
+                pending.append(submit(url))
+            yield subsection
+    finally:
+        pool.terminate()
+
+
+def crawl_and_download(sections, target_dir, args, headers, session, state,
+                       index=None, ask_format=False, all_sections=None):
+    """
+    Crawls the subsections of sections (reusing the ones of the CourseIndex
+    index whose pages did not change) and downloads their units. all_sections are all the
+    sections of the course, if sections are only some of them. Returns the
+    SubSections and the list of DownloadResult (None with --plan-only).
+    """
+    urls = [section.url for section in sections]
+    complete = all_sections is None
+    known = {}
+    if index is not None:
+        known = index.known(sections)
+    probe = (ask_format or args.plan or args.plan_only or args.max_size or
+             args.max_total or 'size' in args.priority)
+    ordered = args.priority != DEFAULT_PRIORITY
+    if args.stream and probe:
+        print('[info] The formats are probed before downloading, '
+              'not streaming')
+    elif args.stream and ordered:
+        print('[info] The videos are downloaded in --priority order, '
+              'not streaming')
+    if args.stream and not probe and not ordered:
+        # Crawl and download at the same time
+        subsections = []
+
+        def crawl():
+            for subsection in iter_subsections(urls, headers, session,
+                                               workers=args.crawl_workers,
+                                               known=known):
+                subsections.append(subsection)
+                yield subsection
+
+        results = download_jobs(iter_download_jobs(crawl()), target_dir,
+                                args, headers, session, state)
+        update_index(index, sections, subsections, known, complete)
+        return subsections, results
+
+    subsections = crawl_subsections(urls, headers, session,
+                                    args.crawl_workers, known)
+    update_index(index, sections, subsections, known, complete)
+    units = [unit for subsection in subsections for unit in subsection.units]
+    if not units:
+        return subsections, []
+    positions = [section.position
+                 for section, subsection in zip(sections, subsections)
+                 for _ in subsection.units]
+    results = download_course_units(units, target_dir, args, headers, session,
+                                    state, ask_format, positions)
+    return subsections, results
+
+
+def update_index(index, sections, subsections, known, complete=True):
+    """
+    Record the crawled subsections of sections in the CourseIndex index (if
+    not None) and tell how many of the known ones did not change.
+    """
+    if index is None:
+        return
+    unchanged = len([subsection for subsection in subsections
+                     if known.get(subsection.url) is subsection])
+    if unchanged:
+        print('[info] %d of %d sections did not change since %s' % (
+            unchanged, len(sections),
+            time.strftime('%Y-%m-%d %H:%M', time.localtime(index.updated))))
+    index.update(sections, subsections, complete)
+    index.save()
+
+
+def get_index(args, site, courseware_url):
+    """
+    Return the CourseIndex of the course, or None if the cache is disabled.
+    """
+    if not args.use_cache:
+        return None
+    return CourseIndex(index_filename(os.path.join(args.cache_dir, 'index'),
+                                      site.name, courseware_url),
+                       refresh=args.refresh)
+
+
+def iter_download_jobs(subsections):
+    """
+    Yields the (filename_prefix, unit) jobs of the units of subsections,
+    numbered in the same way as in a non streamed run.
+    """
+    units = (unit for subsection in subsections for unit in subsection.units)
+    for i, unit in enumerate(units, 1):
+        yield str(i).zfill(2), unit
+
+
 def display_sections(course_name, sections):
     """
     List the weeks for the given course.
@@ -474,24 +1082,1218 @@ def get_selected_sections(sections):
     return [sections[number - 1]]
 
 
-def execute_command(cmd):
+def get_runner():
+    """
+    Return the ProcessRunner that supervises the youtube-dl processes.
+    """
+    global _runner
+    with _runner_lock:
+        if _runner is None:
+            from .runner import ProcessRunner
+            _runner = ProcessRunner()
+        return _runner
+
+
+def execute_command(cmd, echo=True, name=None):
     """
     Creates a process with the given command cmd and writes its output.
+
+    If echo is False the output is not written, only the progress is shown
+    in a status line shared by all the running commands, which is what we
+    want when several commands run at the same time. Returns the exit
+    status of the process and its output (without the progress lines).
     """
-    popen = Popen(cmd, stdout=PIPE, stderr=PIPE)
-    stdout = b''
-    while True:  # Save output to youtube_stdout while this being echoed
-        tmp = popen.stdout.read(1)
-        stdout += tmp
-        print(tmp, end="")
-        sys.stdout.flush()
-        # do it until the process finish and there isn't output
-        if tmp == b"" and popen.poll() is not None:
-            break
+    if name is None and '-o' in cmd:
+        # the NN prefix of the output template identifies the download
+        name = os.path.basename(cmd[cmd.index('-o') + 1]).split('-')[0]
+    return get_runner().run(cmd, name, echo)
+
+
+def get_format_cache(args):
+    """
+    Return the FormatCache of the probed formats, or None if the cache is
+    disabled.
+    """
+    if not args.use_cache:
+        return None
+    return FormatCache(os.path.join(args.cache_dir, 'formats'),
+                       ttl=args.formats_ttl, refresh=args.refresh)
+
+
+def probe_units(units, args):
+    """
+    Return a dict with the VideoInfo of the videos of units by YouTube id,
+    probing with youtube-dl the ones that are not in the format cache.
+    """
+    cache = get_format_cache(args)
+    urls = [unit.video_youtube_url for unit in units]
+    print('[info] Probing the formats of %d videos' % len(urls))
+    with _metrics.phase('probe'):
+        infos = probe_videos(urls, execute_command, cache,
+                             args.probe_workers)
+    if len(infos) < len(set(youtube_id(url) for url in urls)):
+        print('[warning] the formats of some videos could not be probed')
+    return infos
+
+
+def display_formats(infos):
+    """
+    List the formats that all the videos have, with their total size.
+    """
+    formats = common_formats(infos.values())
+    if not formats:
+        print('No format is available for all the videos')
+    for f, total in formats:
+        size = format_size(total) if total is not None else 'unknown size'
+        print('%s: %s in total' % (describe(f), size))
+
+
+def plan_formats(units, infos, args):
+    """
+    Return the Format that will be downloaded for each video by YouTube id
+    (None if we can not tell) and the youtube-dl formats to use for the
+    videos whose format was chosen to fit in --max-size/--max-total.
+    """
+    chosen = {}
+    formats = {}
+    if args.max_size or args.max_total:
+        max_size = args.max_size * 1024 * 1024 if args.max_size else None
+        max_total = args.max_total * 1024 * 1024 if args.max_total else None
+        budget, met = fit_budget(infos.values(), max_size, max_total)
+        if not met:
+            print('[warning] the videos do not fit in the size budget, '
+                  'using their smallest formats')
+        for video_id, f in budget.items():
+            formats[video_id] = f.format_id
+        chosen.update(budget)
+    spec = args.format + '/mp4' if args.format else 'mp4'
+    for unit in units:
+        video_id = youtube_id(unit.video_youtube_url)
+        if video_id not in chosen:
+            info = infos.get(video_id)
+            chosen[video_id] = choose_format(info, spec) if info else None
+    return chosen, formats
+
+
+def _missing_subtitles(target_dir, filename, args):
+    """
+    Return the languages whose subtitles are not written yet for the video
+    filename (all of them if the video is not downloaded yet).
+    """
+    languages = args.subtitles_languages
+    if filename is None:
+        return list(languages)
+    basename = os.path.splitext(filename)[0]
+    return [language for language in languages
+            if not os.path.exists(os.path.join(
+                target_dir, subtitles.subtitles_filename(
+                    basename, language, args.subtitles_format, languages)))]
+
+
+def write_subtitles(target_dir, filename, transcripts, args):
+    """
+    Writes the (language, transcript) edX subtitles next to the downloaded
+    video filename.
+    """
+    basename = os.path.splitext(filename)[0]
+    for language, transcript in transcripts:
+        if not transcript:
+            continue
+        subs_filename = os.path.join(target_dir, subtitles.subtitles_filename(
+            basename, language, args.subtitles_format,
+            args.subtitles_languages))
+        print('[info] Writing edX subtitles: %s' % subs_filename)
+        subtitles.save_subtitles(transcript, subs_filename,
+                                 args.subtitles_format)
+
+
+def _subtitles_fetcher(args, headers, session):
+    """
+    Return the SubtitleFetcher for the edX subtitles or None if they were
+    not requested.
+    """
+    if not args.subtitles:
+        return None
+    fetch = partial(edx_get_transcript, headers=headers, session=session)
+    return subtitles.SubtitleFetcher(fetch, args.subtitles_languages)
+
+
+def get_backend(args, processes=1):
+    """
+    Return the download backend selected with --backend. The library
+    backend falls back to the youtube-dl command if youtube_dl can not be
+    imported.
+    """
+    name = args.backend
+    if name == 'library' and not library_available():
+        print('[warning] youtube_dl can not be imported, '
+              'running the youtube-dl command instead')
+        name = 'subprocess'
+    rate = download_rate(args)
+    if name == 'library':
+        return LibraryBackend(processes, rate)
+    if name == 'batch':
+        return BatchBackend(execute_command, args.batch_size, rate)
+    return SubprocessBackend(execute_command, rate)
+
+
+def download_rate(args):
+    """
+    Return the bytes per second each youtube-dl may download at, its share
+    of --limit-rate among all the downloads that can run at the same time
+    (--jobs of each of the --course-jobs courses), or None if unlimited.
+    The share is fixed when youtube-dl starts: it is not given the shares
+    of the downloads that finished or never started.
+    """
+    if not args.limit_rate:
+        return None
+    workers = max(1, args.jobs)
+    if args.course_id:
+        workers *= max(1, min(args.course_jobs, len(args.course_id)))
+    return max(1, args.limit_rate // workers)
+
+
+def get_bandwidth(args):
+    """
+    Return the TokenBucket of --limit-rate shared by the sessions of all
+    the platforms, or None if unlimited.
+    """
+    global _bandwidth
+    if not args.limit_rate:
+        return None
+    with _runner_lock:
+        if _bandwidth is None:
+            _bandwidth = TokenBucket(args.limit_rate)
+        return _bandwidth
+
+
+def download_unit(job, target_dir, args, headers, session=None, state=None,
+                  echo=True, fetcher=None, backend=None, formats=None):
+    """
+    Downloads the video of a single unit (and its subtitles if requested).
+
+    job is a (filename_prefix, unit) pair. Returns its DownloadResult.
+    """
+    return download_batch([job], target_dir, args, headers, session, state,
+                          echo, fetcher, backend, formats)[0]
+
+
+def download_batch(jobs, target_dir, args, headers, session=None,
+                   state=None, echo=True, fetcher=None, backend=None,
+                   formats=None):
+    """
+    Downloads the videos of the (filename_prefix, unit) jobs with a single
+    call to the backend (and their subtitles if requested).
+
+    Everything that depends on the downloaded files is done here, so that
+    the results are the same no matter in which order the jobs finish.
+    Units that the state store knows as complete are not downloaded again,
+    and the videos it knows in the same format are linked (see --dedup).
+    The subtitles are taken from the fetcher, which may have fetched them
+    while the videos were downloading. formats has the youtube-dl format
+    of some of the videos by YouTube id, the others use args.format.
+    Returns the list of DownloadResult of the jobs.
+    """
+    from .state import COMPLETE, FAILED
+    dedup = state is not None and args.dedup != 'off'
+    filenames = {}
+    if state is not None:
+        for filename_prefix, unit in jobs:
+            filenames[filename_prefix] = state.completed_file(
+                target_dir, filename_prefix, youtube_id(unit.video_youtube_url))
+    skipped = set(prefix for prefix, filename in filenames.items()
+                  if filename is not None)
+    returncodes = dict((prefix, 0) for prefix in skipped)
+
+    video_format_option = args.format + '/mp4' if args.format else 'mp4'
+    formats = formats or {}
+    requests = [DownloadRequest(url=unit.video_youtube_url,
+                                target_dir=target_dir, prefix=filename_prefix,
+                                format=formats.get(
+                                    youtube_id(unit.video_youtube_url),
+                                    video_format_option),
+                                write_sub=bool(args.subtitles))
+                for filename_prefix, unit in jobs
+                if filename_prefix not in skipped]
+    units = dict(jobs)
+
+    # Only the first request of each video (and format) is downloaded, the
+    # others are linked to it, or to where it was downloaded before
+    keys = dict((request.prefix, (youtube_id(request.url), request.format))
+                for request in requests)
+    firsts = {}
+    stored = {}
+    downloads = requests
+    if dedup and requests:
+        for request in requests:
+            firsts.setdefault(keys[request.prefix], request)
+        stored = state.claim_videos(firsts)
+        downloads = [request for key, request in firsts.items()
+                     if key not in stored]
+        downloads.sort(key=lambda request: request.prefix)
+    try:
+        if downloads:
+            own_backend = backend is None
+            if own_backend:
+                backend = get_backend(args)
+            started = time.time()
+            try:
+                outcomes = backend.download(downloads, echo)
+            finally:
+                if own_backend:
+                    backend.close()
+            _metrics.download(
+                [request.prefix for request in downloads],
+                sum(_file_size(target_dir, filename)
+                    for _, filename in outcomes if filename is not None),
+                time.time() - started)
+            for request, (returncode, filename) in zip(downloads, outcomes):
+                if returncode == 0 and filename is None:
+                    filename = get_filename(target_dir, request.prefix)
+                returncodes[request.prefix] = returncode
+                filenames[request.prefix] = filename
+                if state is not None:
+                    status = COMPLETE if filename is not None else FAILED
+                    state.update(target_dir, request.prefix,
+                                 units[request.prefix], status, filename)
+                if dedup and filename is not None:
+                    state.store_video(keys[request.prefix][0],
+                                      request.format,
+                                      os.path.join(target_dir, filename))
+    finally:
+        if dedup and requests:
+            state.release_videos(key for key in firsts if key not in stored)
+
+    duplicates = {}
+    for request in requests:
+        if request.prefix in returncodes:
+            continue
+        key = keys[request.prefix]
+        original = stored.get(key)
+        if original is None:
+            first = firsts[key].prefix
+            if filenames.get(first) is None:
+                returncodes[request.prefix] = returncodes[first] or 1
+                continue
+            original = os.path.relpath(os.path.join(target_dir,
+                                                    filenames[first]),
+                                       state.output_dir)
+        try:
+            filename = link_video(os.path.join(state.output_dir, original),
+                                  target_dir, request.prefix, args.dedup,
+                                  request.write_sub)
+        except (IOError, OSError) as e:
+            print('[error] %s: could not link %s: %s' %
+                  (request.prefix, original, e))
+            returncodes[request.prefix] = 1
+            continue
+        returncodes[request.prefix] = 0
+        filenames[request.prefix] = filename
+        duplicates[request.prefix] = original
+        state.update(target_dir, request.prefix, units[request.prefix],
+                     COMPLETE, filename)
+
+    results = []
+    for filename_prefix, unit in jobs:
+        filename = filenames.get(filename_prefix)
+        subtitles_ok = True
+        if args.subtitles and unit.sub_url:
+            if filename is None:
+                print('[warning] no video downloaded for %s' % filename_prefix)
+                subtitles_ok = False
+            else:
+                missing = _missing_subtitles(target_dir, filename, args)
+                if missing:
+                    fetcher = fetcher or _subtitles_fetcher(args, headers,
+                                                            session)
+                    transcripts = fetcher.transcripts(filename_prefix,
+                                                      unit.sub_url, missing)
+                    write_subtitles(target_dir, filename, transcripts, args)
+        results.append(DownloadResult(prefix=filename_prefix, unit=unit,
+                                      returncode=returncodes[filename_prefix],
+                                      subtitles_ok=subtitles_ok,
+                                      filename=filename,
+                                      skipped=filename_prefix in skipped,
+                                      duplicate_of=duplicates.get(
+                                          filename_prefix)))
+    return results
+
+
+def _file_size(directory, filename):
+    try:
+        return os.path.getsize(os.path.join(directory, filename))
+    except OSError:
+        return 0
+
+
+def download_units(units, target_dir, args, headers, session=None,
+                   state=None, formats=None, sections=None, sizes=None):
+    """
+    Downloads all the units using at most args.jobs parallel downloads.
+    The filename prefixes are assigned before anything starts, so the
+    numbering does not depend on the completion or --priority order.
+    sections (the section number of each unit) and sizes (the size of the
+    videos by YouTube id) are used by the priority policies.
+
+    Returns the list of DownloadResult in the order of the units.
+    """
+    jobs = [(str(i).zfill(2), unit) for i, unit in enumerate(units, 1)]
+    if args.priority != DEFAULT_PRIORITY:
+        jobs = order_jobs(jobs, args.priority, sections, sizes)
+    return download_jobs(jobs, target_dir, args, headers, session, state,
+                         total=len(jobs), formats=formats)
+
+
+def download_jobs(jobs, target_dir, args, headers, session=None, state=None,
+                  total=None, formats=None):
+    """
+    Downloads the (filename_prefix, unit) jobs with at most args.jobs
+    parallel downloads, each of them a batch of jobs if the backend takes
+    batches.
+
+    jobs can be any iterable, e.g. one that is still crawling the course:
+    it is consumed through a bounded queue, so it is not read much further
+    than what the downloaders can handle. The edX subtitles are fetched
+    concurrently a few jobs ahead of the downloads. Returns the list of
+    DownloadResult sorted by prefix.
+    """
+    num_jobs = max(1, args.jobs if total is None else min(args.jobs, total))
+    # the library backend starts its processes before any other thread
+    backend = get_backend(args, num_jobs)
+    batch_size = backend.batch_size
+    if total is not None:
+        # smaller batches if there are not enough to keep every job busy
+        batch_size = max(1, min(batch_size, -(-total // num_jobs)))
+    fetcher = _subtitles_fetcher(args, headers, session)
+    if fetcher is not None:
+        def subtitles_job(job):
+            prefix, unit = job
+            if not unit.sub_url:
+                return None
+            filename = None
+            if state is not None:
+                filename = state.completed_file(
+                    target_dir, prefix, youtube_id(unit.video_youtube_url))
+            if not _missing_subtitles(target_dir, filename, args):
+                return None
+            return prefix, unit.sub_url
+        if args.subtitles_first and total is not None:
+            # every transcript before the first video
+            jobs = list(fetcher.prefetch(jobs, subtitles_job, window=total))
+            fetcher.wait()
+        else:
+            jobs = fetcher.prefetch(jobs, subtitles_job,
+                                    window=max(subtitles.DEFAULT_WORKERS,
+                                               batch_size))
+    try:
+        with _metrics.phase('download'):
+            return _download_jobs(_batches(jobs, batch_size), target_dir,
+                                  args, headers, session, state, total,
+                                  num_jobs, fetcher, backend, formats)
+    finally:
+        if fetcher is not None:
+            fetcher.close()
+        backend.close()
+
+
+def _batches(jobs, size):
+    jobs = iter(jobs)
+    while True:
+        batch = list(islice(jobs, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _download_jobs(batches, target_dir, args, headers, session, state, total,
+                   num_jobs, fetcher, backend, formats):
+    if num_jobs == 1:
+        results = [result for batch in batches
+                   for result in download_batch(batch, target_dir, args,
+                                                headers, session, state,
+                                                fetcher=fetcher,
+                                                backend=backend,
+                                                formats=formats)]
+        results.sort(key=lambda result: int(result.prefix))
+        return results
+
+    queue = Queue(maxsize=2 * num_jobs)
+    results = []
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            batch = queue.get()
+            if batch is None:
+                break
+            try:
+                batch_results = download_batch(batch, target_dir, args,
+                                               headers, session, state,
+                                               echo=False, fetcher=fetcher,
+                                               backend=backend,
+                                               formats=formats)
+            except Exception as e:
+                print('[error] %s: %s' % (batch[0][0], e))
+                batch_results = [DownloadResult(prefix=prefix, unit=unit,
+                                                returncode=-1,
+                                                subtitles_ok=False,
+                                                filename=None, skipped=False,
+                                                duplicate_of=None)
+                                 for prefix, unit in batch]
+            for result in batch_results:
+                if result.skipped:
+                    status = 'already downloaded'
+                elif result.duplicate_of is not None:
+                    status = 'linked to ' + result.duplicate_of
+                else:
+                    status = 'done' if result.returncode == 0 else 'FAILED'
+                with lock:
+                    results.append(result)
+                    message = '[info] [%d/%s] %s %s (%s)' % (
+                        len(results), total if total is not None else '?',
+                        result.prefix, status, result.unit.video_youtube_url)
+                if _runner is not None:
+                    _runner.message(message)
+                else:
+                    print(message)
+
+    threads = [threading.Thread(target=worker) for _ in range(num_jobs)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for batch in batches:
+        queue.put(batch)
+    for _ in threads:
+        queue.put(None)
+    for thread in threads:
+        thread.join()
+    results.sort(key=lambda result: int(result.prefix))
+    return results
+
+
+def display_download_summary(results):
+    """
+    Prints which units could not be downloaded.
+    """
+    failed = [r for r in results if r.returncode != 0 or not r.subtitles_ok]
+    print('[info] Downloaded %d of %d videos (%d were already downloaded)' %
+          (len([r for r in results if r.returncode == 0]), len(results),
+           len([r for r in results if r.skipped])))
+    for result in failed:
+        if result.returncode != 0:
+            reason = 'youtube-dl exited with status %d' % result.returncode
+        else:
+            reason = 'subtitles not written'
+        print('[error] %s - %s: %s' % (result.prefix,
+                                       result.unit.video_youtube_url, reason))
+    duplicates = [r for r in results if r.duplicate_of is not None]
+    if duplicates:
+        print('[info] %d videos were already downloaded for other units, '
+              'linked instead:' % len(duplicates))
+        for result in duplicates:
+            print('[info]   %s -> %s' % (result.filename, result.duplicate_of))
+
+
+def make_session(args, site_name, username):
+    """
+    Return a new Session for the platform site_name, with its own page
+    cache, adaptive limit and connection limit (--site-connections).
+    """
+    cache = None
+    if args.use_cache:
+        cache = ResponseCache(os.path.join(args.cache_dir, 'pages'),
+                              identity='%s:%s' % (site_name, username),
+                              ttl=args.cache_ttl,
+                              max_size=args.cache_size * 1024 * 1024,
+                              refresh=args.refresh)
+    connections = args.site_connections.get(site_name,
+                                            args.connections_per_host)
+    controller = None
+    if args.adaptive:
+        controller = AIMDController(maximum=connections)
+    from .session import Session
+    return Session(max_per_host=connections, cache=cache,
+                   controller=controller, retries=args.retries,
+                   backoff=args.backoff, metrics=_metrics,
+                   bucket=get_bandwidth(args))
+
+
+def get_credentials(site, args):
+    """
+    Return the (username, password) for site: from ~/.netrc (by host) with
+    --netrc, else the ones given with -u and -p.
+    """
+    if args.netrc:
+        try:
+            auth = netrc.netrc().authenticators(urlparse(site.url).hostname)
+        except (IOError, netrc.NetrcParseError) as e:
+            print('[warning] can not read the .netrc file: %s' % e)
+            auth = None
+        if auth is not None:
+            return auth[0], auth[2]
+    return args.username, args.password
+
+
+def session_filename(cache_dir, site, username):
+    """
+    Return the file where the session of username on site is saved.
+    """
+    key = '%s\n%s\n%s' % (site.name, site.url, username)
+    return os.path.join(cache_dir, 'sessions',
+                        hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+
+def get_course_list(args, site, username):
+    """
+    Return the file of the course list of username on site, or None if the
+    cache is disabled.
+    """
+    if not args.use_cache:
+        return None
+    return course_list_filename(os.path.join(args.cache_dir, 'courses'),
+                                site.name, username)
+
+
+def list_courses(args):
+    """
+    List the courses of the platform --platform: the ones saved by the last
+    run, unless --refresh is given or there are none, else the ones of the
+    dashboard. Returns False if we could not log in.
+    """
+    site = get_site(args.platform)
+    username, _ = get_credentials(site, args)
+    path = get_course_list(args, site, username)
+    saved = None
+    if path is not None and not args.refresh:
+        saved = load_course_list(path)
+    if saved is not None:
+        updated, courses = saved
+        display_courses(courses)
+        print('[info] Course list of %s, use --refresh to update it' %
+              time.strftime('%Y-%m-%d %H:%M', time.localtime(updated)))
+        return True
+
+    context = SiteContext(site, args)
+    try:
+        if context.login() is None:
+            return False
+        display_courses(context.courses())
+    finally:
+        context.close()
+    return True
+
+
+class SiteContext(object):
+    """
+    A platform with its own session, logged in on first use and shared by
+    all the courses of the platform.
+
+    The cookies of the session (with the CSRF token) are saved in the cache
+    directory, one file per platform and user, so the next runs only log
+    in again when the platform does not take them any more.
+    """
+
+    def __init__(self, site, args):
+        self.site = site
+        self.username, self.password = get_credentials(site, args)
+        self.session = make_session(args, site.name, self.username)
+        self.session_file = None
+        if args.save_session and self.username:
+            self.session_file = session_filename(args.cache_dir, site,
+                                                 self.username)
+        self.course_list = get_course_list(args, site, self.username)
+        self._headers = None
+        self._dashboard = None
+        self._courses = None
+        self._failed = False
+        self._lock = threading.Lock()
+
+    def login(self):
+        """
+        Return the headers for the requests to the platform, or None if we
+        could not log in.
+        """
+        with self._lock:
+            if self._headers is None and not self._failed:
+                with _metrics.phase('login'):
+                    if not self._resume():
+                        self._login()
+            return self._headers
+
+    def refresh(self):
+        """
+        Check that the session is still logged in, logging in again if the
+        platform expired it. The dashboard read to check it is revalidated
+        through the page cache, and the courses are parsed again by the next
+        courses() only if it changed. Returns the headers, or None if we
+        could not log in.
+        """
+        with self._lock:
+            self._failed = False
+            dashboard = None
+            if self._headers is not None:
+                dashboard = edx_logged_in_dashboard(
+                    self.site.dashboard, self._headers, self.session,
+                    use_cache=True)
+                if dashboard is None:
+                    print('[info] %s: the session expired, logging in' %
+                          self.site.name)
+                    self.session.clear_cookies()
+                    self._headers = None
+            if dashboard is None or dashboard != self._dashboard:
+                self._courses = None
+            self._dashboard = dashboard
+        return self.login()
+
+    def _resume(self):
+        if (self.session_file is None or
+                not self.session.load_cookies(self.session_file)):
+            return False
+        token = self.session.cookie('csrftoken')
+        if token:
+            headers = edx_make_headers(self.site.login_api, token)
+            dashboard = edx_logged_in_dashboard(self.site.dashboard, headers,
+                                                self.session)
+            if dashboard is not None:
+                self._headers = headers
+                self._dashboard = dashboard
+                return True
+        print('[info] %s: the saved session expired, logging in' %
+              self.site.name)
+        self.session.clear_cookies()
+        return False
+
+    def _login(self):
+        if not self.username or not self.password:
+            print('[error] %s: no username and password' % self.site.name)
+            self._failed = True
+            return
+        headers = edx_get_headers(self.session, self.site)
+        resp = edx_login(self.site.login_api, headers, self.username,
+                         self.password, self.session)
+        if not resp.get('success', False):
+            print('[error] %s: %s' % (
+                self.site.name, resp.get('value', 'Wrong Email or Password.')))
+            self._failed = True
+            return
+        self._headers = headers
+        self._save()
+
+    def _save(self):
+        if self.session_file is not None:
+            ensure_private_dir(os.path.dirname(self.session_file))
+            self.session.save_cookies(self.session_file)
+
+    def courses(self):
+        """
+        Return the courses of the dashboard (login() must have worked).
+        """
+        with self._lock, _metrics.phase('dashboard'):
+            if self._courses is None:
+                if self._dashboard is not None:
+                    self._courses = parse_courses(self._dashboard,
+                                                  self.site.url)
+                else:
+                    self._courses = get_courses_info(self.site.dashboard,
+                                                     self._headers,
+                                                     self.session)
+                if self.course_list is not None:
+                    save_course_list(self.course_list, self._courses)
+            return self._courses
+
+    def course_name(self, course_id):
+        """
+        Return the name of the course course_id on the dashboard, or None if
+        the user is not enrolled.
+        """
+        for course in self.courses():
+            match = RE_COURSE_ID.search(course.url or '')
+            if match and match.group(1) == course_id:
+                return course.name
+        return None
+
+    def close(self):
+        # the platform may have renewed the cookies during the run
+        if self._headers is not None:
+            self._save()
+        self.session.close()
+
+
+def parse_course_id(course_id, platform):
+    """
+    Return the (site name, course id) of a course url, a course id or a
+    site:course id. Course ids without a known site are taken from
+    platform. Returns None if the url is not of a known platform.
+    """
+    if course_id.startswith(('http://', 'https://')):
+        host = urlparse(course_id).netloc
+        match = RE_COURSE_ID.search(course_id)
+        for site_name, site in OPENEDX_SITES.items():
+            if urlparse(site['url']).netloc == host and match:
+                return site_name, match.group(1)
+        return None
+    site_name, sep, rest = course_id.partition(':')
+    if sep and site_name in OPENEDX_SITES:
+        return site_name, rest
+    return platform, course_id.strip('/')
+
+
+def download_course_units(units, target_dir, args, headers, session, state,
+                          ask_format=False, sections=None):
+    """
+    Downloads the units of a course, probing their formats first if a plan,
+    a size budget or the size priority was asked (or if the format is asked
+    to the user). sections has the section number of each unit. Returns the
+    list of DownloadResult, or None with --plan-only.
+    """
+    formats = None
+    sizes = None
+    if (ask_format or args.plan or args.plan_only or args.max_size or
+            args.max_total or 'size' in args.priority):
+        infos = probe_units(units, args)
+        if ask_format:
+            # Get Available Video formats
+            display_formats(infos)
+            print('Choose a valid format or a set of valid format codes e.g. 22/17/...')
+            args.format = input('Choose Format code: ')
+        chosen, formats = plan_formats(units, infos, args)
+        sizes = dict((video_id, f.size) for video_id, f in chosen.items()
+                     if f is not None)
+        for line in plan_lines(chosen, len(chosen), args.expected_speed):
+            print('[info] ' + line)
+        if args.plan_only:
+            return None
+    return download_units(units, target_dir, args, headers, session, state,
+                          formats, sections, sizes)
+
+
+def open_course(context, course_id, args, directories=None):
+    """
+    Logs in to the platform of context and gets the sections of course_id.
+    directories has the course directories taken by the other courses: a
+    course of another platform with the same name gets the name of its
+    platform appended. Returns (course name, courseware url, headers,
+    sections, target directory) or None if the course could not be read.
+    """
+    courseware_url = '%s/courses/%s/courseware' % (context.site.url, course_id)
+    try:
+        headers = context.login()
+        if headers is None:
+            return None
+        name = context.course_name(course_id) or course_id
+        sections = get_available_sections(courseware_url, headers,
+                                          context.session)
+    except URLError as e:
+        print('[error] %s: %s' % (course_id, e))
+        return None
+    directory = directory_name(name)
+    if directories is not None:
+        with _directories_lock:
+            course = (context.site.name, course_id)
+            if directories.setdefault(directory, course) != course:
+                directory = directory_name('%s %s' % (name, context.site.name))
+    target_dir = os.path.join(args.output_dir, directory)
+    return name, courseware_url, headers, sections, target_dir
+
+
+def download_course(context, course_id, args, state, directories=None):
+    """
+    Crawls and downloads all the sections of course_id of the platform of
+    context (see open_course for directories). Returns (course name, list
+    of DownloadResult, course structure) or None if the course could not be
+    crawled.
+    """
+    course = open_course(context, course_id, args, directories)
+    if course is None:
+        return None
+    name, courseware_url, headers, sections, target_dir = course
+    print('[info] %s: %d sections, downloading to %s' %
+          (name, len(sections), target_dir))
+    index = get_index(args, context.site, courseware_url)
+    subsections, results = crawl_and_download(sections, target_dir, args,
+                                              headers, context.session, state,
+                                              index)
+    structure = course_structure(name, courseware_url, context.site.name,
+                                 sections, subsections)
+    return name, results or [], structure
+
+
+def enqueue_course(context, course_id, args, queue, directories=None):
+    """
+    Crawls all the sections of course_id of the platform of context and
+    adds its units to the WorkQueue queue, for the workers to download
+    them. Returns (course name, [], course structure) like download_course,
+    or None if the course could not be crawled.
+    """
+    course = open_course(context, course_id, args, directories)
+    if course is None:
+        return None
+    name, courseware_url, headers, sections, target_dir = course
+    index = get_index(args, context.site, courseware_url)
+    known = {}
+    if index is not None:
+        known = index.known(sections)
+    subsections = crawl_subsections([section.url for section in sections],
+                                    headers, context.session,
+                                    args.crawl_workers, known)
+    update_index(index, sections, subsections, known)
+    jobs = list(iter_download_jobs(subsections))
+    queued = queue.add(context.site.name, course_id,
+                       os.path.basename(target_dir), jobs)
+    print('[info] %s: %d units, %d queued in %s' %
+          (name, len(jobs), queued, queue.path))
+    structure = course_structure(name, courseware_url, context.site.name,
+                                 sections, subsections)
+    return name, [], structure
+
+
+def open_store(args):
+    """
+    Return where the units of the courses are recorded: the WorkQueue of
+    --queue, or else the DownloadState of the output directory.
+    """
+    if args.queue:
+        from .workqueue import WorkQueue
+        return WorkQueue(args.queue)
+    from .state import DownloadState
+    return DownloadState(args.output_dir)
+
+
+def get_courses(course_ids, args, contexts):
+    """
+    Return the (SiteContext, course id) of each of the course_ids (urls or
+    ids, see parse_course_id), or None if one is not of a known platform.
+    contexts has the SiteContext of each platform, the missing ones are
+    added to it.
+    """
+    courses = []
+    for course_id in course_ids:
+        parsed = parse_course_id(course_id, args.platform)
+        if parsed is None or parsed[0] not in OPENEDX_SITES:
+            print('[error] %s: not a course of %s' %
+                  (course_id, ', '.join(sorted(OPENEDX_SITES))))
+            return None
+        site_name, course_id = parsed
+        if site_name not in contexts:
+            contexts[site_name] = SiteContext(get_site(site_name), args)
+        courses.append((contexts[site_name], course_id))
+    return courses
+
+
+def process_courses(courses, args, store, directories):
+    """
+    Downloads the (SiteContext, course id) courses, --course-jobs of them at
+    the same time, or adds their units to the work queue with --queue.
+    store is the DownloadState, or the WorkQueue, directories the course
+    directories taken (see open_course). Returns the outcome of
+    download_course (or enqueue_course) for each course.
+    """
+    process = enqueue_course if args.queue else download_course
+    from multiprocessing.dummy import Pool as ThreadPool
+    pool = ThreadPool(max(1, min(args.course_jobs, len(courses))))
+    try:
+        return pool.map(
+            lambda course: process(course[0], course[1], args, store,
+                                   directories),
+            courses)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def download_courses(course_ids, args):
+    """
+    Downloads the courses (urls or ids, possibly of several platforms),
+    --course-jobs of them at the same time. Each platform has its own
+    session and connection limit. With --queue their units are added to
+    the work queue instead. Returns True if everything went well.
+    """
+    contexts = {}
+    courses = get_courses(course_ids, args, contexts)
+    if courses is None:
+        return False
+
+    store = open_store(args)
+    try:
+        outcomes = process_courses(courses, args, store, {})
+    finally:
+        store.close()
+        for context in contexts.values():
+            context.close()
+
+    if args.export_index:
+        export_index([outcome[2] for outcome in outcomes
+                      if outcome is not None], args.export_index)
+        print('[info] Course structure written to ' + args.export_index)
+
+    ok = True
+    for (context, course_id), outcome in zip(courses, outcomes):
+        if outcome is None:
+            print('[error] %s: %s could not be downloaded' %
+                  (context.site.name, course_id))
+            ok = False
+            continue
+        name, results, _ = outcome
+        if args.queue:
+            continue
+        print('[info] %s (%s):' % (name, context.site.name))
+        display_download_summary(results)
+        if any(result.returncode != 0 for result in results):
+            ok = False
+    return ok
+
+
+def run_worker(args):
+    """
+    Downloads the units of the --queue work queue (edx-dl worker) with
+    --jobs threads, until every unit of the queue is done or failed: the
+    units leased by other workers may come back if those crash. The leases
+    of the units being downloaded are renewed every third of --lease.
+    Returns True if all the units downloaded by this worker went well.
+    """
+    from .state import DownloadState
+    from .workqueue import WorkQueue
+    queue = WorkQueue(args.queue)
+    worker = '%s:%d' % (socket.gethostname(), os.getpid())
+    num_jobs = max(1, args.jobs)
+    # the library backend starts its processes before any other thread
+    backend = get_backend(args, num_jobs)
+    state = DownloadState(args.output_dir)
+    contexts = {}
+    outcomes = []
+    logged_out = []
+    lock = threading.Lock()
+    stop = threading.Event()
+    print('[info] Worker %s downloading the units of %s' %
+          (worker, args.queue))
+
+    def get_context(site_name):
+        with lock:
+            if site_name not in contexts:
+                contexts[site_name] = SiteContext(get_site(site_name), args)
+            return contexts[site_name]
+
+    def heartbeat():
+        while not stop.wait(args.lease / 3.0):
+            queue.renew(worker, args.lease)
+
+    def download():
+        while not stop.is_set():
+            unit = queue.claim(worker, args.lease)
+            if unit is None:
+                if not queue.unfinished():
+                    return
+                stop.wait(min(args.lease, 5))
+                continue
+            context = get_context(unit.site)
+            headers = context.login()
+            if headers is None:
+                # the other units of the platform would fail as well
+                queue.release(unit, worker)
+                logged_out.append(unit.site)
+                stop.set()
+                return
+            job = (unit.prefix, Unit(video_youtube_url=unit.video_url,
+                                     sub_url=unit.sub_url))
+            try:
+                result = download_batch([job],
+                                        os.path.join(args.output_dir,
+                                                     unit.directory),
+                                        args, headers, context.session,
+                                        state, echo=False, backend=backend)[0]
+                ok = result.returncode == 0 and result.subtitles_ok
+            except Exception as e:
+                print('[error] %s %s: %s' % (unit.directory, unit.prefix, e))
+                ok = False
+            if not queue.finish(unit, worker, ok):
+                print('[warning] %s %s: the lease expired while downloading' %
+                      (unit.directory, unit.prefix))
+            with lock:
+                outcomes.append(ok)
+                message = '[info] [%d] %s %s %s (%s)' % (
+                    len(outcomes), unit.directory, unit.prefix,
+                    'done' if ok else 'FAILED', unit.video_url)
+            if _runner is not None:
+                _runner.message(message)
+            else:
+                print(message)
+
+    beat = threading.Thread(target=heartbeat)
+    beat.daemon = True
+    beat.start()
+    threads = [threading.Thread(target=download) for _ in range(num_jobs)]
+    try:
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        stop.set()
+        beat.join()
+        backend.close()
+        state.close()
+        for context in contexts.values():
+            context.close()
+    counts = queue.counts()
+    queue.close()
+    print('[info] Worker %s downloaded %d units (%d failed)' %
+          (worker, len(outcomes), outcomes.count(False)))
+    print('[info] Queue: %(done)d done, %(failed)d failed, %(pending)d '
+          'pending, %(leased)d leased' % counts)
+    return all(outcomes) and not logged_out
+
+
+def sync_courses(courses, contexts, args, store, directories):
+    """
+    One sync of watch_courses: checks the session of each platform of
+    contexts, then downloads (or queues) the new videos of the courses, all
+    the started courses of --platform if courses is None. Returns the number
+    of videos downloaded, failed and still to download: the failed ones,
+    tried again by the next sync, or the unfinished units of the queue.
+    """
+    for context in contexts.values():
+        context.refresh()
+    if courses is None:
+        context = contexts[args.platform]
+        courses = []
+        if context.login() is not None:
+            for course in context.courses():
+                match = RE_COURSE_ID.search(course.url or '')
+                if course.state == 'Started' and match:
+                    courses.append((context, match.group(1)))
+    outcomes = process_courses(courses, args, store, directories)
+
+    downloaded = failed = 0
+    for (context, course_id), outcome in zip(courses, outcomes):
+        if outcome is None:
+            print('[error] %s: %s could not be synced' %
+                  (context.site.name, course_id))
+            continue
+        name, results, _ = outcome
+        new = [result for result in results if not result.skipped]
+        if new:
+            print('[info] %s (%s):' % (name, context.site.name))
+            display_download_summary(new)
+        downloaded += len([result for result in new if result.returncode == 0])
+        failed += len([result for result in new if result.returncode != 0])
+    depth = store.unfinished() if args.queue else failed
+    print('[info] Synced %d courses: %d new videos downloaded, %d failed' %
+          (len(courses), downloaded, failed))
+    return downloaded, failed, depth
+
+
+def watch_courses(args):
+    """
+    Downloads the new videos of the courses given (or of all the started
+    courses of --platform) every --watch seconds, give or take some jitter,
+    until interrupted. The platforms are logged in once and their sessions
+    checked on every sync; the pages are revalidated with conditional
+    requests and only the sections that changed are crawled again. With
+    --queue the new units are added to the work queue instead. The status
+    of the run is written to --status. Returns False if a course is not of
+    a known platform.
+    """
+    contexts = {}
+    courses = None
+    if args.course_id:
+        courses = get_courses(args.course_id, args, contexts)
+        if courses is None:
+            return False
+    else:
+        contexts[args.platform] = SiteContext(get_site(args.platform), args)
+    store = open_store(args)
+    status = WatchStatus(args.status, args.watch)
+    directories = {}
+    try:
+        while True:
+            status.syncing()
+            try:
+                downloaded, failed, depth = sync_courses(
+                    courses, contexts, args, store, directories)
+                status.synced(downloaded, failed, depth)
+            except Exception as e:
+                # e.g. the network or the platform is down, or a page could
+                # not be parsed: try again on the next sync
+                error = '%s: %s' % (type(e).__name__, e)
+                print('[error] sync failed: ' + error)
+                status.synced(0, 0, status.data['queue_depth'], error)
+            next_sync = time.time() + jittered(args.watch)
+            status.update(next_sync=next_sync)
+            print('[info] Next sync at ' +
+                  time.strftime('%Y-%m-%d %H:%M:%S',
+                                time.localtime(next_sync)))
+            time.sleep(max(0, next_sync - time.time()))
+    finally:
+        status.update(state='stopped', next_sync=None)
+        store.close()
+        for context in contexts.values():
+            context.close()
+
+
+def verify_output(args):
+    """
+    Verifies the videos of the output directory (--verify), with the sizes
+    probed before they were downloaded if they are still in the format
+    cache. The missing, corrupt and unfinished ones are queued to be
+    downloaded again. Returns True if all of them are fine.
+    """
+    from .state import DownloadState
+    from .verify import requeue, verify_tree
+    print('[info] Verifying the videos in ' + args.output_dir)
+    state = DownloadState(args.output_dir)
+    try:
+        with _metrics.phase('verify'):
+            report = verify_tree(state, args.verify_processes, args.refresh,
+                                 get_format_cache(args))
+        for problem in report.problems:
+            print('[error] %s: %s' % (problem.path, problem.reason))
+        requeue(state, report.problems)
+    finally:
+        state.close()
+    print('[info] Verified %d videos (%d hashed), %d problems' %
+          (report.checked, report.hashed, len(report.problems)))
+    if report.problems:
+        print('[info] They will be downloaded again by the next run')
+    return not report.problems
+
+
+def write_metrics(args):
+    """
+    Writes the timings and metrics of the run to the --report and
+    --prometheus files.
+    """
+    if args.report:
+        write_report(_metrics, args.report)
+        print('[info] Report written to ' + args.report)
+    if args.prometheus:
+        write_prometheus(_metrics, args.prometheus)
 
 
 def main():
     args = parse_args()
+    start_parse_pool(args)
+    try:
+        if args.profile:
+            try:
+                profile(partial(run, args), args.profile)
+            finally:
+                # run() leaves with sys.exit, the profile is written anyway
+                print('[info] Profile written to %s (summary in %s.txt)' %
+                      (args.profile, args.profile))
+        else:
+            run(args)
+    finally:
+        stop_parse_pool()
+        write_metrics(args)
+
+
+def run(args):
+    if args.verify:
+        sys.exit(0 if verify_output(args) else 1)
+
+    if args.worker:
+        sys.exit(0 if run_worker(args) else 1)
 
     # if no args means we are calling the interactive version
     is_interactive = len(sys.argv) == 1
@@ -502,90 +2304,96 @@ def main():
 
     change_openedx_site(args.platform)
 
-    if not args.username or not args.password:
-        print("You must supply username AND password to log-in")
-        sys.exit(2)
-
-    # Prepare Headers
-    headers = _edx_get_headers()
+    if args.list:
+        sys.exit(0 if list_courses(args) else 2)
+
+    if args.watch:
+        # Daemon mode, until interrupted
+        if not args.queue:
+            print("[info] Output directory: " + args.output_dir)
+        if not watch_courses(args):
+            sys.exit(2)
+        return
+
+    if args.course_id:
+        # Batch mode, the courses may be of several platforms
+        if not args.queue:
+            print("[info] Output directory: " + args.output_dir)
+        if not download_courses(args.course_id, args):
+            sys.exit(1)
+        return
+
+    context = SiteContext(get_site(args.platform), args)
+    try:
+        if not context.username or not context.password:
+            print("You must supply username AND password to log-in")
+            sys.exit(2)
+        session = context.session
 
-    # Login
-    resp = edx_login(LOGIN_API, headers, args.username, args.password)
-    if not resp.get('success', False):
-        print(resp.get('value', "Wrong Email or Password."))
-        exit(2)
+        # Login, or reuse the session saved by a previous run
+        headers = context.login()
+        if headers is None:
+            sys.exit(2)
 
-    courses = get_courses_info(DASHBOARD, headers)
-    display_courses(courses)
-    selected_course = get_selected_course(courses)
+        courses = context.courses()
+        display_courses(courses)
+        selected_course = get_selected_course(courses)
 
-    # Get Available Sections
-    courseware_url = selected_course.url.replace('info', 'courseware')
-    sections = get_available_sections(courseware_url, headers)
+        # Get Available Sections
+        courseware_url = selected_course.url.replace('info', 'courseware')
+        sections = get_available_sections(courseware_url, headers, session)
 
-    # Choose Section or choose all
-    display_sections(selected_course.name, sections)
-    selected_sections = get_selected_sections(sections)
+        # Choose Section or choose all
+        display_sections(selected_course.name, sections)
+        selected_sections = get_selected_sections(sections)
 
-    if is_interactive:
-        args.subtitles = input('Download subtitles (y/n)? ').lower() == 'y'
-
-    sections_urls = [selected_section.url for selected_section in selected_sections]
-    video_urls, sub_urls = extract_all_subsections(sections_urls, headers)
-    if len(video_urls) < 1:
-        print('WARNING: No downloadable video found.')
-        sys.exit(0)
+        if is_interactive:
+            args.subtitles = input('Download subtitles (y/n)? ').lower() == 'y'
 
-    if is_interactive:
-        # Get Available Video formats
-        os.system('youtube-dl -F %s' % video_urls[-1])
-        print('Choose a valid format or a set of valid format codes e.g. 22/17/...')
-        args.format = input('Choose Format code: ')
-
-    print("[info] Output directory: " + args.output_dir)
-
-    # Download Videos
-    video_format_option = args.format + '/mp4' if args.format else 'mp4'
-    subtitles_option = '--write-sub' if args.subtitles else ''
-    for i, (v, s) in enumerate(zip(video_urls, sub_urls), 1):
         coursename = directory_name(selected_course.name)
         target_dir = os.path.join(args.output_dir, coursename)
-        filename_prefix = str(i).zfill(2)
-        filename = filename_prefix + "-%(title)s.%(ext)s"
-        fullname = os.path.join(target_dir, filename)
-        cmd = ['youtube-dl', '-o', fullname, '-f', video_format_option,
-               subtitles_option, v]
-        # we execute the youtube-dl command to download the videos
-        execute_command(cmd)
-
-        if args.subtitles:
-            filename = get_filename(target_dir, filename_prefix)
-            if filename is None:
-                print('[warning] no video downloaded for %s' % filename_prefix)
-                continue
-            subs_filename = os.path.join(target_dir, filename + '.srt')
-            if not os.path.exists(subs_filename):
-                subs_string = edx_get_subtitle(s, headers)
-                if subs_string:
-                    print('[info] Writing edX subtitles: %s' % subs_filename)
-                    open(os.path.join(os.getcwd(), subs_filename),
-                         'wb+').write(subs_string.encode('utf-8'))
+        print("[info] Output directory: " + args.output_dir)
+
+        # Crawl the sections that changed and download their videos
+        index = get_index(args, context.site, courseware_url)
+        from .state import DownloadState
+        state = DownloadState(args.output_dir)
+        try:
+            subsections, results = crawl_and_download(
+                selected_sections, target_dir, args, headers, session, state,
+                index, ask_format=is_interactive,
+                all_sections=(sections if selected_sections != sections
+                              else None))
+        finally:
+            state.close()
+        if args.export_index:
+            export_index([course_structure(selected_course.name,
+                                           courseware_url, context.site.name,
+                                           selected_sections, subsections)],
+                         args.export_index)
+            print('[info] Course structure written to ' + args.export_index)
+        if results is None:
+            sys.exit(0)
+        if not results:
+            print('WARNING: No downloadable video found.')
+            sys.exit(0)
+    finally:
+        # saves the renewed cookies and closes the connections
+        context.close()
+
+    display_download_summary(results)
+    if any(result.returncode != 0 for result in results):
+        sys.exit(1)
 
 
 def get_filename(target_dir, filename_prefix):
     """
-    Return the basename for the corresponding filename_prefix.
-    """
-    # This whole function is not the nicest thing, but isolating it makes
-    # things clearer. A good refactoring would be to get the info from the
-    # video_url or the current output, to avoid the iteration from the
-    # current dir.
-    filenames = os.listdir(target_dir)
-    for name in filenames:  # Find the filename of the downloaded video
-        if name.startswith(filename_prefix):
-            (basename, ext) = os.path.splitext(name)
-            return basename
-    return None
+    Return the filename of the video downloaded with filename_prefix.
+    """
+    # This is only a fallback for when we can not get the filename from the
+    # output of youtube-dl, since it has to list the whole directory.
+    # The dash avoids taking e.g. 100-foo.mp4 as the video of 10.
+    return find_video(target_dir, filename_prefix + '-')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+
+"""
+Probing of the formats of the videos before they are downloaded.
+
+The formats (and their sizes) of all the videos are resolved concurrently
+with youtube-dl and kept in an on-disk cache keyed by YouTube id. With
+them a download plan can be shown, and formats can be chosen to fit in a
+size budget, before anything is downloaded.
+"""
+
+from __future__ import unicode_literals
+
+import hashlib
+import heapq
+import json
+import os
+import re
+import time
+
+from collections import namedtuple
+
+from .cache import atomic_write, ensure_private_dir
+from .common import YOUTUBE_VIDEO_ID_LENGTH, youtube_id
+
+DEFAULT_TTL = 7 * 24 * 3600
+DEFAULT_WORKERS = 4
+DEFAULT_BATCH_SIZE = 10
+DEFAULT_SPEED = 5.0  # MB/s, for the time estimates of the plan
+
+MB = 1024 * 1024
+
+RE_VIDEO_ID = re.compile(r'[A-Za-z0-9_-]{%d}\Z' % YOUTUBE_VIDEO_ID_LENGTH)
+
+VideoInfo = namedtuple('VideoInfo', ['video_id', 'title', 'duration',
+                                     'formats'])
+
+# size is in bytes, estimated from the bitrate if youtube-dl does not know
+# it, None if it can not be estimated
+Format = namedtuple('Format', ['format_id', 'ext', 'height', 'has_video',
+                               'has_audio', 'size'])
+
+# the extensions youtube-dl takes as format specifications
+EXTENSIONS = ('mp4', 'webm', 'flv', '3gp', 'm4a', 'mp3', 'ogg', 'aac', 'wav')
+
+
+def parse_info(data):
+    """
+    Return the VideoInfo of the youtube-dl json description of a video.
+    """
+    duration = data.get('duration')
+    formats = []
+    for f in data.get('formats') or [data]:
+        size = f.get('filesize') or f.get('filesize_approx')
+        if not size and f.get('tbr') and duration:
+            size = int(f['tbr'] * 125 * duration)  # kbit/s to bytes
+        formats.append(Format(format_id=f.get('format_id'), ext=f.get('ext'),
+                              height=f.get('height'),
+                              has_video=f.get('vcodec') != 'none',
+                              has_audio=f.get('acodec') != 'none',
+                              size=int(size) if size else None))
+    return VideoInfo(video_id=data['id'], title=data.get('title'),
+                     duration=duration, formats=formats)
+
+
+class FormatCache(object):
+    """
+    Stores the VideoInfo of the videos, one json file per YouTube id.
+    Entries older than ttl seconds, or all of them with refresh set, are
+    probed again.
+    """
+
+    def __init__(self, directory, ttl=DEFAULT_TTL, refresh=False):
+        self.directory = directory
+        self.ttl = ttl
+        self.refresh = refresh
+        ensure_private_dir(directory)
+
+    def _path(self, video_id):
+        # the ids come from the pages, those that are not YouTube ids are
+        # hashed so that they can not name a file outside of the cache
+        if not RE_VIDEO_ID.match(video_id):
+            video_id = hashlib.sha1(video_id.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, video_id + '.json')
+
+    def get(self, video_id):
+        """
+        Return the VideoInfo of video_id or None if it is not cached.
+        """
+        if self.refresh:
+            return None
+        try:
+            with open(self._path(video_id), 'rb') as f:
+                data = json.loads(f.read().decode('utf-8'))
+        except (IOError, OSError, ValueError):
+            return None
+        if time.time() - data.get('stored', 0) >= self.ttl:
+            return None
+        return VideoInfo(video_id=data['video_id'], title=data['title'],
+                         duration=data['duration'],
+                         formats=[Format(*f) for f in data['formats']])
+
+    def put(self, info):
+        data = dict(info._asdict(), stored=time.time())
+        atomic_write(self._path(info.video_id),
+                     json.dumps(data).encode('utf-8'))
+
+
+def _probe_batch(urls, execute):
+    cmd = ['youtube-dl', '--ignore-errors', '-j'] + list(urls)
+    _, output = execute(cmd, False, 'probe')
+    infos = []
+    for line in output.decode('utf-8', 'replace').splitlines():
+        if not line.startswith('{'):
+            continue
+        try:
+            infos.append(parse_info(json.loads(line)))
+        except (ValueError, KeyError):
+            continue
+    return infos
+
+
+def probe_videos(video_urls, execute, cache=None, workers=DEFAULT_WORKERS,
+                 batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Return a dict with the VideoInfo of the videos by YouTube id. The ones
+    not in the cache are probed with up to workers youtube-dl processes at
+    the same time, batch_size videos each. The videos that could not be
+    probed are missing.
+
+    execute(cmd, echo, name) must run cmd and return its exit status and
+    output.
+    """
+    infos = {}
+    missing = []
+    for url in video_urls:
+        video_id = youtube_id(url)
+        if video_id in infos or url in missing:
+            continue
+        info = cache.get(video_id) if cache is not None else None
+        if info is not None:
+            infos[video_id] = info
+        else:
+            missing.append(url)
+    batches = [missing[i:i + batch_size]
+               for i in range(0, len(missing), batch_size)]
+    if batches:
+        from multiprocessing.dummy import Pool as ThreadPool
+        pool = ThreadPool(min(workers, len(batches)))
+        try:
+            probed = pool.map(lambda batch: _probe_batch(batch, execute),
+                              batches)
+        finally:
+            pool.close()
+            pool.join()
+        for batch_infos in probed:
+            for info in batch_infos:
+                infos[info.video_id] = info
+                if cache is not None:
+                    cache.put(info)
+    return infos
+
+
+def _quality(f):
+    return (f.height or 0, f.size or 0)
+
+
+def complete_formats(info):
+    """
+    Return the formats of info with both video and audio, worst first.
+    """
+    return sorted((f for f in info.formats if f.has_video and f.has_audio),
+                  key=_quality)
+
+
+def choose_format(info, spec):
+    """
+    Return the Format youtube-dl would download for the format
+    specification spec, or None if we can not tell. Only the alternatives
+    made of format ids, extensions, best and worst are understood.
+    """
+    complete = complete_formats(info)
+    by_id = dict((f.format_id, f) for f in info.formats)
+    for alternative in spec.split('/'):
+        alternative = alternative.strip()
+        if alternative in ('best', 'b'):
+            return complete[-1] if complete else None
+        if alternative in ('worst', 'w'):
+            return complete[0] if complete else None
+        if alternative in EXTENSIONS:
+            matching = [f for f in complete if f.ext == alternative]
+            if matching:
+                return matching[-1]
+        elif alternative in by_id:
+            return by_id[alternative]
+        elif not alternative.isalnum():
+            return None  # e.g. bestvideo+bestaudio or filters
+    return None
+
+
+def fit_budget(infos, max_size=None, max_total=None):
+    """
+    Choose a format with video and audio for each VideoInfo: the best one
+    not larger than max_size bytes, then, while the total is larger than
+    max_total bytes, a smaller format for the largest video. Returns a dict
+    with the chosen Format by YouTube id (the videos with no format of
+    known size are missing) and whether the budget could be met.
+    """
+    candidates = {}
+    chosen = {}
+    met = True
+    for info in infos:
+        formats = [f for f in complete_formats(info) if f.size]
+        if not formats:
+            continue
+        index = len(formats) - 1
+        if max_size is not None:
+            while index > 0 and formats[index].size > max_size:
+                index -= 1
+            if formats[index].size > max_size:
+                met = False
+        candidates[info.video_id] = formats
+        chosen[info.video_id] = index
+
+    if max_total is not None:
+        total = sum(candidates[video_id][index].size
+                    for video_id, index in chosen.items())
+        heap = [(-candidates[video_id][index].size, video_id)
+                for video_id, index in chosen.items() if index > 0]
+        heapq.heapify(heap)
+        while total > max_total and heap:
+            _, video_id = heapq.heappop(heap)
+            formats = candidates[video_id]
+            index = chosen[video_id]
+            total -= formats[index].size - formats[index - 1].size
+            chosen[video_id] = index - 1
+            if index - 1 > 0:
+                heapq.heappush(heap, (-formats[index - 1].size, video_id))
+        if total > max_total:
+            met = False
+
+    return dict((video_id, candidates[video_id][index])
+                for video_id, index in chosen.items()), met
+
+
+def describe(f):
+    """
+    Return a short description of the Format f, e.g. '22 (mp4, 720p)'.
+    """
+    details = [f.ext or '?']
+    if not f.has_video:
+        details.append('audio only')
+    elif f.height:
+        details.append('%dp' % f.height)
+    if not f.has_audio:
+        details.append('video only')
+    return '%s (%s)' % (f.format_id, ', '.join(details))
+
+
+def format_size(size):
+    return '%.1f MB' % (size / float(MB))
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '%d:%02d:%02d' % (hours, minutes, seconds)
+
+
+def plan_lines(chosen, num_videos, speed=DEFAULT_SPEED):
+    """
+    Return the lines of the download plan: the number of videos, bytes and
+    estimated time (at speed MB/s) of each chosen format. chosen is a
+    dict with the Format of the videos by YouTube id (None if unknown).
+    """
+    groups = {}
+    unknown = num_videos - len(chosen)
+    for f in chosen.values():
+        if f is None or f.size is None:
+            unknown += 1
+            continue
+        count, size = groups.get(describe(f), (0, 0))
+        groups[describe(f)] = count + 1, size + f.size
+    total = sum(size for _, size in groups.values())
+    rate = speed * MB
+    lines = ['Download plan for %d videos (at %.1f MB/s):' %
+             (num_videos, speed)]
+    for name, (count, size) in sorted(groups.items(),
+                                      key=lambda item: -item[1][1]):
+        lines.append('  format %s: %d videos, %s, ~%s' % (
+            name, count, format_size(size), format_duration(size / rate)))
+    if unknown:
+        lines.append('  %d videos of unknown size' % unknown)
+    lines.append('  total: %s, ~%s' % (format_size(total),
+                                       format_duration(total / rate)))
+    return lines
+
+
+def common_formats(infos):
+    """
+    Return (Format, total size) for the formats that all the VideoInfo
+    have, best first. The total is None if some size is unknown.
+    """
+    infos = list(infos)
+    if not infos:
+        return []
+    ids = set(f.format_id for f in infos[0].formats)
+    for info in infos[1:]:
+        ids &= set(f.format_id for f in info.formats)
+    formats = []
+    for f in infos[0].formats:
+        if f.format_id not in ids:
+            continue
+        sizes = [g.size for info in infos for g in info.formats
+                 if g.format_id == f.format_id]
+        total = sum(sizes) if all(sizes) else None
+        formats.append((f, total))
+    formats.sort(key=lambda item: _quality(item[0]), reverse=True)
+    return formats
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+"""
+On-disk index of the structure of the courses (sections, subsections and
+units), so that a course is not crawled again from scratch on each run, and
+of the courses of the dashboard, so that --list answers without logging in.
+"""
+
+from __future__ import unicode_literals
+
+import hashlib
+import json
+import os
+import time
+
+from .cache import atomic_write, ensure_private_dir
+from .common import Course, Section, SubSection, Unit
+
+INDEX_VERSION = 1
+
+
+def index_filename(directory, site_name, courseware_url):
+    """
+    Return the file of the index of the course at courseware_url.
+    """
+    key = '%s\n%s' % (site_name, courseware_url)
+    return os.path.join(directory,
+                        hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json')
+
+
+def course_list_filename(directory, site_name, username):
+    """
+    Return the file of the course list of username on the platform
+    site_name.
+    """
+    key = '%s\n%s' % (site_name, username)
+    return os.path.join(directory,
+                        hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json')
+
+
+def load_course_list(path):
+    """
+    Return the (time it was saved, courses) of the course list at path, or
+    None if there is none.
+    """
+    try:
+        with open(path, 'rb') as f:
+            data = json.loads(f.read().decode('utf-8'))
+    except (IOError, OSError, ValueError):
+        return None
+    if data.get('version') != INDEX_VERSION:
+        return None
+    return data['updated'], [Course(*course) for course in data['courses']]
+
+
+def save_course_list(path, courses):
+    ensure_private_dir(os.path.dirname(path))
+    data = {'version': INDEX_VERSION, 'updated': time.time(),
+            'courses': courses}
+    atomic_write(path, json.dumps(data, indent=1).encode('utf-8'))
+
+
+class CourseIndex(object):
+    """
+    The sections of a course and the units of their subsections, as they
+    were when the course was last crawled.
+
+    The subsection pages of the indexed sections are still requested, but
+    with conditional requests of the page cache: the indexed units are used
+    when the platform answers that the page did not change, so only the new
+    and changed pages are parsed. With refresh set, the index is not used
+    (but it is saved again).
+    """
+
+    def __init__(self, path, refresh=False):
+        self.path = path
+        self.sections = []
+        self.subsections = {}
+        self.updated = None
+        if not refresh:
+            self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                data = json.loads(f.read().decode('utf-8'))
+        except (IOError, OSError, ValueError):
+            return
+        if data.get('version') != INDEX_VERSION:
+            return
+        self.updated = data['updated']
+        self.sections = [Section(*section) for section in data['sections']]
+        self.subsections = dict(
+            (url, SubSection(url=url, units=[Unit(*unit) for unit in units]))
+            for url, units in data['subsections'])
+
+    def save(self):
+        ensure_private_dir(os.path.dirname(self.path))
+        data = {
+            'version': INDEX_VERSION,
+            'updated': self.updated,
+            'sections': self.sections,
+            'subsections': [(url, self.subsections[url].units)
+                            for url in sorted(self.subsections)],
+        }
+        atomic_write(self.path,
+                     json.dumps(data, separators=(',', ':')).encode('utf-8'))
+
+    def known(self, sections):
+        """
+        Return a dict with the indexed SubSection of the sections, by url,
+        to be used if their pages did not change.
+        """
+        known = {}
+        for section in sections:
+            subsection = self.subsections.get(section.url)
+            if subsection is not None:
+                known[section.url] = subsection
+        return known
+
+    def update(self, sections, subsections, complete=True):
+        """
+        Record the sections and their subsections. If they are not all the
+        sections of the course (complete is False), the other indexed
+        sections are kept.
+        """
+        subsections = dict((subsection.url, subsection)
+                           for subsection in subsections)
+        if complete:
+            self.sections = list(sections)
+            self.subsections = subsections
+        else:
+            urls = set(section.url for section in sections)
+            self.sections = ([section for section in self.sections
+                              if section.url not in urls] + list(sections))
+            self.sections.sort(key=lambda section: section.position)
+            self.subsections.update(subsections)
+        self.updated = time.time()
+
+
+def course_structure(name, url, site_name, sections, subsections):
+    """
+    Return the structure of a course as a json serializable dict, as it is
+    exported with --export-index.
+    """
+    subsections = dict((subsection.url, subsection)
+                       for subsection in subsections)
+    return {
+        'name': name,
+        'url': url,
+        'platform': site_name,
+        'sections': [{
+            'position': section.position,
+            'name': section.name,
+            'url': section.url,
+            'units': [{'video_url': unit.video_youtube_url,
+                       'sub_url': unit.sub_url}
+                      for unit in subsections[section.url].units]
+            if section.url in subsections else [],
+        } for section in sections],
+    }
+
+
+def export_index(courses, filename):
+    """
+    Write the structures of the courses (see course_structure) to filename
+    as json.
+    """
+    data = json.dumps({'version': INDEX_VERSION, 'courses': courses},
+                      indent=2, sort_keys=True)
+    with open(filename, 'wb') as f:
+        f.write(data.encode('utf-8'))
@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+
+"""
+Timings and counters of a run: how long each phase took (login, crawl,
+download, ...), latency histograms and bytes of the requests, parse time of
+the pages and throughput of the downloads. They can be written as a json
+report or as a Prometheus textfile, and a run can be profiled.
+"""
+
+from __future__ import unicode_literals
+
+import io
+import json
+import sys
+import threading
+import time
+
+from contextlib import contextmanager
+
+from .cache import atomic_write
+
+# upper bounds of the buckets of the histograms, by metric name
+BUCKETS = {
+    'request_seconds': (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                        30),
+    'parse_seconds': (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                      0.5, 1),
+    'download_mb_per_second': (0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 50, 100),
+}
+DEFAULT_BUCKETS = (0.01, 0.1, 1, 10, 100)
+
+HELP = {
+    'phase_seconds': 'Time spent in each phase of the run (summed over '
+                     'the threads)',
+    'requests': 'Requests sent to the platforms',
+    'cached_responses': 'Responses taken from the page cache',
+    'sent_bytes': 'Bytes of the request bodies',
+    'received_bytes': 'Bytes of the response bodies, as transferred',
+    'request_seconds': 'Latency of the requests',
+    'parse_seconds': 'Time spent parsing each page',
+    'download_bytes': 'Bytes of the downloaded videos',
+    'download_seconds': 'Time spent downloading the videos',
+    'download_mb_per_second': 'Throughput of the downloads',
+}
+
+PROMETHEUS_PREFIX = 'edx_dl_'
+
+
+class Histogram(object):
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def cumulative(self):
+        """
+        Return the (upper bound, count of values not above it) pairs, the
+        last bound is inf.
+        """
+        total = 0
+        pairs = []
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            pairs.append((bound, total))
+        return pairs
+
+
+class Metrics(object):
+    """
+    Thread safe collection of counters and histograms, each one identified
+    by a name and labels, e.g. ('request_seconds', {'host': ...}).
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.counters = {}
+        self.histograms = {}
+        self.downloads = []
+        self._spans = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(
+                    BUCKETS.get(name, DEFAULT_BUCKETS))
+            histogram.observe(value)
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Account the time of the block to the phase name. The phases can
+        run in several threads at the same time, their time is summed and
+        the wall time goes from the first start to the last end.
+        """
+        started = time.time()
+        try:
+            yield
+        finally:
+            ended = time.time()
+            self.add('phase_seconds', ended - started, phase=name)
+            with self._lock:
+                first, last = self._spans.get(name, (started, ended))
+                self._spans[name] = min(first, started), max(last, ended)
+
+    def download(self, videos, size, seconds):
+        """
+        Record that the videos (their filename prefixes) were downloaded in
+        a single call to the backend, size bytes in seconds.
+        """
+        self.add('download_bytes', size)
+        self.add('download_seconds', seconds)
+        entry = {'videos': list(videos), 'bytes': size,
+                 'seconds': round(seconds, 3)}
+        if size and seconds > 0:
+            speed = size / (1024.0 * 1024.0) / seconds
+            self.observe('download_mb_per_second', speed)
+            entry['mb_per_second'] = round(speed, 3)
+        with self._lock:
+            self.downloads.append(entry)
+
+    def report(self):
+        """
+        Return the metrics as a json serializable dict.
+        """
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items())
+            spans = dict(self._spans)
+            downloads = list(self.downloads)
+        phases = {}
+        for (name, labels), value in counters:
+            if name == 'phase_seconds':
+                phase = dict(labels)['phase']
+                first, last = spans[phase]
+                phases[phase] = {'seconds': round(value, 3),
+                                 'wall': round(last - first, 3)}
+        return {
+            'started': self.started,
+            'duration': round(time.time() - self.started, 3),
+            'phases': phases,
+            'counters': [{'name': name, 'labels': dict(labels),
+                          'value': value}
+                         for (name, labels), value in counters
+                         if name != 'phase_seconds'],
+            'histograms': [{
+                'name': name, 'labels': dict(labels),
+                'count': histogram.count, 'sum': histogram.sum,
+                'min': histogram.min, 'max': histogram.max,
+                'buckets': [[bound if bound != float('inf') else '+Inf',
+                             count]
+                            for bound, count in histogram.cumulative()],
+            } for (name, labels), histogram in histograms],
+            'downloads': downloads,
+        }
+
+
+def write_report(metrics, filename):
+    """
+    Write the report of metrics to filename as json.
+    """
+    data = json.dumps(metrics.report(), indent=2, sort_keys=True)
+    with open(filename, 'wb') as f:
+        f.write(data.encode('utf-8'))
+
+
+def _labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (key, ('%s' % value).replace('\\', '\\\\')
+                     .replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in pairs)
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else '%d' % value
+
+
+def prometheus_lines(metrics):
+    """
+    Return the lines of the metrics in the Prometheus text format.
+    """
+    with metrics._lock:
+        counters = sorted(metrics.counters.items())
+        histograms = sorted(metrics.histograms.items())
+    lines = []
+    seen = set()
+
+    def header(name, full_name, kind):
+        if full_name not in seen:
+            seen.add(full_name)
+            lines.append('# HELP %s %s' % (full_name, HELP.get(name, name)))
+            lines.append('# TYPE %s %s' % (full_name, kind))
+
+    for (name, labels), value in counters:
+        full_name = PROMETHEUS_PREFIX + name + '_total'
+        header(name, full_name, 'counter')
+        lines.append('%s%s %s' % (full_name, _labels(labels), _number(value)))
+    for (name, labels), histogram in histograms:
+        full_name = PROMETHEUS_PREFIX + name
+        header(name, full_name, 'histogram')
+        for bound, count in histogram.cumulative():
+            lines.append('%s_bucket%s %d' % (
+                full_name, _labels(labels, [('le', _number(bound))]), count))
+        lines.append('%s_sum%s %s' % (full_name, _labels(labels),
+                                      _number(histogram.sum)))
+        lines.append('%s_count%s %d' % (full_name, _labels(labels),
+                                        histogram.count))
+    return lines
+
+
+def write_prometheus(metrics, filename):
+    """
+    Write the metrics to filename in the Prometheus text format, atomically
+    as the textfile collector of node_exporter wants.
+    """
+    text = '\n'.join(prometheus_lines(metrics)) + '\n'
+    atomic_write(filename, text.encode('utf-8'))
+
+
+def profile(func, filename, top=30):
+    """
+    Call func under cProfile and, if available, tracemalloc. The cProfile
+    statistics are dumped to filename (for pstats or a viewer) and a
+    summary of the slowest functions and the largest allocations to
+    filename.txt. Returns what func returns.
+
+    Before python 3.12 cProfile only sees the thread that calls func, the
+    phases of the report tell where the other threads spend their time.
+    tracemalloc sees all of them.
+    """
+    try:
+        import tracemalloc
+    except ImportError:  # python 2
+        tracemalloc = None
+    import cProfile
+    import pstats
+    if tracemalloc is not None:
+        tracemalloc.start(10)
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func)
+    finally:
+        lines = []
+        if tracemalloc is not None:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            lines.append('Memory: %.1f MB allocated, %.1f MB at the peak' %
+                         (current / 1048576.0, peak / 1048576.0))
+            lines.append('Largest allocations:')
+            for stat in snapshot.statistics('lineno')[:top]:
+                lines.append('  %s' % stat)
+        profiler.dump_stats(filename)
+        out = io.StringIO() if sys.version_info[0] >= 3 else io.BytesIO()
+        pstats.Stats(profiler, stream=out).sort_stats(
+            'cumulative').print_stats(top)
+        lines.insert(0, out.getvalue())
+        with io.open(filename + '.txt', 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
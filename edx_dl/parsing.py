@@ -0,0 +1,512 @@
+# -*- coding: utf-8 -*-
+
+"""
+Extraction of the units (videos and subtitles) of a subsection page, and of
+the sections of the courseware and the courses of the dashboard.
+
+The pages can be parsed as they are received, a chunk at a time: the
+parsers keep only what is needed to find the tokens split between chunks,
+so their memory does not grow with the size of the page.
+
+With a ParsePool the pages are parsed in worker processes instead, while
+the threads that fetched them go on fetching the next ones.
+"""
+
+from __future__ import unicode_literals
+
+import codecs
+import re
+import time
+
+try:
+    from html import unescape
+    from html.parser import HTMLParser
+except ImportError:
+    from HTMLParser import HTMLParser
+    unescape = HTMLParser().unescape
+
+from .common import YOUTUBE_VIDEO_ID_LENGTH, Course, Section, Unit
+
+# A unit starts after 'data-streams="...1.0:' (the speed 1.0 stream), the
+# video id follows. The greedy '.*' of the original pattern
+# r'data-streams=(?:&#34;|").*1.0[0]*:' means that the speed marker used is
+# the last one in the same line, we look for it from the end of the line.
+RE_STREAMS = re.compile(r'data-streams=(?:&#34;|")')
+RE_SPEED = re.compile(r'1.0[0]*:')
+RE_SUBS = re.compile(r'data-transcript-translation-url=(?:&#34;|")([^"&]*)(?:&#34;|")')
+RE_EXTRA_YOUTUBE = re.compile(r'//w{0,3}\.youtube.com/embed/([^ \?&]*)[\?& ]')
+
+
+def _last_speed_marker(page, lower, line_end):
+    """
+    Return (start, end) of the last '1.0[0]*:' match in page[lower:line_end]
+    or (-1, -1) if there is none.
+    """
+    pos = line_end
+    while True:
+        pos = page.rfind('1', lower, pos)
+        if pos == -1:
+            return -1, -1
+        match = RE_SPEED.match(page, pos, line_end)
+        if match:
+            return pos, match.end()
+
+
+def iter_unit_spans(page):
+    """
+    Yields (start, end) for the html of each unit of page: start is where
+    the video id begins and end where the next unit starts. This is what
+    splitting page by the old data-streams pattern gave, without copying.
+    """
+    markers = {}  # line end -> last speed marker of the line
+    search = RE_STREAMS.search
+    find = page.find
+    pos = 0
+    previous = None
+    while True:
+        anchor = search(page, pos)
+        if anchor is None:
+            break
+        anchor_end = anchor.end()
+        line_end = find('\n', anchor_end)
+        if line_end == -1:
+            line_end = len(page)
+        marker = markers.get(line_end)
+        if marker is None:
+            marker = markers[line_end] = _last_speed_marker(page, anchor_end,
+                                                            line_end)
+        if marker[0] < anchor_end:
+            # no speed marker after this anchor in its line
+            pos = anchor_end
+            continue
+        if previous is not None:
+            yield previous, anchor.start()
+        previous = pos = marker[1]
+    if previous is not None:
+        yield previous, len(page)
+
+
+def extract_units(page, base_url):
+    """
+    Return the list of Unit of a subsection page: the videos with their
+    subtitles url first and then the extra videos embedded with iframes.
+    """
+    units = []
+    for start, end in iter_unit_spans(page):
+        video_id = page[start:min(start + YOUTUBE_VIDEO_ID_LENGTH, end)]
+        sub_url = None
+        match_subs = RE_SUBS.search(page, start, end)
+        if match_subs:
+            sub_url = base_url + match_subs.group(1) + "/en" + "?videoId=" + video_id
+        units.append(Unit(video_youtube_url='http://youtube.com/watch?v=' + video_id,
+                          sub_url=sub_url))
+
+    # Try to download some extra videos which is referred by iframe
+    for match in RE_EXTRA_YOUTUBE.finditer(page):
+        extra_id = match.group(1)[:YOUTUBE_VIDEO_ID_LENGTH]
+        units.append(Unit(video_youtube_url='http://youtube.com/watch?v=' + extra_id,
+                          sub_url=None))
+    return units
+
+
+# The streamed parsing only takes the urls and speed markers of up to
+# MAX_TOKEN characters (the real ones are far shorter) and keeps that much
+# of the page to find the tokens split between chunks.
+MAX_TOKEN = 4096
+TAIL = 2 * MAX_TOKEN
+
+RE_STREAMED_SPEED = re.compile(r'1(?=(.00{0,%d}:))' % MAX_TOKEN)
+# the subtitles urls are searched from each start, as they can overlap
+RE_STREAMED_SUBS = re.compile(
+    r'd(?=ata-transcript-translation-url=(?:&#34;|")([^"&]{0,%d})(&#34;|"))'
+    % MAX_TOKEN)
+RE_STREAMED_EXTRA = re.compile(
+    r'//w{0,3}\.youtube.com/embed/([^ \?&]{0,%d})[\?& ]' % MAX_TOKEN)
+
+# kinds of the tokens of UnitParser
+_STREAMS, _SPEED, _SUBS, _EXTRA = range(4)
+
+
+class UnitParser(object):
+    """
+    Extracts the units of a subsection page fed a chunk at a time, with the
+    same results as extract_units. feed() and close() return the units
+    completed so far; the extra videos embedded with iframes are returned
+    by close(), after the others.
+
+    A unit starts after the last speed marker of a line that has one after
+    a data-streams attribute, and ends where the data-streams attribute of
+    the next such line starts. Its subtitles url is the first one in it:
+    until its end is known, the urls that may be it are kept (only those
+    that end before all the previous ones).
+    """
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self._buffer = ''
+        self._offset = 0  # position of the buffer in the page
+        self._positions = [0] * 4  # where the search of each kind resumes
+        self._open = None  # [start, video id, [(end, subtitles url)]]
+        self._line_streams = None  # (start, end) of the first data-streams
+        self._no_newline = 0  # the line goes on at least until there
+        self._candidate = None  # unit of the last speed marker of the line
+        self._extra = []
+        self._units = []
+
+    def feed(self, text):
+        self._buffer += text
+        self._scan(len(self._buffer) - TAIL)
+        return self._take()
+
+    def close(self):
+        self._scan(len(self._buffer))
+        self._end_line()
+        if self._open is not None:
+            self._emit(self._open, self._offset + len(self._buffer))
+            self._open = None
+        self._units.extend(self._extra)
+        self._extra = []
+        return self._take()
+
+    def _take(self):
+        units, self._units = self._units, []
+        return units
+
+    def _tokens(self, limit):
+        # the tokens that start before limit, as (start, kind, match), in
+        # the order of the page; the buffer is kept from limit
+        buffer = self._buffer
+        tokens = []
+        for kind, regex in ((_STREAMS, RE_STREAMS), (_SPEED, RE_STREAMED_SPEED),
+                            (_SUBS, RE_STREAMED_SUBS),
+                            (_EXTRA, RE_STREAMED_EXTRA)):
+            end = max(limit, self._positions[kind])
+            for match in regex.finditer(buffer, self._positions[kind]):
+                if match.start() >= limit:
+                    break
+                tokens.append((match.start(), kind, match))
+                end = max(end, match.end())
+            self._positions[kind] = end
+        tokens.sort(key=lambda token: token[:2])
+        return tokens
+
+    def _scan(self, limit):
+        if limit <= 0:
+            return
+        for start, kind, match in self._tokens(limit):
+            self._check_line(start)
+            self._token(kind, match)
+        self._check_line(limit)
+        self._buffer = self._buffer[limit:]
+        self._offset += limit
+        self._positions = [pos - limit for pos in self._positions]
+
+    def _check_line(self, pos):
+        # end the line of _line_streams if it ends before pos (only the
+        # lines with a data-streams attribute matter)
+        if self._line_streams is None:
+            return
+        begin = max(self._line_streams[1], self._no_newline) - self._offset
+        if self._buffer.find('\n', begin, pos) != -1:
+            self._end_line()
+        else:
+            self._no_newline = self._offset + pos
+
+    def _token(self, kind, match):
+        offset = self._offset
+        if kind == _STREAMS:
+            if self._line_streams is None:
+                self._line_streams = (offset + match.start(),
+                                      offset + match.end())
+        elif kind == _SPEED:
+            if (self._line_streams is not None and
+                    offset + match.start() >= self._line_streams[1]):
+                start = match.end(1)
+                self._candidate = [
+                    offset + start,
+                    self._buffer[start:start + YOUTUBE_VIDEO_ID_LENGTH], []]
+        elif kind == _SUBS:
+            start, end = offset + match.start(), offset + match.end(2)
+            for unit in (self._candidate, self._open):
+                if unit is None or start < unit[0]:
+                    continue
+                subs = unit[2]
+                if not subs or end < subs[-1][0]:
+                    subs.append((end, match.group(1)))
+        elif kind == _EXTRA:
+            extra_id = match.group(1)[:YOUTUBE_VIDEO_ID_LENGTH]
+            self._extra.append(Unit(
+                video_youtube_url='http://youtube.com/watch?v=' + extra_id,
+                sub_url=None))
+
+    def _end_line(self):
+        if self._candidate is not None:
+            if self._open is not None:
+                self._emit(self._open, self._line_streams[0])
+            self._open = self._candidate
+        self._line_streams = None
+        self._candidate = None
+
+    def _emit(self, unit, end):
+        start, video_id, subs = unit
+        video_id = video_id[:max(0, end - start)]
+        sub_url = None
+        for sub_end, sub in subs:
+            if sub_end <= end:
+                sub_url = self.base_url + sub + "/en" + "?videoId=" + video_id
+                break
+        self._units.append(Unit(
+            video_youtube_url='http://youtube.com/watch?v=' + video_id,
+            sub_url=sub_url))
+
+
+class _ElementParser(HTMLParser):
+    """
+    Base of the parsers that take each element with a given tag and class
+    of a page (e.g. the div.chapter of the courseware) as a record. They
+    are fed a chunk at a time and only keep the tags that are not complete
+    yet (and the contents of a script until its end). An element that is
+    not closed ends where the next one starts.
+    """
+
+    tag = None
+    class_name = None
+
+    def __init__(self, base_url):
+        HTMLParser.__init__(self)
+        self.base_url = base_url
+        self._depth = 0  # of self.tag in the current element, 0 outside
+        self._records = []
+
+    def feed(self, text):
+        HTMLParser.feed(self, text)
+        records, self._records = self._records, []
+        return records
+
+    def close(self):
+        HTMLParser.close(self)
+        if self._depth:  # not closed at the end of the page
+            self._depth = 0
+            self._add_record()
+        records, self._records = self._records, []
+        return records
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict((name, value or '') for name, value in attrs)
+        if (tag == self.tag and
+                self.class_name in attrs.get('class', '').split()):
+            if self._depth:
+                # the previous element (or one of its children) was not
+                # closed, the records are not nested in the pages
+                self._add_record()
+            self._depth = 1
+            self.begin()
+        elif self._depth:
+            if tag == self.tag:
+                self._depth += 1
+            self.start(tag, attrs)
+
+    def handle_endtag(self, tag):
+        if not self._depth:
+            return
+        if tag == self.tag:
+            self._depth -= 1
+            if not self._depth:
+                self._add_record()
+                return
+        self.end(tag)
+
+    def handle_data(self, data):
+        if self._depth:
+            self.data(data)
+
+    # python 2 does not convert the character references
+    def handle_entityref(self, name):
+        self.handle_data(unescape('&%s;' % name))
+
+    def handle_charref(self, name):
+        self.handle_data(unescape('&#%s;' % name))
+
+    def _add_record(self):
+        record = self.record()
+        if record is not None:
+            self._records.append(record)
+
+    def begin(self):
+        pass
+
+    def start(self, tag, attrs):
+        pass
+
+    def end(self, tag):
+        pass
+
+    def data(self, data):
+        pass
+
+    def record(self):
+        raise NotImplementedError
+
+
+class CourseParser(_ElementParser):
+    """
+    Extracts the courses (article.course) of the dashboard: the name is
+    the text of the first h3 and the url the first link, the courses that
+    have started link to their info page.
+    """
+
+    tag = 'article'
+    class_name = 'course'
+
+    def begin(self):
+        self._title = None
+        self._in_title = False
+        self._href = None
+
+    def start(self, tag, attrs):
+        if tag == 'h3' and self._title is None:
+            self._title = []
+            self._in_title = True
+        elif tag == 'a' and self._href is None:
+            self._href = attrs.get('href', False)
+
+    def end(self, tag):
+        if tag == 'h3':
+            self._in_title = False
+
+    def data(self, data):
+        if self._in_title:
+            self._title.append(data)
+
+    def record(self):
+        url = None
+        state = 'Not yet'
+        if self._href not in (None, False):
+            url = self.base_url + self._href
+            if url.endswith('info') or url.endswith('info/'):
+                state = 'Started'
+        return Course(name=''.join(self._title or []).strip(), url=url,
+                      state=state)
+
+
+class SectionParser(_ElementParser):
+    """
+    Extracts the sections (div.chapter) of the courseware: the name is the
+    text of the link of the first h3 and the url the first link of the
+    first list. The sections without a link are skipped, but counted in
+    the positions.
+    """
+
+    tag = 'div'
+    class_name = 'chapter'
+
+    def __init__(self, base_url):
+        _ElementParser.__init__(self, base_url)
+        self._position = 0
+
+    def begin(self):
+        self._position += 1
+        self._state = None  # 'h3', 'name' (its link) or 'ul'
+        self._name = None
+        self._seen_ul = False
+        self._href = None
+
+    def start(self, tag, attrs):
+        if tag == 'h3' and self._name is None and self._state is None:
+            self._state = 'h3'
+        elif tag == 'a' and self._state == 'h3':
+            self._name = []
+            self._state = 'name'
+        elif tag == 'ul' and not self._seen_ul and self._state is None:
+            self._seen_ul = True
+            self._state = 'ul'
+        elif tag == 'a' and self._state == 'ul' and self._href is None:
+            self._href = attrs.get('href')
+
+    def end(self, tag):
+        if ((tag == 'a' and self._state == 'name') or
+                (tag in ('h3', 'ul') and self._state is not None)):
+            self._state = None
+
+    def data(self, data):
+        if self._state == 'name':
+            self._name.append(data)
+
+    def record(self):
+        if self._href is None:
+            return None
+        return Section(position=self._position,
+                       name=''.join(self._name or []).strip(),
+                       url=self.base_url + self._href)
+
+
+def parse_chunks(parser, chunks):
+    """
+    Yield the records of the page given by the chunks (of text) as parser
+    (a UnitParser, CourseParser or SectionParser) finds them.
+    """
+    for chunk in chunks:
+        for record in parser.feed(chunk):
+            yield record
+    for record in parser.close():
+        yield record
+
+
+# the parser of each kind of page
+PARSERS = {
+    'subsection': UnitParser,
+    'courseware': SectionParser,
+    'dashboard': CourseParser,
+}
+
+# the parsers are fed this many bytes of the body at a time
+PARSE_CHUNK_SIZE = 64 * 1024
+
+
+def parse_body(page, body, charset, base_url):
+    """
+    Return the records of the body (bytes in charset) of a page of kind page
+    ('subsection', 'courseware' or 'dashboard').
+    """
+    parser = PARSERS[page](base_url)
+    decoder = codecs.getincrementaldecoder(charset)()
+    records = []
+    for i in range(0, len(body), PARSE_CHUNK_SIZE):
+        chunk = body[i:i + PARSE_CHUNK_SIZE]
+        records.extend(parser.feed(decoder.decode(chunk)))
+    records.extend(parser.feed(decoder.decode(b'', True)))
+    records.extend(parser.close())
+    return records
+
+
+def _timed_parse_body(page, body, charset, base_url):
+    # runs in the worker processes of ParsePool
+    started = time.time()
+    records = parse_body(page, body, charset, base_url)
+    return records, time.time() - started
+
+
+class ParsePool(object):
+    """
+    Parses pages in a pool of worker processes, so that the parsing of the
+    pages fetched by several threads is not serialized by the GIL.
+
+    The processes are started right away, so create the pool before
+    starting other threads.
+    """
+
+    def __init__(self, processes=None):
+        import multiprocessing
+        self._pool = multiprocessing.Pool(processes)
+
+    def parse(self, page, body, charset, base_url):
+        """
+        Return the records of the body of a page, as parse_body does, and
+        the seconds spent parsing it. The calling thread waits for them.
+        """
+        return self._pool.apply(_timed_parse_body,
+                                (page, body, charset, base_url))
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+"""
+Priority policies of the download queue: which videos of a course are
+downloaded first.
+"""
+
+from __future__ import unicode_literals
+
+from .common import youtube_id
+
+# course: the order of the course, recent: the last sections first, size:
+# the smallest videos first
+PRIORITIES = ('course', 'recent', 'size')
+DEFAULT_PRIORITY = ['course']
+
+
+def parse_priority(value):
+    """
+    Return the list of policies of a comma separated --priority value.
+    Raises ValueError for unknown policies.
+    """
+    policies = [policy.strip() for policy in value.split(',')
+                if policy.strip()]
+    unknown = [policy for policy in policies if policy not in PRIORITIES]
+    if unknown or not policies:
+        raise ValueError('unknown priority %s (choose from %s)' %
+                         (', '.join(unknown), ', '.join(PRIORITIES)))
+    return policies
+
+
+def order_jobs(jobs, policies, sections=None, sizes=None):
+    """
+    Return the (filename_prefix, unit) jobs sorted by the policies, each
+    one breaking the ties of the previous ones (and the order of the course
+    the ties of all of them). sections has the section number of each job,
+    sizes the size in bytes of the videos by YouTube id: the videos of
+    unknown size go last.
+    """
+    sizes = sizes or {}
+
+    def key(item):
+        i, (_, unit) = item
+        values = []
+        for policy in policies:
+            if policy == 'course':
+                values.append(i)
+            elif policy == 'recent':
+                values.append(-sections[i] if sections else 0)
+            elif policy == 'size':
+                size = sizes.get(youtube_id(unit.video_youtube_url))
+                values.append((size is None, size or 0))
+        values.append(i)
+        return values
+
+    return [job for _, job in sorted(enumerate(jobs), key=key)]
@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+
+"""
+Supervision of the youtube-dl processes.
+
+A single thread reads the output of all the running processes (with
+selectors where the platform can poll pipes), parses their progress and
+shows it in one status line.
+"""
+
+from __future__ import unicode_literals
+
+try:
+    import selectors
+except ImportError:  # python 2
+    selectors = None
+
+import os
+import re
+import sys
+import threading
+import time
+
+from collections import deque, namedtuple
+from subprocess import Popen, PIPE
+
+CHUNK_SIZE = 64 * 1024
+MAX_OUTPUT_LINES = 200
+DISPLAY_INTERVAL = 0.5
+LOG_INTERVAL = 10.0
+
+Progress = namedtuple('Progress', ['percent', 'size', 'speed', 'eta'])
+
+# e.g. '[download]  45.3% of 10.50MiB at  1.23MiB/s ETA 00:05'
+RE_PROGRESS = re.compile(r'\[download\]\s+(?P<percent>[\d.]+)%\s+of\s+~?\s*(?P<size>\S+)'
+                         r'(?:\s+at\s+(?P<speed>\S+))?(?:\s+ETA\s+(?P<eta>\S+))?')
+RE_LINE_END = re.compile(br'[\r\n]')
+
+
+def parse_progress(line):
+    """
+    Return the Progress of a youtube-dl progress line or None.
+    """
+    match = RE_PROGRESS.search(line)
+    if match is None:
+        return None
+    return Progress(percent=float(match.group('percent')),
+                    size=match.group('size'), speed=match.group('speed'),
+                    eta=match.group('eta'))
+
+
+class _Child(object):
+    """
+    A running process and what we keep of its output: the last progress
+    and the last MAX_OUTPUT_LINES lines that are not progress lines of each
+    stream, so that the warnings on stderr do not push out the lines on
+    stdout that report the downloaded files.
+    """
+
+    def __init__(self, popen, name, echo):
+        self.popen = popen
+        self.name = name
+        self.echo = echo
+        self.progress = None
+        self.lines = {'stdout': deque(maxlen=MAX_OUTPUT_LINES),
+                      'stderr': deque(maxlen=MAX_OUTPUT_LINES)}
+        self.partial = {}
+        self.open_streams = 2
+        self.returncode = None
+        self.done = threading.Event()
+
+    def feed(self, stream, data):
+        if self.echo and stream == 'stdout':
+            out = getattr(sys.stdout, 'buffer', None)
+            if out is not None:
+                out.write(data)
+            else:
+                sys.stdout.write(data.decode('utf-8', 'replace'))
+            sys.stdout.flush()
+        data = self.partial.pop(stream, b'') + data
+        pieces = RE_LINE_END.split(data)
+        if pieces[-1]:
+            self.partial[stream] = pieces[-1]
+        for piece in pieces[:-1]:
+            self._line(stream, piece)
+
+    def close_stream(self, stream):
+        rest = self.partial.pop(stream, b'')
+        if rest:
+            self._line(stream, rest)
+        self.open_streams -= 1
+
+    def _line(self, stream, raw):
+        if not raw:
+            return
+        line = raw.decode('utf-8', 'replace')
+        progress = parse_progress(line)
+        if progress is not None:
+            self.progress = progress
+        else:
+            self.lines[stream].append(line)
+
+    def output(self):
+        lines = list(self.lines['stdout']) + list(self.lines['stderr'])
+        return '\n'.join(lines).encode('utf-8')
+
+
+class ProcessRunner(object):
+    """
+    Runs commands and supervises all of them from a single thread.
+
+    run() blocks the calling thread until its process finishes, so several
+    threads can run processes at the same time. Unless a process echoes its
+    output, its progress is shown in a status line shared by all of them.
+    """
+
+    def __init__(self, stream=None, display_interval=DISPLAY_INTERVAL):
+        self.stream = stream or sys.stdout
+        self.display_interval = display_interval
+        self._children = []
+        self._lock = threading.Lock()
+        self._use_selector = selectors is not None and os.name != 'nt'
+        self._selector = selectors.DefaultSelector() if self._use_selector else None
+        self._wakeup_r, self._wakeup_w = os.pipe() if self._use_selector else (None, None)
+        if self._use_selector:
+            self._selector.register(self._wakeup_r, selectors.EVENT_READ, None)
+        self._closed = False
+        self._last_log = 0.0
+        self._status_width = 0
+        self._thread = threading.Thread(target=self._supervise)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def run(self, cmd, name=None, echo=False):
+        """
+        Run cmd and return its exit status and the output lines it printed
+        (except for the progress lines).
+        """
+        popen = Popen(cmd, stdout=PIPE, stderr=PIPE)
+        child = _Child(popen, name or os.path.basename(cmd[0]), echo)
+        with self._lock:
+            self._children.append(child)
+            if self._use_selector:
+                self._selector.register(popen.stdout, selectors.EVENT_READ,
+                                        (child, 'stdout'))
+                self._selector.register(popen.stderr, selectors.EVENT_READ,
+                                        (child, 'stderr'))
+        if self._use_selector:
+            os.write(self._wakeup_w, b'x')
+        else:
+            readers = [threading.Thread(target=self._read_pipe,
+                                        args=(child, pipe, stream))
+                       for pipe, stream in ((popen.stdout, 'stdout'),
+                                            (popen.stderr, 'stderr'))]
+            for reader in readers:
+                reader.daemon = True
+                reader.start()
+        child.done.wait()
+        return child.returncode, child.output()
+
+    def message(self, text):
+        """
+        Print a line of text without mixing it with the status line.
+        """
+        with self._lock:
+            self._clear_status()
+            self._write(text + '\n')
+
+    def active(self):
+        """
+        Return (name, progress) of the running processes.
+        """
+        with self._lock:
+            return [(child.name, child.progress) for child in self._children]
+
+    def close(self):
+        self._closed = True
+        if self._use_selector:
+            os.write(self._wakeup_w, b'x')
+        self._thread.join()
+        if self._use_selector:
+            self._selector.close()
+            os.close(self._wakeup_r)
+            os.close(self._wakeup_w)
+
+    def _read_pipe(self, child, pipe, stream):
+        # used where pipes can not be polled, one thread per pipe
+        fd = pipe.fileno()
+        while True:
+            data = os.read(fd, CHUNK_SIZE)
+            with self._lock:
+                if not data:
+                    self._stream_closed(child, pipe, stream)
+                    return
+                child.feed(stream, data)
+
+    def _stream_closed(self, child, pipe, stream):
+        # called with the lock held
+        child.close_stream(stream)
+        pipe.close()
+        if child.open_streams == 0:
+            child.returncode = child.popen.wait()
+            self._children.remove(child)
+            child.done.set()
+
+    def _supervise(self):
+        while not self._closed:
+            if self._use_selector:
+                events = self._selector.select(self.display_interval)
+                for key, _ in events:
+                    if key.data is None:
+                        os.read(self._wakeup_r, CHUNK_SIZE)
+                        continue
+                    child, stream = key.data
+                    data = os.read(key.fd, CHUNK_SIZE)
+                    with self._lock:
+                        if data:
+                            child.feed(stream, data)
+                        else:
+                            self._selector.unregister(key.fileobj)
+                            self._stream_closed(child, key.fileobj, stream)
+            else:
+                time.sleep(self.display_interval)
+            self._display()
+        with self._lock:
+            self._clear_status()
+
+    def _display(self):
+        # the lock keeps the status line from being written in the middle
+        # of a message()
+        with self._lock:
+            self._show_status()
+
+    def _show_status(self):
+        # called with the lock held
+        children = [child for child in self._children if not child.echo]
+        if not children:
+            self._clear_status()
+            return
+        parts = []
+        for child in children:
+            progress = child.progress
+            if progress is None:
+                parts.append('%s starting' % child.name)
+            else:
+                parts.append('%s %.0f%% %s ETA %s' % (
+                    child.name, progress.percent, progress.speed or '-',
+                    progress.eta or '-'))
+        status = '[%d running] %s' % (len(children), ' | '.join(parts))
+        if self._is_tty():
+            width = 79
+            status = status[:width]
+            self._write('\r' + status.ljust(self._status_width))
+            self._status_width = len(status)
+        elif time.time() - self._last_log >= LOG_INTERVAL:
+            self._last_log = time.time()
+            self._write(status + '\n')
+
+    def _clear_status(self):
+        if self._status_width and self._is_tty():
+            self._write('\r' + ' ' * self._status_width + '\r')
+            self._status_width = 0
+
+    def _is_tty(self):
+        isatty = getattr(self.stream, 'isatty', None)
+        return bool(isatty and isatty())
+
+    def _write(self, text):
+        try:
+            self.stream.write(text)
+            self.stream.flush()
+        except (IOError, ValueError, UnicodeError):
+            pass
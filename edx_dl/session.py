@@ -0,0 +1,638 @@
+# -*- coding: utf-8 -*-
+
+"""
+HTTP session with persistent per-host connections, used for all the
+requests that edx-dl makes to the OpenEdX platforms.
+"""
+
+from __future__ import unicode_literals
+
+try:
+    import http.client as httplib
+except ImportError:
+    import httplib
+
+try:
+    from http.cookiejar import LoadError, LWPCookieJar
+except ImportError:
+    from cookielib import LoadError, LWPCookieJar
+
+try:
+    from urllib.parse import urljoin, urlsplit
+    from urllib.request import HTTPError, Request, URLError
+    from urllib.request import getproxies, proxy_bypass
+except ImportError:
+    from urlparse import urljoin, urlsplit
+    from urllib import getproxies, proxy_bypass
+    from urllib2 import HTTPError, Request, URLError
+
+import codecs
+import socket
+import threading
+import time
+import zlib
+
+from functools import partial
+from io import BytesIO
+
+from .cache import atomic_write
+from .throttle import DEFAULT_BACKOFF, DEFAULT_MAX_PER_HOST, THROTTLE_STATUSES
+from .throttle import backoff_delay, parse_retry_after
+
+DEFAULT_TIMEOUT = 60
+MAX_REDIRECTS = 10
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+CHUNK_SIZE = 64 * 1024
+
+
+class Response(object):
+    """
+    A fully read HTTP response. The body is already decompressed.
+    """
+
+    def __init__(self, url, status, reason, headers, body, cached=False,
+                 stream=None, sink=None):
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+        self.cached = cached
+        # the chunks of the body when it is streamed, and the EntryWriter
+        # of the cache that they are written to
+        self._stream = stream
+        self._sink = sink
+
+    def info(self):
+        """
+        Return the headers, as urllib responses do (needed by CookieJar).
+        """
+        return self.headers
+
+    def charset(self):
+        try:
+            return self.headers.get_content_charset(failobj="utf-8")  # for python3
+        except AttributeError:
+            return self.headers.getparam('charset') or 'utf-8'
+
+    def read(self):
+        """
+        Return the body, reading the rest of it if it is streamed.
+        """
+        if self._stream is not None:
+            self.body = b''.join(self.iter_content())
+        return self.body
+
+    def text(self):
+        """
+        Return the body decoded with the charset announced by the server.
+        """
+        return self.read().decode(self.charset())
+
+    def iter_content(self):
+        """
+        Yield the body a chunk at a time. A streamed body (see Session.get)
+        is read from the connection as it is consumed, and only once.
+        """
+        stream, self._stream = self._stream, None
+        sink, self._sink = self._sink, None
+        if stream is None:
+            if self.body:
+                yield self.body
+            return
+        complete = False
+        try:
+            for chunk in stream:
+                if sink is not None:
+                    sink.write(chunk)
+                yield chunk
+            complete = True
+        finally:
+            stream.close()
+            if sink is not None:
+                if complete:
+                    sink.commit()
+                else:
+                    sink.abort()
+
+    def iter_text(self):
+        """
+        Yield the body a chunk at a time, decoded as text() does.
+        """
+        decoder = codecs.getincrementaldecoder(self.charset())()
+        for chunk in self.iter_content():
+            text = decoder.decode(chunk)
+            if text:
+                yield text
+        text = decoder.decode(b'', True)
+        if text:
+            yield text
+
+    def close(self):
+        """
+        Release the connection of a streamed body that was not read to the
+        end (it is closed).
+        """
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+        if self._sink is not None:
+            self._sink.abort()
+            self._sink = None
+
+
+def make_headers(pairs):
+    """
+    Build a headers object like the ones of httplib responses from a list
+    of (name, value) pairs.
+    """
+    raw = ''.join('%s: %s\r\n' % (name, value)
+                  for name, value in pairs if value is not None)
+    fp = BytesIO((raw + '\r\n').encode('latin-1'))
+    try:
+        return httplib.parse_headers(fp)
+    except AttributeError:  # python 2
+        return httplib.HTTPMessage(fp)
+
+
+def decode_body(body, encoding):
+    """
+    Undo the gzip or deflate content encoding of body.
+    """
+    encoding = (encoding or '').strip().lower()
+    if encoding in ('gzip', 'x-gzip'):
+        return zlib.decompress(body, 16 + zlib.MAX_WBITS)
+    if encoding == 'deflate':
+        try:
+            return zlib.decompress(body)
+        except zlib.error:
+            # some servers send a raw deflate stream without zlib header
+            return zlib.decompress(body, -zlib.MAX_WBITS)
+    return body
+
+
+class _Decoder(object):
+    """
+    Undoes the content encoding of a body fed a chunk at a time, as
+    decode_body does for a whole body, without decoding more than
+    CHUNK_SIZE bytes at once.
+    """
+
+    def __init__(self, encoding):
+        encoding = (encoding or '').strip().lower()
+        self._deflate = encoding == 'deflate'
+        self._started = False
+        self._pending = b''  # fed but not decoded yet
+        if encoding in ('gzip', 'x-gzip'):
+            self._obj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif self._deflate:
+            self._obj = zlib.decompressobj()
+        else:
+            self._obj = None
+
+    def feed(self, chunk):
+        self._pending += chunk
+
+    def read(self):
+        """
+        Return the next bytes of the body, or b'' if more must be fed.
+        """
+        if not self._pending:
+            return b''
+        if self._obj is None:
+            data, self._pending = self._pending, b''
+            return data
+        try:
+            data = self._obj.decompress(self._pending, CHUNK_SIZE)
+        except zlib.error:
+            if not self._deflate or self._started:
+                raise
+            # some servers send a raw deflate stream without zlib header
+            self._obj = zlib.decompressobj(-zlib.MAX_WBITS)
+            data = self._obj.decompress(self._pending, CHUNK_SIZE)
+        self._started = True
+        self._pending = self._obj.unconsumed_tail
+        return data
+
+    def flush(self):
+        return self._obj.flush() if self._obj is not None else b''
+
+
+class _StreamedBody(object):
+    """
+    Iterates over the body of a response as it is received, CHUNK_SIZE
+    bytes at a time. finish is called with the bytes received when the end
+    is reached, or with None if the body is closed before.
+    """
+
+    def __init__(self, resp, finish, bucket=None):
+        self._resp = resp
+        self._finish = finish
+        self._bucket = bucket
+        self._decoder = _Decoder(resp.msg.get('content-encoding'))
+        self._received = 0
+        self._done = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            while True:
+                data = self._decoder.read()
+                if data:
+                    return data
+                if self._done:
+                    raise StopIteration
+                chunk = self._resp.read(CHUNK_SIZE)
+                if chunk:
+                    self._received += len(chunk)
+                    if self._bucket is not None:
+                        self._bucket.consume(len(chunk))
+                    self._decoder.feed(chunk)
+                else:
+                    self._done = True
+                    self._finish(self._received)
+                    data = self._decoder.flush()
+                    if data:
+                        return data
+        except (httplib.HTTPException, socket.error) as e:
+            self.close()
+            raise URLError(e)
+        except Exception:
+            self.close()
+            raise
+
+    next = __next__  # python 2
+
+    def close(self):
+        if not self._done:
+            self._done = True
+            self._finish(None)
+
+
+class _FileBody(object):
+    """
+    Iterates over the rest of an open file CHUNK_SIZE bytes at a time, for
+    the streamed bodies of the cached responses.
+    """
+
+    def __init__(self, f):
+        self._file = f
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        chunk = self._file.read(CHUNK_SIZE)
+        if not chunk:
+            self.close()
+            raise StopIteration
+        return chunk
+
+    next = __next__  # python 2
+
+    def close(self):
+        self._file.close()
+
+
+class _HostPool(object):
+    """
+    The idle connections to one host and the limit of connections to it.
+    """
+
+    def __init__(self, max_connections):
+        self.slots = threading.BoundedSemaphore(max_connections)
+        self.idle = []
+        self.lock = threading.Lock()
+
+
+class Session(object):
+    """
+    Keeps the cookies and a pool of keep-alive connections per host.
+
+    It is safe to share a session between threads: at most max_per_host
+    requests are sent to the same host at the same time, the remaining ones
+    wait for a connection to be released.
+
+    If a ResponseCache is given, the GET requests made with use_cache are
+    answered from it when possible and revalidated with conditional
+    requests otherwise.
+
+    If a controller (see throttle.AIMDController) is given, it decides how
+    many of those max_per_host connections are really used. GET requests
+    that fail because of the network or a throttling status are retried
+    up to retries times, waiting what the server asks in Retry-After or
+    an exponential backoff otherwise.
+
+    If a metrics.Metrics is given, the latency and the bytes of the requests
+    are recorded in it. If a throttle.TokenBucket is given, the bytes of
+    the responses are taken from it, to stay under a bandwidth limit.
+
+    With stream set, get() returns as soon as the headers are received and
+    the body is read a chunk at a time with Response.iter_content() (or
+    iter_text()), which keeps the connection until the end of the body or
+    Response.close(). The cache reads and writes it a chunk at a time too.
+    """
+
+    def __init__(self, max_per_host=DEFAULT_MAX_PER_HOST,
+                 timeout=DEFAULT_TIMEOUT, cache=None, controller=None,
+                 retries=0, backoff=DEFAULT_BACKOFF, metrics=None,
+                 bucket=None):
+        self.cookies = LWPCookieJar()
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self.cache = cache
+        self.controller = controller
+        self.retries = retries
+        self.backoff = backoff
+        self.metrics = metrics
+        self.bucket = bucket
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def get(self, url, headers=None, use_cache=False, stream=False):
+        cache = self.cache if use_cache else None
+        if cache is None:
+            return self.request(url, None, headers, stream)
+
+        entry = cache.get(url, stream)
+        if entry is not None and cache.is_fresh(entry):
+            if self.metrics is not None:
+                self.metrics.add('cached_responses', status='fresh')
+            return self._cached_response(entry)
+
+        request_headers = dict(headers or {})
+        if entry is not None:
+            if entry.etag:
+                request_headers['If-None-Match'] = entry.etag
+            if entry.last_modified:
+                request_headers['If-Modified-Since'] = entry.last_modified
+        try:
+            response = self.request(url, None, request_headers, stream)
+        except Exception:
+            if stream and entry is not None:
+                entry.body.close()
+            raise
+
+        # a redirected response (e.g. to the login page) is not the page at
+        # url: it is neither matched with nor stored as its entry
+        redirected = response.url != url
+        if response.status == 304 and entry is not None and not redirected:
+            etag = response.headers.get('etag') or entry.etag
+            last_modified = (response.headers.get('last-modified') or
+                             entry.last_modified)
+            if self.metrics is not None:
+                self.metrics.add('cached_responses', status='revalidated')
+            if stream:
+                response.read()
+                # the entry is stored again as the body is read
+                return self._cached_response(entry, cache.writer(
+                    url, etag, last_modified, entry.content_type))
+            cache.put(url, entry.body, etag, last_modified,
+                      entry.content_type)
+            return self._cached_response(entry)
+        if stream and entry is not None:
+            entry.body.close()
+        if response.status == 200 and not redirected:
+            if stream:
+                response._sink = cache.writer(
+                    url, response.headers.get('etag'),
+                    response.headers.get('last-modified'),
+                    response.headers.get('content-type'))
+            else:
+                cache.put(url, response.body, response.headers.get('etag'),
+                          response.headers.get('last-modified'),
+                          response.headers.get('content-type'))
+        return response
+
+    def post(self, url, data, headers=None):
+        return self.request(url, data, headers)
+
+    def request(self, url, data=None, headers=None, stream=False):
+        """
+        Send a GET (or a POST if data is given) following the redirects.
+
+        Raises HTTPError for error statuses and URLError for connection
+        problems, as urlopen does.
+        """
+        for _ in range(MAX_REDIRECTS + 1):
+            response = self._send_with_retries(url, data, headers or {},
+                                               stream)
+            location = response.headers.get('location')
+            if response.status in REDIRECT_CODES and location:
+                response.read()
+                url = urljoin(url, location)
+                if response.status in (301, 302, 303):
+                    data = None
+                continue
+            if response.status >= 400:
+                raise HTTPError(url, response.status, response.reason,
+                                response.headers, BytesIO(response.read()))
+            return response
+        raise HTTPError(url, response.status, 'Too many redirects',
+                        response.headers, BytesIO(response.read()))
+
+    def close(self):
+        """
+        Close all the idle connections.
+        """
+        with self._lock:
+            pools = list(self._pools.values())
+        for pool in pools:
+            with pool.lock:
+                idle, pool.idle = pool.idle, []
+            for conn, _ in idle:
+                conn.close()
+
+    def cookie(self, name):
+        """
+        Return the value of the cookie with the given name or None.
+        """
+        for cookie in self.cookies:
+            if cookie.name == name:
+                return cookie.value
+        return None
+
+    def save_cookies(self, path):
+        """
+        Write the cookies, including the ones that only last for the browser
+        session, to path (readable only by the user).
+        """
+        data = '#LWP-Cookies-2.0\n' + self.cookies.as_lwp_str(
+            ignore_discard=True, ignore_expires=False)
+        atomic_write(path, data.encode('utf-8'))
+
+    def load_cookies(self, path):
+        """
+        Add the cookies saved to path with save_cookies. Returns False if
+        they could not be read.
+        """
+        try:
+            self.cookies.load(path, ignore_discard=True)
+        except (IOError, OSError, LoadError):
+            return False
+        return True
+
+    def clear_cookies(self):
+        self.cookies.clear()
+
+    def _send_with_retries(self, url, data, headers, stream=False):
+        # only the GET requests are safe to repeat
+        retries = self.retries if data is None else 0
+        attempt = 0
+        while True:
+            try:
+                response = self._send(url, data, headers, stream)
+            except (httplib.HTTPException, socket.error) as e:
+                if attempt >= retries:
+                    raise URLError(e)
+                delay = backoff_delay(attempt, self.backoff)
+            else:
+                if response.status not in THROTTLE_STATUSES or attempt >= retries:
+                    return response
+                response.read()
+                delay = parse_retry_after(response.headers.get('retry-after'))
+                if delay is None:
+                    delay = backoff_delay(attempt, self.backoff)
+            attempt += 1
+            time.sleep(delay)
+
+    @staticmethod
+    def _cached_response(entry, sink=None):
+        headers = make_headers([('Content-Type', entry.content_type),
+                                ('ETag', entry.etag),
+                                ('Last-Modified', entry.last_modified)])
+        if isinstance(entry.body, bytes):
+            return Response(entry.url, 200, 'OK', headers, entry.body,
+                            cached=True)
+        return Response(entry.url, 200, 'OK', headers, None, cached=True,
+                        stream=_FileBody(entry.body), sink=sink)
+
+    def _get_pool(self, key):
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool is None:
+                pool = self._pools[key] = _HostPool(self.max_per_host)
+            return pool
+
+    def _connect(self, parts):
+        """
+        Open a new connection for the scheme/host in parts, through the
+        proxy configured in the environment if any. Returns the connection
+        and whether the request target must be the absolute url.
+        """
+        is_https = parts.scheme == 'https'
+        conn_class = httplib.HTTPSConnection if is_https else httplib.HTTPConnection
+        proxy = getproxies().get(parts.scheme)
+        if proxy and not proxy_bypass(parts.hostname):
+            proxy_parts = urlsplit(proxy)
+            if is_https:
+                conn = conn_class(proxy_parts.hostname, proxy_parts.port,
+                                  timeout=self.timeout)
+                conn.set_tunnel(parts.hostname, parts.port)
+                return conn, False
+            conn = httplib.HTTPConnection(proxy_parts.hostname,
+                                          proxy_parts.port,
+                                          timeout=self.timeout)
+            return conn, True
+        return conn_class(parts.hostname, parts.port, timeout=self.timeout), False
+
+    def _send(self, url, data, headers, stream=False):
+        request = Request(url, data, headers)
+        self.cookies.add_cookie_header(request)
+        request_headers = dict((name.title(), value)
+                               for name, value in request.header_items())
+        request_headers.setdefault('Accept-Encoding', 'gzip, deflate')
+        if data is not None:
+            request_headers.setdefault('Content-Type',
+                                       'application/x-www-form-urlencoded')
+        method = 'GET' if data is None else 'POST'
+
+        parts = urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        if self.controller is not None:
+            self.controller.acquire(parts.netloc)
+        started = time.time()
+        resp = None
+        pool = self._get_pool((parts.scheme, parts.netloc))
+        pool.slots.acquire()
+        try:
+            with pool.lock:
+                idle = pool.idle.pop() if pool.idle else None
+            reused = idle is not None
+            conn, absolute = idle if reused else self._connect(parts)
+            target = url if absolute else path
+            try:
+                resp = self._roundtrip(conn, method, target, data, request_headers)
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                if not reused:
+                    raise
+                # the server closed the idle connection, try a fresh one
+                conn, absolute = self._connect(parts)
+                target = url if absolute else path
+                try:
+                    resp = self._roundtrip(conn, method, target, data,
+                                           request_headers)
+                except (httplib.HTTPException, socket.error):
+                    conn.close()
+                    raise
+        except BaseException:
+            self._release(parts, pool, started, resp)
+            raise
+
+        finish = partial(self._finish, parts, method, data, pool, conn,
+                         absolute, resp, started)
+        if stream:
+            response = Response(url, resp.status, resp.reason, resp.msg, None,
+                                stream=_StreamedBody(resp, finish,
+                                                     self.bucket))
+        else:
+            try:
+                body = resp.read()
+            except BaseException:
+                finish(None)
+                raise
+            finish(len(body))
+            if self.bucket is not None:
+                self.bucket.consume(len(body))
+            body = decode_body(body, resp.msg.get('content-encoding'))
+            response = Response(url, resp.status, resp.reason, resp.msg, body)
+        self.cookies.extract_cookies(response, request)
+        return response
+
+    def _release(self, parts, pool, started, resp):
+        pool.slots.release()
+        if self.controller is not None:
+            status = resp.status if resp is not None else None
+            retry_after = None
+            if resp is not None and resp.status in THROTTLE_STATUSES:
+                retry_after = parse_retry_after(resp.msg.get('retry-after'))
+            self.controller.release(parts.netloc, time.time() - started,
+                                    status, retry_after)
+
+    def _finish(self, parts, method, data, pool, conn, absolute, resp,
+                started, received):
+        # the body of resp was read (received bytes) or abandoned (None)
+        if received is None or resp.will_close:
+            conn.close()
+        else:
+            with pool.lock:
+                pool.idle.append((conn, absolute))
+        self._release(parts, pool, started, resp)
+        if self.metrics is not None and received is not None:
+            host = parts.netloc
+            self.metrics.add('requests', host=host, method=method)
+            self.metrics.add('sent_bytes', len(data or b''), host=host)
+            self.metrics.add('received_bytes', received, host=host)
+            self.metrics.observe('request_seconds', time.time() - started,
+                                 host=host)
+
+    @staticmethod
+    def _roundtrip(conn, method, target, data, headers):
+        conn.request(method, target, data, headers)
+        return conn.getresponse()
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+
+"""
+Persistent record of the units downloaded to an output directory.
+"""
+
+from __future__ import unicode_literals
+
+import os
+import sqlite3
+import threading
+import time
+
+from collections import namedtuple
+
+from .common import youtube_id
+
+STATE_FILENAME = '.edx-dl-state.sqlite'
+
+PENDING = 'pending'
+COMPLETE = 'complete'
+FAILED = 'failed'
+
+UnitState = namedtuple('UnitState', ['course', 'video_id', 'video_url',
+                                     'sub_url', 'prefix', 'filename', 'size',
+                                     'status', 'created', 'updated'])
+
+# one row per unit: the units of a course that embed the same video have
+# their own files (or links)
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS units (
+    course TEXT NOT NULL,
+    video_id TEXT NOT NULL,
+    video_url TEXT NOT NULL,
+    sub_url TEXT,
+    prefix TEXT NOT NULL,
+    filename TEXT,
+    size INTEGER,
+    status TEXT NOT NULL,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (course, prefix)
+)
+"""
+
+# the first download of each video in each format, path is relative to the
+# output directory
+_VIDEOS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS videos (
+    video_id TEXT NOT NULL,
+    format TEXT NOT NULL,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (video_id, format)
+)
+"""
+
+
+class DownloadState(object):
+    """
+    SQLite store with one row per unit (course, filename prefix) in an
+    output directory.
+
+    course is the name of the course directory, filename is the basename of
+    the video of the unit inside of it. The store can be shared by threads.
+
+    It also records where each video was first downloaded in each format,
+    so that the other units with the same video (in any course of the
+    output directory) can link to it instead of downloading it again.
+    """
+
+    def __init__(self, output_dir):
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+        self.output_dir = output_dir
+        self.path = os.path.join(output_dir, STATE_FILENAME)
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._claims = threading.Condition()
+        self._claimed = set()
+        with self._lock:
+            self._conn.execute(_SCHEMA)
+            self._conn.execute(_VIDEOS_SCHEMA)
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def get(self, course, prefix):
+        """
+        Return the UnitState of the unit of course with the filename prefix,
+        or None if we never saw it.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT * FROM units WHERE course = ? AND prefix = ?',
+                (course, prefix)).fetchone()
+        return UnitState(*row) if row else None
+
+    def units(self, course=None):
+        """
+        Return the UnitState of all the videos (of course if given).
+        """
+        query = 'SELECT * FROM units'
+        params = ()
+        if course is not None:
+            query += ' WHERE course = ?'
+            params = (course,)
+        with self._lock:
+            rows = self._conn.execute(query + ' ORDER BY course, prefix',
+                                      params).fetchall()
+        return [UnitState(*row) for row in rows]
+
+    def completed_file(self, target_dir, prefix, video_id):
+        """
+        Return the basename of the video of the unit with the filename prefix
+        in target_dir if it was completed (with the video video_id) and the
+        file is still there with the same size, None otherwise.
+        """
+        unit_state = self.get(os.path.basename(target_dir), prefix)
+        if (unit_state is None or unit_state.status != COMPLETE or
+                unit_state.video_id != video_id):
+            return None
+        try:
+            size = os.path.getsize(os.path.join(target_dir, unit_state.filename))
+        except (OSError, TypeError):
+            return None
+        return unit_state.filename if size == unit_state.size else None
+
+    def update(self, target_dir, prefix, unit, status, filename=None):
+        """
+        Record the status of unit, downloaded to filename in target_dir.
+        """
+        course = os.path.basename(target_dir)
+        video_id = youtube_id(unit.video_youtube_url)
+        size = None
+        if filename is not None:
+            try:
+                size = os.path.getsize(os.path.join(target_dir, filename))
+            except OSError:
+                pass
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR IGNORE INTO units VALUES '
+                '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (course, video_id, unit.video_youtube_url, unit.sub_url,
+                 prefix, filename, size, status, now, now))
+            self._conn.execute(
+                'UPDATE units SET video_id = ?, video_url = ?, sub_url = ?, '
+                'filename = ?, size = ?, status = ?, updated = ? '
+                'WHERE course = ? AND prefix = ?',
+                (video_id, unit.video_youtube_url, unit.sub_url, filename,
+                 size, status, now, course, prefix))
+            self._conn.commit()
+
+    def set_status(self, course, prefix, status):
+        """
+        Change the status of the unit of course with the filename prefix,
+        e.g. to download it again.
+        """
+        with self._lock:
+            self._conn.execute(
+                'UPDATE units SET status = ?, updated = ? '
+                'WHERE course = ? AND prefix = ?',
+                (status, time.time(), course, prefix))
+            self._conn.commit()
+
+    def stored_video(self, video_id, video_format):
+        """
+        Return the path (relative to the output directory) where the video
+        was downloaded in video_format, None if it was not or if the file is
+        not there anymore with the same size.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT path, size FROM videos '
+                'WHERE video_id = ? AND format = ?',
+                (video_id, video_format)).fetchone()
+        if row is None:
+            return None
+        path, size = row
+        try:
+            if os.path.getsize(os.path.join(self.output_dir, path)) != size:
+                return None
+        except OSError:
+            return None
+        return path
+
+    def store_video(self, video_id, video_format, path):
+        """
+        Record that the video was downloaded in video_format to path.
+        """
+        size = os.path.getsize(path)
+        path = os.path.relpath(path, self.output_dir)
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO videos VALUES (?, ?, ?, ?, ?)',
+                (video_id, video_format, path, size, time.time()))
+            self._conn.commit()
+
+    def forget_video(self, path):
+        """
+        Forget the videos downloaded to path (relative to the output
+        directory), so that they are not linked to anymore.
+        """
+        with self._lock:
+            self._conn.execute('DELETE FROM videos WHERE path = ?', (path,))
+            self._conn.commit()
+
+    def claim_videos(self, keys):
+        """
+        Return a dict with the stored_video path of the (video_id, format)
+        keys that are already downloaded. The others are claimed by the
+        caller, who must call release_videos once it downloaded them: other
+        threads claiming any of them wait until then.
+        """
+        keys = set(keys)
+        with self._claims:
+            # all at once, so that two threads never wait for each other
+            while keys & self._claimed:
+                self._claims.wait()
+            stored = {}
+            for key in keys:
+                path = self.stored_video(*key)
+                if path is not None:
+                    stored[key] = path
+            self._claimed.update(keys.difference(stored))
+        return stored
+
+    def release_videos(self, keys):
+        with self._claims:
+            self._claimed.difference_update(keys)
+            self._claims.notify_all()
@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+
+"""
+Conversion of the edX transcripts (json with the start and end times in
+milliseconds and the text of each cue) to SRT and WebVTT subtitles.
+
+It can also be used to convert transcripts saved to disk:
+
+    python -m edx_dl.subtitles --format vtt transcripts/*.json
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import io
+import json
+import os
+import sys
+import threading
+
+from collections import deque
+from datetime import timedelta
+
+FORMATS = ('srt', 'vtt')
+DEFAULT_LANGUAGES = ('en',)
+DEFAULT_WORKERS = 8
+
+
+def _to_ms(value):
+    """
+    Return the time in integer milliseconds, rounded as the timedelta based
+    conversion did for non integer values. Negative times are taken as 0.
+    """
+    if isinstance(value, int):
+        return max(value, 0)
+    delta = timedelta(seconds=max(value, 0) / 1000.)
+    return (delta.days * 86400 + delta.seconds) * 1000 + delta.microseconds // 1000
+
+
+def iter_cues(transcript):
+    """
+    Yields (index, start_ms, end_ms, text) for each cue of transcript with
+    some text. The index is the position of the cue in the transcript, so
+    it skips the empty cues, as edx-dl always did.
+    """
+    cues = zip(transcript['start'], transcript['end'], transcript['text'])
+    for i, (start, end, text) in enumerate(cues):
+        if text == "":
+            continue
+        yield i, _to_ms(start), _to_ms(end), text
+
+
+def _split_ms(ms):
+    seconds, ms = divmod(ms, 1000)
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    return hours, minutes, seconds, ms
+
+
+def write_srt(transcript, out):
+    """
+    Write transcript as SRT to the text stream out, one cue at a time.
+    """
+    for i, start, end, text in iter_cues(transcript):
+        sh, sm, ss, sms = _split_ms(start)
+        eh, em, es, ems = _split_ms(end)
+        # the hours wrap at 24, as they did when computed with datetime
+        out.write("%d\n%02d:%02d:%02d,%03d --> %02d:%02d:%02d,%03d\n%s\n\n" %
+                  (i, sh % 24, sm, ss, sms, eh % 24, em, es, ems, text))
+
+
+def write_vtt(transcript, out):
+    """
+    Write transcript as WebVTT to the text stream out, one cue at a time.
+    """
+    out.write("WEBVTT\n\n")
+    for i, start, end, text in iter_cues(transcript):
+        text = (text.replace('&', '&amp;').replace('<', '&lt;')
+                .replace('-->', '--&gt;'))
+        out.write("%d\n%02d:%02d:%02d.%03d --> %02d:%02d:%02d.%03d\n%s\n\n" %
+                  ((i,) + _split_ms(start) + _split_ms(end) + (text,)))
+
+
+_WRITERS = {'srt': write_srt, 'vtt': write_vtt}
+
+
+def write_subtitles(transcript, out, fmt='srt'):
+    """
+    Write transcript in the given format ('srt' or 'vtt') to out.
+    """
+    _WRITERS[fmt](transcript, out)
+
+
+class _Chunks(list):
+    """
+    A stream that collects what is written to it, to be joined at the end.
+    """
+    write = list.append
+
+
+def convert(transcript, fmt='srt'):
+    """
+    Return transcript converted to the given format as a string.
+    """
+    out = _Chunks()
+    write_subtitles(transcript, out, fmt)
+    return ''.join(out)
+
+
+def save_subtitles(transcript, filename, fmt='srt'):
+    """
+    Write transcript in the given format to filename (utf-8, with '\\n' line
+    endings on every platform).
+    """
+    with io.open(filename, 'w', encoding='utf-8', newline='') as out:
+        write_subtitles(transcript, out, fmt)
+
+
+def translation_url(sub_url, language):
+    """
+    Return the url of the transcript of sub_url in another language.
+    """
+    path, sep, query = sub_url.partition('?')
+    return path.rsplit('/', 1)[0] + '/' + language + sep + query
+
+
+def subtitles_filename(basename, language, fmt, languages):
+    """
+    Return the filename of the subtitles of the video basename. The
+    language is only part of the name when several languages are used.
+    """
+    if list(languages) == [language]:
+        return '%s.%s' % (basename, fmt)
+    return '%s.%s.%s' % (basename, language, fmt)
+
+
+class SubtitleFetcher(object):
+    """
+    Fetches the transcripts of the units in the background, in one or more
+    languages, so that they are ready by the time their videos are
+    downloaded.
+
+    fetch(url) must return the transcript json object or None.
+    """
+
+    def __init__(self, fetch, languages=DEFAULT_LANGUAGES,
+                 workers=DEFAULT_WORKERS):
+        self.fetch = fetch
+        self.languages = list(languages)
+        from multiprocessing.dummy import Pool as ThreadPool
+        self._pool = ThreadPool(workers)
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def submit(self, key, sub_url):
+        """
+        Start fetching the transcripts of sub_url, to be taken later with
+        transcripts(key, ...).
+        """
+        results = [(language,
+                    self._pool.apply_async(self.fetch,
+                                           (translation_url(sub_url, language),)))
+                   for language in self.languages]
+        with self._lock:
+            self._pending[key] = results
+
+    def prefetch(self, jobs, subtitles_job, window=DEFAULT_WORKERS):
+        """
+        Yields the items of jobs, submitting their transcripts window items
+        before they are yielded. subtitles_job(job) returns the (key,
+        sub_url) to submit for job, or None if it needs no subtitles.
+        """
+        ahead = deque()
+        for job in jobs:
+            submit = subtitles_job(job)
+            if submit is not None:
+                self.submit(*submit)
+            ahead.append(job)
+            if len(ahead) > window:
+                yield ahead.popleft()
+        while ahead:
+            yield ahead.popleft()
+
+    def transcripts(self, key, sub_url, languages=None):
+        """
+        Return a list of (language, transcript) for key, waiting for the
+        transcripts submitted or fetching them now if they were not.
+        """
+        languages = self.languages if languages is None else languages
+        with self._lock:
+            results = dict(self._pending.pop(key, ()))
+        transcripts = []
+        for language in languages:
+            result = results.get(language)
+            if result is not None:
+                transcript = result.get()
+            else:
+                transcript = self.fetch(translation_url(sub_url, language))
+            transcripts.append((language, transcript))
+        return transcripts
+
+    def wait(self):
+        """
+        Wait until all the transcripts submitted are fetched.
+        """
+        with self._lock:
+            pending = [result for results in self._pending.values()
+                       for _, result in results]
+        for result in pending:
+            result.wait()
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+
+def convert_files(filenames, fmt='srt', output_dir=None):
+    """
+    Convert the transcript json files to subtitles next to them (or in
+    output_dir). Returns a list of (filename, subtitles filename, error)
+    where error is None if the conversion worked.
+    """
+    results = []
+    for filename in filenames:
+        basename = os.path.splitext(os.path.basename(filename))[0]
+        directory = output_dir or os.path.dirname(filename)
+        target = os.path.join(directory, basename + '.' + fmt)
+        try:
+            with io.open(filename, encoding='utf-8') as f:
+                transcript = json.load(f)
+            save_subtitles(transcript, target, fmt)
+            results.append((filename, target, None))
+        except (IOError, OSError, ValueError, KeyError) as e:
+            results.append((filename, target, e))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m edx_dl.subtitles',
+                                     description='Convert edX transcripts '
+                                     '(json) to subtitles')
+    parser.add_argument('transcripts', nargs='+',
+                        help='transcript json files')
+    parser.add_argument('-f', '--format', choices=FORMATS, default='srt',
+                        help='subtitles format (default: %(default)s)')
+    parser.add_argument('-o', '--output-dir', dest='output_dir',
+                        help='directory for the subtitles (default: next to '
+                        'each transcript)')
+    args = parser.parse_args()
+
+    failed = 0
+    for filename, target, error in convert_files(args.transcripts,
+                                                 args.format, args.output_dir):
+        if error is None:
+            print('[info] %s -> %s' % (filename, target))
+        else:
+            failed += 1
+            print('[error] %s: %s' % (filename, error))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+
+"""
+Adaptive per-host concurrency control and retry delays for the requests
+made to the OpenEdX platforms, and the bandwidth limit of the run.
+"""
+
+from __future__ import unicode_literals
+
+import random
+import threading
+import time
+
+DEFAULT_MAX_PER_HOST = 8
+DEFAULT_RETRIES = 5
+DEFAULT_BACKOFF = 1.0
+MAX_BACKOFF = 60.0
+
+# statuses that mean that the server is overloaded or throttling us
+THROTTLE_STATUSES = (429, 500, 502, 503, 504)
+
+RATE_SUFFIXES = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+
+
+def parse_retry_after(value):
+    """
+    Return the seconds to wait given by a Retry-After header (either a
+    number of seconds or a HTTP date), or None if it can not be parsed.
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    from email.utils import mktime_tz, parsedate_tz
+    date = parsedate_tz(value)
+    if date is None:
+        return None
+    return max(0.0, mktime_tz(date) - time.time())
+
+
+def parse_rate(value):
+    """
+    Return the bytes per second of a rate such as 500K, 2.5M or 1048576
+    (the syntax of youtube-dl --limit-rate). Raises ValueError if it can
+    not be parsed.
+    """
+    value = value.strip().lower()
+    if value.endswith('/s'):
+        value = value[:-2]
+    if value.endswith('b'):
+        value = value[:-1]
+    suffix = value[-1:] if value[-1:] in RATE_SUFFIXES else ''
+    rate = float(value[:len(value) - len(suffix)]) * RATE_SUFFIXES[suffix]
+    if rate <= 0:
+        raise ValueError('the rate must be positive')
+    return int(rate)
+
+
+def backoff_delay(attempt, base=DEFAULT_BACKOFF, cap=MAX_BACKOFF):
+    """
+    Return the delay before the given retry attempt (0 based): exponential
+    backoff with jitter, so that the threads do not retry in lockstep.
+    """
+    return min(cap, base * 2 ** attempt) * random.uniform(0.5, 1.5)
+
+
+class _HostState(object):
+
+    def __init__(self, limit):
+        self.limit = float(limit)
+        self.inflight = 0
+        self.base_latency = None
+        self.blocked_until = 0.0
+        self.last_decrease = 0.0
+
+
+class AIMDController(object):
+    """
+    Limits the requests in flight to each host, adjusting the limit with
+    additive increase / multiplicative decrease.
+
+    Every fast successful response raises the limit by about one request
+    per round trip, up to maximum. A throttling response (429 or 5xx), or
+    a latency much larger than the best one seen, halves it, down to
+    minimum. A Retry-After from the server blocks the host until then.
+    """
+
+    def __init__(self, initial=4, minimum=1, maximum=16, decrease=0.5,
+                 latency_factor=3.0):
+        self.initial = max(minimum, min(initial, maximum))
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease = decrease
+        self.latency_factor = latency_factor
+        self._hosts = {}
+        self._cond = threading.Condition()
+
+    def limit(self, host):
+        with self._cond:
+            return self._host(host).limit
+
+    def _host(self, host):
+        state = self._hosts.get(host)
+        if state is None:
+            state = self._hosts[host] = _HostState(self.initial)
+        return state
+
+    def acquire(self, host):
+        """
+        Wait until a request can be sent to host.
+        """
+        with self._cond:
+            state = self._host(host)
+            while True:
+                wait = state.blocked_until - time.time()
+                if wait <= 0 and state.inflight < int(state.limit):
+                    break
+                self._cond.wait(wait if wait > 0 else None)
+            state.inflight += 1
+
+    def release(self, host, latency, status=None, retry_after=None):
+        """
+        Record the outcome of a request to host. status is None if the
+        request failed without a response.
+        """
+        now = time.time()
+        with self._cond:
+            state = self._host(host)
+            state.inflight -= 1
+            throttled = status is None or status in THROTTLE_STATUSES
+            slow = False
+            if not throttled:
+                if state.base_latency is None or latency < state.base_latency:
+                    state.base_latency = latency
+                else:
+                    # let the baseline follow slow drifts of the latency
+                    state.base_latency = 0.9 * state.base_latency + 0.1 * latency
+                slow = latency > self.latency_factor * state.base_latency
+            if throttled or slow:
+                # decrease at most once per round trip, one congestion
+                # event is seen by all the requests in flight
+                if now - state.last_decrease > latency:
+                    state.limit = max(self.minimum, state.limit * self.decrease)
+                    state.last_decrease = now
+            else:
+                state.limit = min(self.maximum, state.limit + 1.0 / state.limit)
+            if retry_after:
+                state.blocked_until = max(state.blocked_until, now + retry_after)
+            self._cond.notify_all()
+
+
+class TokenBucket(object):
+    """
+    Limits the bytes per second transferred by all the threads sharing it.
+    Each transfer takes its size in tokens, which refill at rate per second
+    up to burst. The tokens can go negative: the transfer is already done,
+    so the thread waits until the debt is paid, and so do the next ones.
+    """
+
+    def __init__(self, rate, burst=None, clock=time.time, sleep=time.sleep):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.clock = clock
+        self.sleep = sleep
+        self._tokens = self.burst
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def consume(self, amount):
+        """
+        Take amount tokens, then wait as long as the bucket is in debt.
+        Returns how long it waited.
+        """
+        with self._lock:
+            now = self.clock()
+            self._tokens = min(self.burst, self._tokens +
+                               (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= amount
+            wait = max(0.0, -self._tokens / self.rate)
+        if wait > 0:
+            self.sleep(wait)
+        return wait
@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+
+"""
+Verification of the videos already downloaded to an output directory.
+
+The course directories are walked and their files matched with the units
+of the state store by filename prefix. The sizes of the videos are checked
+against the ones recorded when they were downloaded (or probed, see
+formats.FormatCache), and their contents are hashed (memory mapped, a chunk
+at a time, in a pool of processes) and compared with the hashes of the
+previous verification, kept in a manifest in the output directory. The
+videos that are missing, corrupt or left by an interrupted download are
+queued to be downloaded again; their files are kept, renamed out of the way
+of the new download (the partial downloads are resumed).
+"""
+
+from __future__ import unicode_literals
+
+import hashlib
+import json
+import mmap
+import os
+import time
+
+from collections import namedtuple
+
+from .backends import is_partial, is_video
+from .cache import atomic_write
+from .state import COMPLETE, PENDING
+
+MANIFEST_FILENAME = '.edx-dl-manifest.json'
+MANIFEST_VERSION = 1
+
+CHUNK_SIZE = 16 * 1024 * 1024
+
+# appended to the name of a corrupt video by requeue
+CORRUPT_SUFFIX = '.corrupt'
+
+# path is relative to the output directory, unit is the UnitState of the
+# video (None for a file that the state store never saw)
+Problem = namedtuple('Problem', ['path', 'unit', 'reason'])
+
+VerifyReport = namedtuple('VerifyReport', ['checked', 'hashed', 'problems'])
+
+
+def hash_file(path, chunk_size=CHUNK_SIZE):
+    """
+    Return the sha256 hex digest of the file at path. The file is memory
+    mapped and hashed chunk_size bytes at a time, so it is never read into
+    memory as a whole.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:  # empty files can not be mapped
+            return digest.hexdigest()
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if hasattr(mapped, 'madvise'):
+                mapped.madvise(mmap.MADV_SEQUENTIAL)
+            for offset in range(0, size, chunk_size):
+                digest.update(mapped[offset:offset + chunk_size])
+        finally:
+            mapped.close()
+    return digest.hexdigest()
+
+
+def _hash(path):
+    # runs in the worker processes of hash_files
+    try:
+        return path, hash_file(path)
+    except (IOError, OSError, ValueError):
+        return path, None
+
+
+def hash_files(paths, processes=None):
+    """
+    Return a dict with the sha256 hex digest of the files by path (None if
+    a file could not be read), hashed by a pool of processes (one per CPU
+    by default).
+    """
+    paths = list(paths)
+    if processes == 1 or len(paths) < 2:
+        return dict(_hash(path) for path in paths)
+    import multiprocessing
+    pool = multiprocessing.Pool(min(processes or multiprocessing.cpu_count(),
+                                    len(paths)))
+    try:
+        return dict(pool.imap_unordered(_hash, paths))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def manifest_path(output_dir):
+    return os.path.join(output_dir, MANIFEST_FILENAME)
+
+
+def load_manifest(output_dir):
+    """
+    Return the files of the manifest of output_dir, a dict with their
+    size, mtime, sha256 and the time they were verified by relative path.
+    """
+    try:
+        with open(manifest_path(output_dir), 'rb') as f:
+            data = json.loads(f.read().decode('utf-8'))
+    except (IOError, OSError, ValueError):
+        return {}
+    if data.get('version') != MANIFEST_VERSION:
+        return {}
+    return data['files']
+
+
+def save_manifest(output_dir, files):
+    data = {'version': MANIFEST_VERSION, 'files': files}
+    atomic_write(manifest_path(output_dir),
+                 json.dumps(data, indent=1, sort_keys=True).encode('utf-8'))
+
+
+def _walk(output_dir):
+    """
+    Yield the (course, prefix, name) of the videos of the course directories
+    of output_dir and of what the interrupted downloads left, the files
+    whose name starts with a filename prefix. The hidden files (the state
+    and the manifest) and directories and the files set aside by requeue
+    are skipped.
+    """
+    for course in sorted(os.listdir(output_dir)):
+        directory = os.path.join(output_dir, course)
+        if course.startswith('.') or not os.path.isdir(directory):
+            continue
+        for name in sorted(os.listdir(directory)):
+            prefix = name.split('-', 1)[0]
+            if (prefix.isdigit() and CORRUPT_SUFFIX not in name and
+                    (is_video(name) or is_partial(name))):
+                yield course, prefix, name
+
+
+def probed_size(info, name):
+    """
+    Return the size of the smallest probed format with a video of the
+    extension of the file name, the least that the complete video can
+    have, or None if it is not known. info is the VideoInfo of the video.
+    """
+    ext = os.path.splitext(name)[1][1:]
+    sizes = [f.size for f in info.formats
+             if f.ext == ext and f.has_video and f.size]
+    return min(sizes) if sizes else None
+
+
+def verify_tree(state, processes=None, refresh=False, formats=None):
+    """
+    Verify the videos of the output directory of the DownloadState state
+    and update its manifest. The videos of the units that are not complete
+    and the partial downloads are reported as they are; the others are
+    checked, also the ones that state never saw (e.g. downloaded by an
+    older edx-dl). The sizes of the videos without a recorded size are
+    checked against the probed ones in the FormatCache formats, if given.
+    Only the videos whose size or mtime changed since the last verification
+    are hashed again, all of them with refresh set. Returns a VerifyReport.
+    """
+    output_dir = state.output_dir
+    manifest = load_manifest(output_dir)
+    recorded = dict(((unit.course, unit.prefix), unit)
+                    for unit in state.units())
+    units = {}
+    problems = []
+    for course, prefix, name in _walk(output_dir):
+        path = os.path.join(course, name)
+        unit = recorded.get((course, prefix))
+        if unit is not None and unit.status == COMPLETE:
+            continue  # its recorded video is checked below
+        if is_partial(name):
+            problems.append(Problem(path, unit, 'partial download'))
+        elif unit is not None:
+            problems.append(Problem(path, unit, 'download ' + unit.status))
+        else:
+            units[path] = None
+    for unit in recorded.values():
+        if unit.status == COMPLETE and unit.filename:
+            units[os.path.join(unit.course, unit.filename)] = unit
+    stats = {}
+    for path, unit in sorted(units.items()):
+        try:
+            stats[path] = os.stat(os.path.join(output_dir, path))
+        except OSError:  # also a broken symbolic link
+            problems.append(Problem(path, unit, 'missing'))
+
+    digests = {}
+    to_hash = {}
+    for path, stat in sorted(stats.items()):
+        unit = units[path]
+        size = unit.size if unit is not None else None
+        probed = None
+        if size is None and unit is not None and formats is not None:
+            info = formats.get(unit.video_id)
+            if info is not None:
+                probed = probed_size(info, path)
+        if stat.st_size == 0:
+            problems.append(Problem(path, unit, 'empty'))
+        elif size is not None and stat.st_size != size:
+            problems.append(Problem(path, unit, '%d bytes instead of %d' %
+                                    (stat.st_size, size)))
+        elif probed is not None and stat.st_size < probed:
+            problems.append(Problem(path, unit,
+                                    '%d bytes, the video has at least %d' %
+                                    (stat.st_size, probed)))
+        else:
+            entry = manifest.get(path)
+            if (not refresh and entry is not None and
+                    entry['size'] == stat.st_size and
+                    entry['mtime'] == stat.st_mtime):
+                digests[path] = entry['sha256']
+            else:
+                # hard links to the same video are hashed once
+                to_hash.setdefault((stat.st_dev, stat.st_ino), []).append(path)
+    hashed = hash_files([os.path.join(output_dir, paths[0])
+                         for paths in to_hash.values()], processes)
+    for paths in to_hash.values():
+        for path in paths:
+            digests[path] = hashed[os.path.join(output_dir, paths[0])]
+
+    now = time.time()
+    files = {}
+    for path, digest in sorted(digests.items()):
+        unit = units[path]
+        entry = manifest.get(path)
+        if digest is None:
+            problems.append(Problem(path, unit, 'unreadable'))
+            continue
+        if (entry is not None and entry['sha256'] != digest and
+                entry['size'] == stats[path].st_size and
+                (unit is None or unit.updated < entry['verified'])):
+            # same size, different contents and not downloaded again
+            problems.append(Problem(path, unit, 'contents changed'))
+            continue
+        files[path] = {'size': stats[path].st_size,
+                       'mtime': stats[path].st_mtime,
+                       'sha256': digest, 'verified': now}
+    save_manifest(output_dir, files)
+    problems.sort(key=lambda problem: problem.path)
+    return VerifyReport(checked=len(stats), hashed=len(to_hash),
+                        problems=problems)
+
+
+def _set_aside(path):
+    # rename path to the first free path.corrupt, path.corrupt.1, ...
+    target = path + CORRUPT_SUFFIX
+    i = 0
+    while os.path.lexists(target):
+        i += 1
+        target = '%s%s.%d' % (path, CORRUPT_SUFFIX, i)
+    os.rename(path, target)
+    return target
+
+
+def requeue(state, problems):
+    """
+    Mark the units of the problems as pending, so that the next run
+    downloads them again. Nothing is removed: the videos that are still
+    there are renamed to FILE.corrupt, since youtube-dl would take them as
+    already downloaded. The partial downloads are kept for youtube-dl to
+    resume them.
+    """
+    for problem in problems:
+        path = os.path.join(state.output_dir, problem.path)
+        if os.path.lexists(path) and not is_partial(path):
+            _set_aside(path)
+        state.forget_video(problem.path)
+        if problem.unit is not None:
+            state.set_status(problem.unit.course, problem.unit.prefix,
+                             PENDING)
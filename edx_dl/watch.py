@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+"""
+Schedule and status of --watch, which keeps downloading the new videos of
+the courses at regular intervals.
+"""
+
+from __future__ import unicode_literals
+
+import json
+import math
+import os
+import random
+import time
+
+from .cache import atomic_write
+
+# the intervals vary by this fraction either way, so that several watchers
+# (or cron jobs) started together do not all poll the platform at once
+DEFAULT_JITTER = 0.1
+
+INTERVAL_SUFFIXES = {'': 1, 's': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def parse_interval(value):
+    """
+    Return the seconds of an interval such as 90, 30m, 6h or 1d. Raises
+    ValueError if it can not be parsed.
+    """
+    value = value.strip().lower()
+    suffix = value[-1:] if value[-1:] in INTERVAL_SUFFIXES else ''
+    seconds = (float(value[:len(value) - len(suffix)]) *
+               INTERVAL_SUFFIXES[suffix])
+    if math.isnan(seconds) or math.isinf(seconds):
+        raise ValueError('the interval must be finite')
+    if seconds <= 0:
+        raise ValueError('the interval must be positive')
+    return seconds
+
+
+def jittered(interval, jitter=DEFAULT_JITTER):
+    """
+    Return interval, randomly longer or shorter by up to jitter of it.
+    """
+    return interval * random.uniform(1 - jitter, 1 + jitter)
+
+
+class WatchStatus(object):
+    """
+    The status of a --watch run, written as JSON to path (unless it is
+    None) each time it changes: the state (syncing, idle or stopped), when
+    the last sync ended and how long it took, when the next one is due and
+    the queue depth, the videos that are still to be downloaded.
+    """
+
+    def __init__(self, path, interval):
+        self.path = path
+        self.data = {
+            'pid': os.getpid(),
+            'started': time.time(),
+            'interval': interval,
+            'state': 'starting',
+            'syncs': 0,
+            'sync_started': None,
+            'last_sync': None,
+            'last_sync_seconds': None,
+            'next_sync': None,
+            'queue_depth': 0,
+            'downloaded': 0,
+            'failed': 0,
+            'last_error': None,
+        }
+
+    def syncing(self):
+        self.update(state='syncing', sync_started=time.time(),
+                    next_sync=None)
+
+    def synced(self, downloaded, failed, queue_depth, error=None):
+        """
+        Record the end of a sync, which downloaded and failed to download
+        some videos and left queue_depth of them to download.
+        """
+        now = time.time()
+        self.update(state='idle', syncs=self.data['syncs'] + 1,
+                    last_sync=now,
+                    last_sync_seconds=now - self.data['sync_started'],
+                    queue_depth=queue_depth,
+                    downloaded=self.data['downloaded'] + downloaded,
+                    failed=self.data['failed'] + failed, last_error=error)
+
+    def update(self, **values):
+        self.data.update(values)
+        if self.path is not None:
+            atomic_write(self.path, json.dumps(self.data, indent=1,
+                                               sort_keys=True).encode('utf-8'))
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+
+"""
+Work queue shared by the processes that mirror the same courses, possibly
+on several machines (with the queue on shared storage): a crawl adds the
+units of the courses and any number of workers claim them, download them
+and mark them done.
+
+A claimed unit is leased to its worker for a while, and the worker renews
+the leases of the units it is downloading. The units of a worker that
+crashed are claimed again by the others once their lease expires.
+"""
+
+from __future__ import unicode_literals
+
+import os
+import threading
+import time
+
+from collections import namedtuple
+from contextlib import contextmanager
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+# seconds a claimed unit stays with its worker without being renewed
+DEFAULT_LEASE = 600
+# claims of a unit before it is given up as failed
+DEFAULT_ATTEMPTS = 3
+
+QueuedUnit = namedtuple('QueuedUnit', ['id', 'site', 'course_id',
+                                       'directory', 'prefix', 'video_url',
+                                       'sub_url', 'attempts'])
+
+# directory is the course directory in the output directory of the workers
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS units (
+    id INTEGER PRIMARY KEY,
+    site TEXT NOT NULL,
+    course_id TEXT NOT NULL,
+    directory TEXT NOT NULL,
+    prefix TEXT NOT NULL,
+    video_url TEXT NOT NULL,
+    sub_url TEXT,
+    status TEXT NOT NULL,
+    worker TEXT,
+    expires REAL,
+    attempts INTEGER NOT NULL,
+    updated REAL NOT NULL,
+    UNIQUE (directory, prefix)
+)
+"""
+
+_COLUMNS = ('id, site, course_id, directory, prefix, video_url, sub_url, '
+            'attempts')
+
+
+class WorkQueue(object):
+    """
+    SQLite store of the units to download, safe to share by threads and
+    processes. The file locks of SQLite must work on the storage shared by
+    several machines (they do not on some network filesystems).
+
+    A unit is claimed at most attempts times: when its last worker fails
+    or crashes it is marked as failed.
+    """
+
+    def __init__(self, path, attempts=DEFAULT_ATTEMPTS, timeout=60):
+        # imported here, edx-dl reads DEFAULT_LEASE on every run
+        import sqlite3
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.path = path
+        self.attempts = attempts
+        # the transactions are explicit: BEGIN IMMEDIATE takes the write
+        # lock before looking for a unit to claim, so that no other process
+        # claims the same one
+        self._conn = sqlite3.connect(path, timeout=timeout,
+                                     isolation_level=None,
+                                     check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._transaction() as conn:
+            conn.execute(_SCHEMA)
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+            self._conn.execute('COMMIT')
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def add(self, site, course_id, directory, jobs):
+        """
+        Queue the (filename_prefix, unit) jobs of course_id of site, to be
+        downloaded to directory. The units already queued are kept as they
+        are, unless their video changed or they failed: they are queued
+        again. Returns the number of units queued.
+        """
+        now = time.time()
+        queued = 0
+        with self._transaction() as conn:
+            for prefix, unit in jobs:
+                row = conn.execute(
+                    'SELECT video_url, sub_url, status FROM units '
+                    'WHERE directory = ? AND prefix = ?',
+                    (directory, prefix)).fetchone()
+                if row is None:
+                    conn.execute(
+                        'INSERT INTO units (site, course_id, directory, '
+                        'prefix, video_url, sub_url, status, attempts, '
+                        'updated) VALUES (?, ?, ?, ?, ?, ?, ?, 0, ?)',
+                        (site, course_id, directory, prefix,
+                         unit.video_youtube_url, unit.sub_url, PENDING, now))
+                elif (row[2] == FAILED or
+                      tuple(row[:2]) != (unit.video_youtube_url,
+                                         unit.sub_url)):
+                    conn.execute(
+                        'UPDATE units SET site = ?, course_id = ?, '
+                        'video_url = ?, sub_url = ?, status = ?, '
+                        'worker = NULL, expires = NULL, attempts = 0, '
+                        'updated = ? WHERE directory = ? AND prefix = ?',
+                        (site, course_id, unit.video_youtube_url,
+                         unit.sub_url, PENDING, now, directory, prefix))
+                else:
+                    continue
+                queued += 1
+        return queued
+
+    def claim(self, worker, lease=DEFAULT_LEASE):
+        """
+        Lease the next pending unit (or one whose lease expired) to worker
+        for lease seconds. Returns its QueuedUnit, or None if there is none
+        to claim right now.
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            while True:
+                row = conn.execute(
+                    'SELECT ' + _COLUMNS + ' FROM units WHERE status = ? '
+                    'OR (status = ? AND expires < ?) ORDER BY id LIMIT 1',
+                    (PENDING, LEASED, now)).fetchone()
+                if row is None:
+                    return None
+                unit = QueuedUnit(*row)
+                if unit.attempts >= self.attempts:
+                    # its workers crashed every time
+                    conn.execute(
+                        'UPDATE units SET status = ?, expires = NULL, '
+                        'updated = ? WHERE id = ?', (FAILED, now, unit.id))
+                    continue
+                conn.execute(
+                    'UPDATE units SET status = ?, worker = ?, expires = ?, '
+                    'attempts = attempts + 1, updated = ? WHERE id = ?',
+                    (LEASED, worker, now + lease, now, unit.id))
+                return unit._replace(attempts=unit.attempts + 1)
+
+    def renew(self, worker, lease=DEFAULT_LEASE):
+        """
+        Extend the leases of all the units claimed by worker by lease
+        seconds from now. Returns the number of units it holds.
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            return conn.execute(
+                'UPDATE units SET expires = ? WHERE status = ? AND worker = ?',
+                (now + lease, LEASED, worker)).rowcount
+
+    def finish(self, unit, worker, ok):
+        """
+        Mark the claimed unit as done, or as pending again if it failed
+        (failed if it was its last attempt). Returns False if worker had
+        lost its lease, in which case nothing is changed.
+        """
+        if ok:
+            status = DONE
+        elif unit.attempts >= self.attempts:
+            status = FAILED
+        else:
+            status = PENDING
+        with self._transaction() as conn:
+            return conn.execute(
+                'UPDATE units SET status = ?, worker = ?, expires = NULL, '
+                'updated = ? WHERE id = ? AND status = ? AND worker = ?',
+                (status, worker if status != PENDING else None, time.time(),
+                 unit.id, LEASED, worker)).rowcount == 1
+
+    def release(self, unit, worker):
+        """
+        Give the claimed unit back without counting the attempt, e.g. when
+        the worker can not log in to its platform.
+        """
+        with self._transaction() as conn:
+            conn.execute(
+                'UPDATE units SET status = ?, worker = NULL, expires = NULL, '
+                'attempts = attempts - 1, updated = ? '
+                'WHERE id = ? AND status = ? AND worker = ?',
+                (PENDING, time.time(), unit.id, LEASED, worker))
+
+    def counts(self):
+        """
+        Return the number of units in each status.
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT status, COUNT(*) FROM units GROUP BY status').fetchall()
+        counts = dict((status, 0) for status in (PENDING, LEASED, DONE,
+                                                 FAILED))
+        counts.update(rows)
+        return counts
+
+    def unfinished(self):
+        """
+        Return the number of units that are pending or leased.
+        """
+        counts = self.counts()
+        return counts[PENDING] + counts[LEASED]
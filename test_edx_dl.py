@@ -1,20 +1,1107 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import io
+import json
+import multiprocessing
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
 import unittest
 
-from edx_dl import edx_dl
+from benchmarks.server import PASSWORD, USERNAME, Platform, StandInServer
+from edx_dl import backends, edx_dl
+from edx_dl.cache import ResponseCache
+from edx_dl.common import Course, Section, SubSection, Unit, youtube_id
+from edx_dl.formats import Format, FormatCache, VideoInfo, choose_format
+from edx_dl.formats import fit_budget
+from edx_dl.index import CourseIndex, load_course_list, save_course_list
+from edx_dl.metrics import Metrics, prometheus_lines
+from edx_dl.parsing import CourseParser, SectionParser, UnitParser
+from edx_dl.parsing import ParsePool, extract_units, parse_chunks
+from edx_dl.priority import order_jobs, parse_priority
+from edx_dl.runner import ProcessRunner
+from edx_dl.session import Session
+from edx_dl import subtitles
+from edx_dl.state import STATE_FILENAME, DownloadState
+from edx_dl.throttle import AIMDController, TokenBucket, parse_rate
+from edx_dl.throttle import parse_retry_after
+from edx_dl.verify import hash_file, requeue, verify_tree
+from edx_dl.watch import WatchStatus, jittered, parse_interval
+from edx_dl.workqueue import WorkQueue
+
+
+def stand_in_site(server):
+    return edx_dl.Site(name='stand-in', url=server.url,
+                       login_api=server.url + '/login_ajax',
+                       dashboard=server.url + '/dashboard',
+                       courseware_selector=None)
+
+
+def log_in(server, session):
+    # returns the headers of the requests to the stand-in platform
+    site = stand_in_site(server)
+    headers = edx_dl.edx_get_headers(session, site)
+    resp = edx_dl.edx_login(site.login_api, headers, USERNAME, PASSWORD,
+                            session)
+    assert resp.get('success'), resp
+    return headers
+
+
+def drain_queue(path, worker, crash=False):
+    # a worker process of test_work_queue_processes
+    queue = WorkQueue(path)
+    if crash:
+        queue.claim(worker, lease=0.5)
+        os._exit(1)
+    while True:
+        unit = queue.claim(worker, lease=0.5)
+        if unit is None:
+            if not queue.unfinished():
+                break
+            time.sleep(0.05)
+            continue
+        queue.finish(unit, worker, True)
+    queue.close()
+
+
+class FakeYoutubeDL(object):
+    """
+    Stands in for execute_command: writes the videos of the youtube-dl
+    commands (their url is their contents) and prints their destination.
+    The videos in failed are not downloaded, those in interrupted only half.
+    """
+
+    def __init__(self, failed=(), interrupted=()):
+        self.failed = failed
+        self.interrupted = interrupted
+        self.commands = []
+        self._lock = threading.Lock()
+
+    def __call__(self, cmd, echo=True, name=None):
+        template = cmd[cmd.index('-o') + 1]
+        returncode = 0
+        output = ''
+        for url in cmd[cmd.index('-o') + 2:]:
+            if not url.startswith('http://youtube.com/'):
+                continue
+            video_id = youtube_id(url)
+            if video_id in self.failed:
+                returncode = 1
+                continue
+            filename = template % {'id': video_id, 'title': 'video',
+                                   'ext': 'mp4'}
+            data = url.encode('utf-8')
+            if video_id in self.interrupted:
+                data = data[:len(data) // 2]
+                returncode = 1
+            else:
+                output += '[download] Destination: %s\n' % filename
+            with self._lock:
+                if not os.path.isdir(os.path.dirname(filename)):
+                    os.makedirs(os.path.dirname(filename))
+            with open(filename, 'wb') as f:
+                f.write(data)
+        with self._lock:
+            self.commands.append(cmd)
+        return returncode, output.encode('utf-8')
+
 
 class TestEdX(unittest.TestCase):
 
     def setUp(self):
         return
 
+    def temp_dir(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        return directory
+
+    def parse_args(self, *options):
+        # the arguments of edx-dl run with options, its cache is in a
+        # temporary directory unless they give one
+        return edx_dl.parse_args(['--cache-dir', self.temp_dir()] +
+                                 list(options))
+
+    def fake_youtube_dl(self, **kwargs):
+        # runs the FakeYoutubeDL in place of youtube-dl until the test ends
+        fake = FakeYoutubeDL(**kwargs)
+        original = edx_dl.execute_command
+        edx_dl.execute_command = fake
+        self.addCleanup(setattr, edx_dl, 'execute_command', original)
+        return fake
+
     def test_failed_login(self):
         resp = edx_dl.edx_login(
             edx_dl.LOGIN_API, edx_dl.edx_get_headers(), "guest", "guest")
         self.assertFalse(resp.get('success', False))
 
+    def test_parallel_downloads_keep_numbering(self):
+        fake = self.fake_youtube_dl(failed=('3',))
+        units = [edx_dl.Unit(video_youtube_url='http://youtube.com/watch?v=%d' % i,
+                             sub_url=None) for i in range(1, 13)]
+        args = self.parse_args('-j', '4')
+        results = edx_dl.download_units(units, self.temp_dir(), args, {})
+
+        self.assertEqual(len(fake.commands), 12)
+        self.assertEqual([r.prefix for r in results],
+                         [str(i).zfill(2) for i in range(1, 13)])
+        self.assertEqual([r.unit for r in results], units)
+        self.assertEqual([r.prefix for r in results if r.returncode], ['03'])
+
+    def test_response_cache_evicts_least_recently_used(self):
+        directory = self.temp_dir()
+        cache = ResponseCache(directory, identity='edx:guest', max_size=3500)
+        now = time.time()
+        for i, url in enumerate(['a', 'b', 'c']):
+            cache.put(url, b'x' * 1000, etag='"%d"' % i)
+            # mtime resolution can be coarse on some filesystems
+            os.utime(cache._path(url), (now - 100 + i, now - 100 + i))
+        os.utime(cache._path('a'), (now - 10, now - 10))
+        cache.put('d', b'x' * 1000)
+
+        self.assertEqual(cache.get('a').etag, '"0"')
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('c'))
+        self.assertIsNone(ResponseCache(directory, 'edx:other').get('a'))
+
+    def test_completed_units_are_not_downloaded_again(self):
+        directory = self.temp_dir()
+        target_dir = os.path.join(directory, 'course')
+        fake = self.fake_youtube_dl()
+        units = [edx_dl.Unit(video_youtube_url='http://youtube.com/watch?v=%d' % i,
+                             sub_url=None) for i in range(1, 4)]
+        args = self.parse_args()
+        for _ in range(2):
+            state = DownloadState(directory)
+            results = edx_dl.download_units(units, target_dir, args, {},
+                                            state=state)
+            state.close()
+
+        self.assertEqual(len(fake.commands), 3)
+        self.assertTrue(all(r.skipped for r in results))
+        self.assertEqual(results[1].filename, '02-video.mp4')
+
+    def test_duplicate_videos_are_linked(self):
+        directory = self.temp_dir()
+        fake = self.fake_youtube_dl()
+        get_filename = edx_dl.get_filename
+        try:
+            units = [edx_dl.Unit(video_youtube_url='http://youtube.com/watch?v=%s' % i,
+                                 sub_url=None) for i in 'abab']
+            args = self.parse_args('-j', '2', '--dedup', 'hardlink')
+            state = DownloadState(directory)
+            results = edx_dl.download_units(
+                units, os.path.join(directory, 'one'), args, {}, state=state)
+            other = edx_dl.download_units(
+                units[1:2], os.path.join(directory, 'two'), args, {},
+                state=state)
+            # each unit has its own row, the next run finds their files
+            # without looking in the directory
+            self.assertEqual([(u.prefix, u.filename)
+                              for u in state.units('one')],
+                             [('0%d' % i, '0%d-video.mp4' % i)
+                              for i in range(1, 5)])
+            edx_dl.get_filename = None
+            again = edx_dl.download_units(
+                units, os.path.join(directory, 'one'), args, {}, state=state)
+            self.assertEqual([(r.skipped, r.filename) for r in again],
+                             [(True, '0%d-video.mp4' % i)
+                              for i in range(1, 5)])
+            state.close()
+        finally:
+            edx_dl.get_filename = get_filename
+
+        self.assertEqual(sorted(cmd[-1] for cmd in fake.commands),
+                         ['http://youtube.com/watch?v=a',
+                          'http://youtube.com/watch?v=b'])
+        self.assertEqual([r.duplicate_of for r in results + other],
+                         [None, None, os.path.join('one', '01-video.mp4'),
+                          os.path.join('one', '02-video.mp4'),
+                          os.path.join('one', '02-video.mp4')])
+        linked = os.path.join(directory, 'two', '01-video.mp4')
+        self.assertEqual(open(linked, 'rb').read(),
+                         b'http://youtube.com/watch?v=b')
+        self.assertEqual(os.stat(linked).st_nlink, 3)
+
+    def test_verify_finds_changed_videos(self):
+        directory = self.temp_dir()
+        target_dir = os.path.join(directory, 'course')
+        os.makedirs(target_dir)
+        state = DownloadState(directory)
+        self.addCleanup(state.close)
+        for i, data in enumerate([b'abc', b'def', b'ghi'], 1):
+            filename = '0%d-video.mp4' % i
+            with open(os.path.join(target_dir, filename), 'wb') as f:
+                f.write(data)
+            state.update(target_dir, '0%d' % i,
+                         Unit(video_youtube_url='http://youtube.com/watch?v=%d' % i,
+                              sub_url=None),
+                         'complete', filename)
+        # files that are not videos of the units are not checked
+        for filename in ('mine.mp4', '01-video.en.srt'):
+            open(os.path.join(target_dir, filename), 'wb').close()
+        self.assertEqual(hash_file(os.path.join(target_dir, '01-video.mp4'),
+                                   chunk_size=2),
+                         'ba7816bf8f01cfea414140de5dae2223'
+                         'b00361a396177a9cb410ff61f20015ad')
+        self.assertEqual(verify_tree(state, processes=1).problems, [])
+
+        with open(os.path.join(target_dir, '01-video.mp4'), 'wb') as f:
+            f.write(b'ab')
+        with open(os.path.join(target_dir, '02-video.mp4'), 'wb') as f:
+            f.write(b'xyz')
+        report = verify_tree(state, processes=2)
+        self.assertEqual([(p.path, p.reason) for p in report.problems],
+                         [(os.path.join('course', '01-video.mp4'),
+                           '2 bytes instead of 3'),
+                          (os.path.join('course', '02-video.mp4'),
+                           'contents changed')])
+        requeue(state, report.problems)
+        self.assertEqual(sorted(os.listdir(target_dir)),
+                         ['01-video.en.srt', '01-video.mp4.corrupt',
+                          '02-video.mp4.corrupt', '03-video.mp4',
+                          'mine.mp4'])
+        self.assertEqual([u.status for u in state.units()],
+                         ['pending', 'pending', 'complete'])
+
+    def test_verify_finds_interrupted_downloads(self):
+        directory = self.temp_dir()
+        target_dir = os.path.join(directory, 'course')
+        # the download of v=2 is interrupted half way
+        self.fake_youtube_dl(interrupted=('2',))
+        state = DownloadState(directory)
+        self.addCleanup(state.close)
+        units = [Unit('http://youtube.com/watch?v=%d' % i, None)
+                 for i in (1, 2)]
+        edx_dl.download_units(units, target_dir, self.parse_args(), {},
+                              state=state)
+        # a partial download of a unit the state never saw, and videos of
+        # an older edx-dl
+        for name, size in (('03-video.mp4.part', 10), ('04-old.mp4', 10),
+                           ('05-old.mp4', 0)):
+            with open(os.path.join(target_dir, name), 'wb') as f:
+                f.write(b'x' * size)
+        # no size was recorded for the first video, it was probed
+        conn = sqlite3.connect(os.path.join(directory, STATE_FILENAME))
+        conn.execute("UPDATE units SET size = NULL WHERE prefix = '01'")
+        conn.commit()
+        conn.close()
+        formats = FormatCache(os.path.join(directory, '.formats'))
+        formats.put(VideoInfo('1', 'video', 60, [
+            Format('18', 'mp4', 360, True, True, 150),
+            Format('140', 'm4a', None, False, True, 20)]))
+
+        report = verify_tree(state, processes=1, formats=formats)
+        self.assertEqual(report.checked, 3)
+        self.assertEqual([(p.path, p.reason) for p in report.problems], [
+            (os.path.join('course', '01-video.mp4'),
+             '28 bytes, the video has at least 150'),
+            (os.path.join('course', '02-video.mp4'), 'download failed'),
+            (os.path.join('course', '03-video.mp4.part'), 'partial download'),
+            (os.path.join('course', '05-old.mp4'), 'empty')])
+        requeue(state, report.problems)
+        self.assertEqual(sorted(os.listdir(target_dir)),
+                         ['01-video.mp4.corrupt', '02-video.mp4.corrupt',
+                          '03-video.mp4.part', '04-old.mp4',
+                          '05-old.mp4.corrupt'])
+        self.assertEqual([u.status for u in state.units()],
+                         ['pending', 'pending'])
+        self.assertEqual(verify_tree(state, processes=1,
+                                     formats=formats).problems[0].reason,
+                         'partial download')
+
+    def test_batch_backend_keeps_filenames(self):
+        target_dir = self.temp_dir()
+        fake = self.fake_youtube_dl(failed=('missing',))
+        ids = ['a', 'b', 'missing', 'a', 'c']
+        units = [edx_dl.Unit(video_youtube_url='http://youtube.com/watch?v=' + i,
+                             sub_url=None) for i in ids]
+        args = self.parse_args('--backend', 'batch', '--batch-size', '4')
+        results = edx_dl.download_units(units, target_dir, args, {})
+        filenames = sorted(os.listdir(target_dir))
+
+        self.assertEqual(len(fake.commands), 2)
+        self.assertEqual([r.filename for r in results],
+                         ['01-video.mp4', '02-video.mp4', None,
+                          '04-video.mp4', '05-video.mp4'])
+        self.assertEqual([r.returncode for r in results], [0, 0, 1, 0, 0])
+        self.assertEqual(filenames, ['01-video.mp4', '02-video.mp4',
+                                     '04-video.mp4', '05-video.mp4'])
+
+    def test_library_backend_reports_failures(self):
+        target_dir = self.temp_dir()
+        params = []
+
+        class DownloadError(Exception):
+            pass
+
+        class YoutubeDL(object):
+            # downloads v=ok, reports a file it did not write for v=gone
+            def __init__(self, options):
+                params.append(options)
+                self.options = options
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc_info):
+                return False
+
+            def extract_info(self, url):
+                video_id = url.rsplit('v=', 1)[-1]
+                if video_id == 'private':
+                    raise DownloadError('private video')
+                if video_id == 'crash':
+                    raise KeyError('formats')
+                if video_id == 'ok':
+                    open(self.prepare_filename({}), 'wb').write(b'data')
+                return {'id': video_id}
+
+            def prepare_filename(self, info):
+                return self.options['outtmpl'] % {'title': 'video',
+                                                  'ext': 'mp4'}
+
+        stub = types.ModuleType(str('youtube_dl'))
+        stub.YoutubeDL = YoutubeDL
+        stub.utils = types.ModuleType(str('youtube_dl.utils'))
+        stub.utils.DownloadError = DownloadError
+        requests = [backends.DownloadRequest(
+            'http://youtube.com/watch?v=' + video_id, target_dir, prefix,
+            'mp4', False)
+            for prefix, video_id in (('01', 'ok'), ('02', 'private'),
+                                     ('03', 'crash'), ('04', 'gone'))]
+
+        original = backends._youtube_dl, sys.stderr
+        backends._youtube_dl = stub
+        sys.stderr = io.StringIO()
+        try:
+            results = backends._library_download(requests, False, rate=1000)
+            errors = sys.stderr.getvalue()
+        finally:
+            backends._youtube_dl, sys.stderr = original
+
+        self.assertEqual(results, [(0, '01-video.mp4'), (1, None), (1, None),
+                                   (0, None)])
+        # youtube_dl reports its own errors, the others are written
+        self.assertEqual(errors, "ERROR: http://youtube.com/watch?v=crash: "
+                                 "'formats'\n")
+        self.assertEqual(params[0]['outtmpl'],
+                         os.path.join(target_dir, '01-%(title)s.%(ext)s'))
+        self.assertEqual([p['ratelimit'] for p in params], [1000] * 4)
+        self.assertTrue(all(p['quiet'] for p in params))
+
+    def test_formats_fit_budget(self):
+        mb = 1024 * 1024
+
+        def video(video_id, scale):
+            return VideoInfo(video_id=video_id, title=video_id, duration=60,
+                             formats=[Format('17', '3gp', 144, True, True,
+                                             5 * scale * mb),
+                                      Format('18', 'mp4', 360, True, True,
+                                             20 * scale * mb),
+                                      Format('137', 'mp4', 1080, True, False,
+                                             200 * mb),
+                                      Format('22', 'mp4', 720, True, True,
+                                             80 * scale * mb)])
+
+        infos = [video('a', 1), video('b', 2)]
+        self.assertEqual(choose_format(infos[0], '137/mp4').format_id, '137')
+        self.assertEqual(choose_format(infos[0], 'webm/mp4').format_id, '22')
+        self.assertIsNone(choose_format(infos[0], 'bestvideo+bestaudio'))
+
+        chosen, met = fit_budget(infos, max_size=50 * mb)
+        self.assertTrue(met)
+        self.assertEqual(chosen['a'].format_id, '18')
+        self.assertEqual(chosen['b'].format_id, '18')
+
+        chosen, met = fit_budget(infos, max_total=150 * mb)
+        self.assertTrue(met)
+        self.assertEqual(chosen['a'].format_id, '22')
+        self.assertEqual(chosen['b'].format_id, '18')
+
+        chosen, met = fit_budget(infos, max_total=1 * mb)
+        self.assertFalse(met)
+        self.assertEqual(chosen['b'].format_id, '17')
+
+        directory = self.temp_dir()
+        cache = FormatCache(os.path.join(directory, 'formats'))
+        for video_id in ('dQw4w9WgXcQ', '../../escape', 'a/b'):
+            cache.put(video(video_id, 1))
+            self.assertEqual(cache.get(video_id), video(video_id, 1))
+        self.assertEqual(os.listdir(directory), ['formats'])
+        names = os.listdir(os.path.join(directory, 'formats'))
+        self.assertIn('dQw4w9WgXcQ.json', names)
+        self.assertEqual(len(names), 3)
+
+    def test_parse_course_id(self):
+        self.assertEqual(edx_dl.parse_course_id(
+            'https://courses.edx.org/courses/BerkeleyX/CS191x/2013_Spring/info/',
+            'fun'), ('edx', 'BerkeleyX/CS191x/2013_Spring'))
+        self.assertEqual(edx_dl.parse_course_id(
+            'https://courses.edx.org/courses/course-v1:MITx+6.00x+2T2015/info',
+            'edx'), ('edx', 'course-v1:MITx+6.00x+2T2015'))
+        self.assertEqual(edx_dl.parse_course_id('stanford:Org/Course/Run',
+                                                'edx'),
+                         ('stanford', 'Org/Course/Run'))
+        self.assertEqual(edx_dl.parse_course_id('course-v1:MITx+6.00x+2T2015',
+                                                'edx'),
+                         ('edx', 'course-v1:MITx+6.00x+2T2015'))
+        self.assertIsNone(edx_dl.parse_course_id(
+            'https://example.com/courses/Org/Course/Run/info', 'edx'))
+
+    def test_course_index_crawls_only_new_sections(self):
+        tmp = self.temp_dir()
+        path = os.path.join(tmp, 'index', 'course.json')
+        sections = [Section(position=i, name='S%d' % i, url='s%d' % i)
+                    for i in range(1, 4)]
+        subsections = [SubSection(url=section.url,
+                                  units=[Unit(video_youtube_url=section.name,
+                                              sub_url='')])
+                       for section in sections]
+        index = CourseIndex(path)
+        index.update(sections[:2], subsections[:2])
+        index.save()
+
+        index = CourseIndex(path)
+        self.assertEqual(sorted(index.known(sections[:1])), ['s1'])
+        self.assertEqual(sorted(index.known(sections)), ['s1', 's2'])
+        index.update(sections[2:], subsections[2:], complete=False)
+        self.assertEqual([s.url for s in index.sections], ['s1', 's2', 's3'])
+        self.assertEqual(index.subsections['s3'].units[0].video_youtube_url,
+                         'S3')
+        self.assertEqual(CourseIndex(path, refresh=True).known(sections), {})
+
+    def test_session_against_stand_in_server(self):
+        platform = Platform(num_courses=2, num_sections=1)
+        server = StandInServer(platform).start()
+        self.addCleanup(server.stop)
+        session = Session(retries=2, backoff=30)
+        self.addCleanup(session.close)
+        dashboard = server.url + '/dashboard'
+
+        # not logged in, the platform sends us to the login page
+        response = session.get(dashboard)
+        self.assertEqual(response.url, server.url + '/login_ajax')
+        headers = log_in(server, session)
+        response = session.get(dashboard, headers)
+        self.assertEqual(response.url, dashboard)
+        self.assertEqual(response.headers.get('content-encoding'), 'gzip')
+        page = response.text()
+        self.assertIn('Course number 1', page)
+        streamed = session.get(dashboard, headers, stream=True)
+        self.assertEqual(''.join(streamed.iter_text()), page)
+        deflate = dict(headers, **{'Accept-Encoding': 'deflate'})
+        response = session.get(dashboard, deflate)
+        self.assertEqual(response.headers.get('content-encoding'), 'deflate')
+        self.assertEqual(response.text(), page)
+        streamed = session.get(dashboard, deflate, stream=True)
+        self.assertEqual(''.join(streamed.iter_text()), page)
+        # all of them went through the same keep-alive connection
+        self.assertEqual(platform.connections, 1)
+
+        # the platform is busy, the session waits what it asks (a second,
+        # not the backoff) and tries again
+        platform.busy = 1
+        started = time.time()
+        self.assertEqual(session.get(dashboard, headers).text(), page)
+        self.assertTrue(0.9 <= time.time() - started < 5)
+        # it gives up after the retries, without asking a fourth time
+        platform.busy = 4
+        platform.retry_after = 0
+        with self.assertRaises(edx_dl.HTTPError) as raised:
+            session.get(dashboard, headers)
+        self.assertEqual(raised.exception.code, 503)
+        self.assertEqual(platform.busy, 1)
+
+    def test_saved_session_is_reused(self):
+        platform = Platform(num_courses=1, num_sections=1)
+        server = StandInServer(platform).start()
+        self.addCleanup(server.stop)
+        tmp = self.temp_dir()
+        edx_dl.OPENEDX_SITES['stand-in'] = {'url': server.url,
+                                            'courseware-selector': None}
+        self.addCleanup(edx_dl.OPENEDX_SITES.pop, 'stand-in')
+        args = self.parse_args('-u', USERNAME, '-p', PASSWORD, '-x',
+                               'stand-in', '--cache-dir', tmp, '--no-cache')
+        site = edx_dl.get_site('stand-in')
+
+        def log_in_again():
+            # a new run, with a new session
+            context = edx_dl.SiteContext(site, args)
+            self.addCleanup(context.close)
+            self.assertIsNotNone(context.login())
+            self.assertEqual(context.courses()[0].name, 'Course number 0')
+            return context
+
+        context = log_in_again()
+        self.assertEqual(platform.logins, 1)
+        with open(context.session_file) as f:
+            saved = f.read()
+        self.assertTrue(saved.startswith('#LWP-Cookies-2.0'))
+        self.assertIn('sessionid=', saved)
+        # the next run takes the saved cookies
+        log_in_again()
+        self.assertEqual(platform.logins, 1)
+
+        # the platform expired them, the next run logs in and saves the
+        # new ones
+        with open(context.session_file, 'w') as f:
+            f.write(saved.replace('sessionid=', 'sessionid=expired-'))
+        log_in_again()
+        self.assertEqual(platform.logins, 2)
+        with open(context.session_file) as f:
+            self.assertEqual(f.read(), saved)
+        log_in_again()
+        self.assertEqual(platform.logins, 2)
+
+    def test_crawl_revalidates_known_subsections(self):
+        platform = Platform(units_per_subsection=2, filler_lines=2)
+        server = StandInServer(platform).start()
+        self.addCleanup(server.stop)
+        tmp = self.temp_dir()
+        session = Session(cache=ResponseCache(tmp))
+        self.addCleanup(session.close)
+        headers = log_in(server, session)
+        url = server.url + '/courses/Org/C0/2015/courseware/week0/seq0/'
+
+        first, = edx_dl.crawl_subsections([url], headers, session)
+        self.assertTrue(first.units)
+        # the platform answers 304, the indexed units are used
+        indexed = SubSection(url=url, units=first.units[:1])
+        requests = platform.requests
+        subsection, = edx_dl.crawl_subsections([url], headers, session,
+                                               known={url: indexed})
+        self.assertIs(subsection, indexed)
+        self.assertEqual(platform.requests, requests + 1)
+        # the page changed, it is parsed again
+        platform.units_per_subsection = 3
+        platform._pages.clear()
+        subsection, = edx_dl.crawl_subsections([url], headers, session,
+                                               known={url: indexed})
+        self.assertEqual(len(subsection.units), len(first.units) + 1)
+
+    def test_list_courses_from_saved_list(self):
+        tmp = self.temp_dir()
+        args = self.parse_args('-u', 'user', '--cache-dir', tmp)
+        site = edx_dl.get_site('edx')
+        path = edx_dl.get_course_list(args, site, 'user')
+        courses = [Course(name='A', url='http://a', state='Started')]
+        save_course_list(path, courses)
+        self.assertEqual(load_course_list(path)[1], courses)
+
+        def no_login(site, args):
+            raise AssertionError('the saved list was not used')
+
+        original = edx_dl.SiteContext
+        edx_dl.SiteContext = no_login
+        try:
+            self.assertTrue(edx_dl.list_courses(args))
+            args.refresh = True
+            self.assertRaises(AssertionError, edx_dl.list_courses, args)
+        finally:
+            edx_dl.SiteContext = original
+
+        # and without loading the modules that only the downloads need
+        script = ('import sys\n'
+                  'from edx_dl import edx_dl\n'
+                  'sys.argv = ["edx-dl", "--list", "-u", "user", '
+                  '"--cache-dir", sys.argv[1]]\n'
+                  'try:\n'
+                  '    edx_dl.main()\n'
+                  'except SystemExit:\n'
+                  '    pass\n'
+                  'print(sorted(m for m in ("sqlite3", "html.parser", '
+                  '"subprocess", "mmap") if m in sys.modules))\n')
+        output = subprocess.check_output([sys.executable, '-c', script, tmp])
+        self.assertEqual(output.splitlines()[-1], b'[]')
+
+    def test_metrics(self):
+        metrics = Metrics()
+        for latency in (0.02, 0.2, 40):
+            metrics.observe('request_seconds', latency, host='a"b')
+        metrics.add('received_bytes', 10, host='x')
+        metrics.add('received_bytes', 5, host='x')
+        with metrics.phase('crawl'):
+            pass
+
+        report = metrics.report()
+        self.assertEqual(list(report['phases']), ['crawl'])
+        self.assertEqual(report['counters'], [{'name': 'received_bytes',
+                                               'labels': {'host': 'x'},
+                                               'value': 15}])
+        histogram = report['histograms'][0]
+        self.assertEqual((histogram['count'], histogram['max']), (3, 40))
+        self.assertEqual(histogram['buckets'][1], [0.025, 1])
+        self.assertEqual(histogram['buckets'][-1], ['+Inf', 3])
+        lines = prometheus_lines(metrics)
+        self.assertIn('edx_dl_received_bytes_total{host="x"} 15', lines)
+        self.assertIn('edx_dl_request_seconds_bucket{host="a\\"b",le="0.5"} 2',
+                      lines)
+        self.assertIn('# TYPE edx_dl_request_seconds histogram', lines)
+
+    def test_streamed_crawl_is_ordered_and_bounded(self):
+        fetched = []
+
+        def fake_extract_subsection(url, headers, session=None, known=None):
+            time.sleep(0.01 * (url % 3))
+            fetched.append(url)
+            unit = edx_dl.Unit(video_youtube_url='http://youtube.com/watch?v=%d' % url,
+                               sub_url=None)
+            return edx_dl.SubSection(url=url, units=[unit, unit])
+
+        original = edx_dl.extract_subsection
+        edx_dl.extract_subsection = fake_extract_subsection
+        try:
+            subsections = edx_dl.iter_subsections(range(30), {}, workers=4)
+            jobs = edx_dl.iter_download_jobs(subsections)
+            first = [next(jobs) for _ in range(3)]
+            time.sleep(0.1)
+            fetched_ahead = len(fetched)
+            jobs = first + list(jobs)
+        finally:
+            edx_dl.extract_subsection = original
+
+        self.assertLessEqual(fetched_ahead, 6)
+        self.assertEqual([prefix for prefix, _ in jobs],
+                         [str(i).zfill(2) for i in range(1, 61)])
+        self.assertEqual(jobs[5][1].video_youtube_url,
+                         'http://youtube.com/watch?v=2')
+
+    def test_aimd_controller(self):
+        controller = AIMDController(initial=2, maximum=4)
+        for _ in range(20):
+            controller.acquire('host')
+            controller.release('host', 0.1, 200)
+        self.assertEqual(controller.limit('host'), 4)
+
+        controller.acquire('host')
+        controller.release('host', 0.1, 429, retry_after=0.05)
+        self.assertEqual(controller.limit('host'), 2)
+        started = time.time()
+        controller.acquire('host')
+        self.assertGreaterEqual(time.time() - started, 0.04)
+        self.assertEqual(parse_retry_after('120'), 120)
+
+    def test_priority_and_bandwidth(self):
+        jobs = [('%02d' % i, Unit(video_youtube_url='http://youtube.com/watch?v=%d' % i,
+                                  sub_url=None)) for i in range(1, 6)]
+        sections = [1, 1, 2, 2, 3]
+        sizes = {'1': 50, '2': 10, '3': 30, '4': 20}
+        order = lambda policies: [prefix for prefix, _ in order_jobs(
+            jobs, parse_priority(policies), sections, sizes)]
+        self.assertEqual(order('course'), ['01', '02', '03', '04', '05'])
+        self.assertEqual(order('recent'), ['05', '03', '04', '01', '02'])
+        self.assertEqual(order('size'), ['02', '04', '03', '01', '05'])
+        self.assertEqual(order('recent,size'), ['05', '04', '03', '02', '01'])
+        self.assertRaises(ValueError, parse_priority, 'newest')
+
+        self.assertEqual(parse_rate('500K'), 512000)
+        self.assertEqual(parse_rate('1.5MB/s'), 1572864)
+        now = [0.0]
+        waits = []
+        bucket = TokenBucket(100, clock=lambda: now[0], sleep=waits.append)
+        self.assertEqual(bucket.consume(60), 0)
+        self.assertEqual(bucket.consume(60), 0.2)
+        now[0] += 1.0
+        self.assertEqual(bucket.consume(50), 0)
+        self.assertEqual(waits, [0.2])
+
+    def test_extract_units(self):
+        page = '\n'.join([
+            '<div data-streams=&#34;0.75:aaaaaaaaaaa,1.00:abcdefghijk&#34; '
+            'data-transcript-translation-url=&#34;/t/1&#34;></div>',
+            '<div data-streams="" data-sources="/v.mp4"></div>',
+            '<div data-streams="1.0:ABCDEFGHIJK"></div>',
+            '<iframe src="//www.youtube.com/embed/XXXXXXXXXXXyy?rel=0">',
+        ])
+        self.assertEqual(extract_units(page, 'https://edx'), [
+            edx_dl.Unit(video_youtube_url='http://youtube.com/watch?v=abcdefghijk',
+                        sub_url='https://edx/t/1/en?videoId=abcdefghijk'),
+            edx_dl.Unit(video_youtube_url='http://youtube.com/watch?v=ABCDEFGHIJK',
+                        sub_url=None),
+            edx_dl.Unit(video_youtube_url='http://youtube.com/watch?v=XXXXXXXXXXX',
+                        sub_url=None),
+        ])
+
+    def test_streamed_parsing(self):
+        def chunks(page, size):
+            return [page[i:i + size] for i in range(0, len(page), size)]
+
+        unit = ('<div data-streams=&#34;0.75:aaaaaaaaaaa,1.00:%s&#34; '
+                'data-transcript-translation-url=&#34;/t/%d&#34;></div>')
+        page = '\n'.join([unit % ('v%010d' % i, i) for i in range(300)] + [
+            '<div data-streams="" data-sources="/v.mp4"></div>',
+            '<iframe src="//www.youtube.com/embed/XXXXXXXXXXXyy?rel=0">',
+        ])
+        expected = extract_units(page, 'https://edx')
+        self.assertEqual(len(expected), 301)
+        for size in (1, 7, 1000, 100000):
+            self.assertEqual(list(parse_chunks(UnitParser('https://edx'),
+                                               chunks(page, size))),
+                             expected)
+
+        dashboard = (
+            '<article class="course"><h3>A &amp; B</h3>'
+            '<a href="/courses/A/info">View</a></article>'
+            '<article class="course"><h3> C </h3></article>')
+        courseware = (
+            '<div class="chapter"><h3><a href="#">Week 1</a></h3>'
+            '<ul><li><a href="/courses/A/courseware/w1/">L</a></li></ul></div>'
+            '<div class="chapter"><h3><a href="#">Week 2</a></h3></div>'
+            '<div class="chapter other"><h3><a>Week 3</a></h3>'
+            '<ul><li><a href="/w3/">L</a></li></ul></div>')
+        for size in (1, 5, 1000):
+            self.assertEqual(
+                list(parse_chunks(CourseParser('https://edx'),
+                                  chunks(dashboard, size))),
+                [edx_dl.Course(name='A & B', url='https://edx/courses/A/info',
+                               state='Started'),
+                 edx_dl.Course(name='C', url=None, state='Not yet')])
+            self.assertEqual(
+                list(parse_chunks(SectionParser('https://edx'),
+                                  chunks(courseware, size))),
+                [Section(position=1, name='Week 1',
+                         url='https://edx/courses/A/courseware/w1/'),
+                 Section(position=3, name='Week 3', url='https://edx/w3/')])
+
+    def test_streamed_parsing_malformed_pages(self):
+        # the courses and sections are those the BeautifulSoup selectors of
+        # the previous versions found in the same pages
+        dashboard = (
+            '<html><head><script>var s = "<article class=\'course\'>";'
+            '</script></head><body>\n'
+            '<nav aria-label="Global"><ul><li><a href="/dashboard">Courses'
+            '<li><a href="/u/me">Profile</ul></nav>\n'
+            '<ul class="listing-courses">\n'
+            '<li class="course-item"><article id="course-1" '
+            'aria-labelledby="t-1" class="course audit">\n'
+            '<a data-course-key="A" href="/courses/MITx/6.00x/2013_Spring/'
+            'info" class="cover"><img src="/a.jpg" alt=""></a>\n'
+            '<h3 class="course-title" id="t-1"><a href="/courses/MITx/6.00x/'
+            '2013_Spring/info">Computer Science &amp; Programming</a></h3>\n'
+            '<li class="course-item"><article class="course">\n'
+            '<h3 class="course-title">  Circuits &#38; Electronics&nbsp;'
+            '</h3><div>Starts - Mar 1</div></article>\n'
+            '<li class="course-item"><article class="course verified"><h3>'
+            '<a href="/courses/course-v1:BerkeleyX+CS191x+2T2015/info/">'
+            'Quantum Mechanics</a></h3><div><p>unclosed<div>other</article>\n'
+            '<li class="course-item"><article class="other"><h3>Not a course'
+            '</h3></article>\n'
+            '<li class="course-item"><article class="course"><h3>Last '
+            '<em>One</em></h3><a href="/courses/X/Y/Z/about">About</a>\n'
+            '</ul></body></html>\n')
+        courseware = (
+            '<html><body><nav aria-label="Global"><ol><li>'
+            '<a href="/dashboard">Dashboard</ol></nav>\n'
+            '<nav aria-label="Course Navigation" class="accordion">\n'
+            '<div id="c1" class="chapter is-open" data-id="w1">\n'
+            '<h3 aria-expanded="true"><a role="button" href="#">Week 1: '
+            'Basics</a></h3>\n<ul class="menu">\n'
+            '<li class="active"><a href="/courses/A/courseware/w1/s1/">'
+            '<p>Lecture 1</p><p class="subtitle">due</p></a>\n'
+            '<li><a href="/courses/A/courseware/w1/s2/"><p>Lecture 2</p>'
+            '</a>\n</ul>\n</div>\n'
+            '<div data-id="w2" class="chapter"><h3><a href="#">Week 2 &amp; '
+            'Review </a></h3>\n'
+            '<nav class="inner"><nav><span>x</span></nav></nav>\n'
+            '<ul><li><a class="link" href="/courses/A/courseware/w2/s1/">L'
+            '</a><li><a href="/w2/s2/">M</a></ul>\n'
+            '<div class="summary"><p>never closed\n</div>\n'
+            '<div class="chapter"><h3><a href="#">Week 3</a></h3>\n'
+            '<ul><li><a href="/courses/A/courseware/w3/s1/">L</a></li></ul>'
+            '\n</div>\n</nav></body></html>\n')
+        for size in (1, 13, 100000):
+            chunks = [dashboard[i:i + size]
+                      for i in range(0, len(dashboard), size)]
+            self.assertEqual(
+                list(parse_chunks(CourseParser('https://edx'), chunks)),
+                [edx_dl.Course(name='Computer Science & Programming',
+                               url='https://edx/courses/MITx/6.00x/'
+                                   '2013_Spring/info',
+                               state='Started'),
+                 edx_dl.Course(name='Circuits & Electronics', url=None,
+                               state='Not yet'),
+                 edx_dl.Course(name='Quantum Mechanics',
+                               url='https://edx/courses/course-v1:BerkeleyX'
+                                   '+CS191x+2T2015/info/',
+                               state='Started'),
+                 edx_dl.Course(name='Last One',
+                               url='https://edx/courses/X/Y/Z/about',
+                               state='Not yet')])
+            chunks = [courseware[i:i + size]
+                      for i in range(0, len(courseware), size)]
+            self.assertEqual(
+                list(parse_chunks(SectionParser('https://edx'), chunks)),
+                [Section(position=1, name='Week 1: Basics',
+                         url='https://edx/courses/A/courseware/w1/s1/'),
+                 Section(position=2, name='Week 2 & Review',
+                         url='https://edx/courses/A/courseware/w2/s1/'),
+                 Section(position=3, name='Week 3',
+                         url='https://edx/courses/A/courseware/w3/s1/')])
+
+    def test_streamed_parsing_large_pages(self):
+        # pages of real size, whose tokens cross the part of the page kept
+        # between chunks
+        filler = '<p class="filler">%s</p>\n' % ('lorem ipsum ' * 8)
+        unit = ('<div data-streams=&#34;0.75:aaaaaaaaaaa,1.00:%s&#34; '
+                'data-transcript-translation-url=&#34;/t/%d&#34;></div>\n')
+        page = ''.join(unit % ('v%010d' % i, i) + filler * (i % 120)
+                       for i in range(80))
+        # an embedded video url that runs past the kept part, with another
+        # one in its id
+        page += (filler * 80 + '<iframe src="//www.youtube.com/embed/' +
+                 'A' * 3000 + '//www.youtube.com/embed/BBBBBBBBBBB ">' +
+                 filler * 80)
+        expected = extract_units(page, 'https://edx')
+        self.assertEqual(len(expected), 81)
+        for size in (7, 1000, 4096, 8191, 65536):
+            chunks = [page[i:i + size] for i in range(0, len(page), size)]
+            self.assertEqual(list(parse_chunks(UnitParser('https://edx'),
+                                               chunks)),
+                             expected)
+
+    def test_parse_pool(self):
+        # a multibyte character split between the chunks of the body
+        name = '\u00e9' * (64 * 1024)
+        page = ('<article class="course"><h3>%s</h3>'
+                '<a href="/courses/A/info">View</a></article>' % name)
+        unit = ('<div data-streams=&#34;1.00:%s&#34; '
+                'data-transcript-translation-url=&#34;/t/%d&#34;></div>')
+        subsection = '\n'.join(unit % ('v%010d' % i, i) for i in range(50))
+        pool = ParsePool(2)
+        try:
+            courses, seconds = pool.parse('dashboard', page.encode('utf-8'),
+                                          'utf-8', 'https://edx')
+            self.assertEqual(courses, [
+                Course(name=name, url='https://edx/courses/A/info',
+                       state='Started')])
+            self.assertTrue(seconds >= 0)
+            units, _ = pool.parse('subsection', subsection.encode('utf-8'),
+                                  'utf-8', 'https://edx')
+            self.assertEqual(units, extract_units(subsection, 'https://edx'))
+        finally:
+            pool.close()
+
+    def test_work_queue(self):
+        tmp = self.temp_dir()
+        queue = WorkQueue(os.path.join(tmp, 'queue.sqlite'), attempts=2)
+        jobs = [('01', Unit('http://youtube.com/watch?v=a', None)),
+                ('02', Unit('http://youtube.com/watch?v=b', 'https://s/b'))]
+        self.assertEqual(queue.add('edx', 'A/B/C', 'Course', jobs), 2)
+        self.assertEqual(queue.add('edx', 'A/B/C', 'Course', jobs), 0)
+
+        first = queue.claim('w1', lease=60)
+        second = queue.claim('w2', lease=-1)
+        self.assertEqual((first.prefix, second.prefix), ('01', '02'))
+        # the lease of w2 expired, w3 gets its unit
+        third = queue.claim('w3', lease=60)
+        self.assertEqual((third.id, third.attempts), (second.id, 2))
+        self.assertEqual(queue.claim('w4'), None)
+        self.assertFalse(queue.finish(second, 'w2', True))
+        self.assertTrue(queue.finish(first, 'w1', True))
+        # the last attempt failed
+        self.assertTrue(queue.finish(third, 'w3', False))
+        self.assertEqual(queue.counts(), {'pending': 0, 'leased': 0,
+                                          'done': 1, 'failed': 1})
+        self.assertEqual(queue.unfinished(), 0)
+        # queued again by the next crawl
+        self.assertEqual(queue.add('edx', 'A/B/C', 'Course', jobs), 1)
+        self.assertEqual(queue.claim('w1').prefix, '02')
+        queue.close()
+
+        args = self.parse_args('worker', '--queue', queue.path)
+        self.assertEqual((args.worker, args.course_id), (True, []))
+        args = self.parse_args('--queue', queue.path, 'A/B/C')
+        self.assertEqual((args.worker, args.course_id), (False, ['A/B/C']))
+
+    def test_work_queue_processes(self):
+        tmp = self.temp_dir()
+        path = os.path.join(tmp, 'queue.sqlite')
+        queue = WorkQueue(path)
+        for course in ('A', 'B'):
+            queue.add('edx', course, course,
+                      [('%02d' % i, Unit('http://youtube.com/watch?v=%s%d' %
+                                         (course, i), None))
+                       for i in range(1, 21)])
+        crashed = multiprocessing.Process(target=drain_queue,
+                                          args=(path, 'crashed', True))
+        crashed.start()
+        crashed.join()
+        workers = [multiprocessing.Process(target=drain_queue,
+                                           args=(path, 'w%d' % i))
+                   for i in range(3)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual(queue.counts()['done'], 40)
+        rows = queue._conn.execute(
+            'SELECT worker, attempts FROM units ORDER BY id').fetchall()
+        # the unit of the crashed worker was claimed again once its lease
+        # expired, every unit was done by a single worker
+        self.assertEqual(rows[0][1], 2)
+        self.assertEqual([attempts for _, attempts in rows[1:]], [1] * 39)
+        self.assertNotIn('crashed', [worker for worker, _ in rows])
+        queue.close()
+
+    def test_watch_schedule_and_status(self):
+        self.assertEqual(parse_interval('90'), 90)
+        self.assertEqual(parse_interval('30m'), 1800)
+        self.assertEqual(parse_interval(' 1.5H '), 5400)
+        for value in ('', 'often', '0', '-5m', 'nan', 'inf', '-inf', 'infh',
+                      '1e400'):
+            self.assertRaises(ValueError, parse_interval, value)
+        delays = [jittered(100) for _ in range(200)]
+        self.assertTrue(all(90 <= delay <= 110 for delay in delays))
+        self.assertTrue(len(set(delays)) > 1)
+
+        tmp = self.temp_dir()
+        path = os.path.join(tmp, 'status.json')
+        status = WatchStatus(path, 60)
+        status.syncing()
+        with open(path) as f:
+            self.assertEqual(json.load(f)['state'], 'syncing')
+        status.synced(3, 1, 1)
+        status.syncing()
+        status.synced(0, 0, 0, 'timed out')
+        with open(path) as f:
+            data = json.load(f)
+        self.assertEqual((data['state'], data['syncs'], data['downloaded'],
+                          data['failed'], data['queue_depth'],
+                          data['last_error']),
+                         ('idle', 2, 3, 1, 0, 'timed out'))
+        self.assertTrue(data['last_sync'] >= data['sync_started'])
+
+    def test_watch_survives_failed_syncs(self):
+        platform = Platform(num_courses=2, num_sections=2,
+                            units_per_subsection=2, filler_lines=2)
+        server = StandInServer(platform).start()
+        self.addCleanup(server.stop)
+        tmp = self.temp_dir()
+        edx_dl.OPENEDX_SITES['stand-in'] = {'url': server.url,
+                                            'courseware-selector': None}
+        self.addCleanup(edx_dl.OPENEDX_SITES.pop, 'stand-in')
+        status_path = os.path.join(tmp, 'status.json')
+        args = self.parse_args('-u', USERNAME, '-p', PASSWORD, '-x',
+                               'stand-in', '--cache-dir',
+                               os.path.join(tmp, 'cache'),
+                               '--queue', os.path.join(tmp, 'queue.db'),
+                               '--watch', '0.01', '--status', status_path)
+
+        sync_courses = edx_dl.sync_courses
+        sent = []
+
+        def sync(*a):
+            sent.append((platform.requests, platform.bytes_sent))
+            if len(sent) == 1:
+                raise ValueError('unexpected page')
+            if len(sent) == 2:
+                with open(status_path) as f:
+                    self.assertEqual(json.load(f)['last_error'],
+                                     'ValueError: unexpected page')
+            if len(sent) == 4:
+                raise KeyboardInterrupt
+            return sync_courses(*a)
+        edx_dl.sync_courses = sync
+        try:
+            self.assertRaises(KeyboardInterrupt, edx_dl.watch_courses, args)
+        finally:
+            edx_dl.sync_courses = sync_courses
+        with open(status_path) as f:
+            data = json.load(f)
+        self.assertEqual((data['state'], data['syncs'], data['queue_depth'],
+                          data['last_error']), ('stopped', 3, 9, None))
+        # nothing changed: the third sync only got 304 answers
+        self.assertTrue(sent[3][0] > sent[2][0])
+        self.assertEqual(sent[3][1], sent[2][1])
+
+    def test_edx_json2srt(self):
+        transcript = {'start': [0, 1500, 3723004, 90000000],
+                      'end': [1500, 3000, 3724005.5, 90001000],
+                      'text': ['Hello', '', 'world', 'late']}
+        self.assertEqual(edx_dl.edx_json2srt(transcript),
+                         '0\n00:00:00,000 --> 00:00:01,500\nHello\n\n'
+                         '2\n01:02:03,004 --> 01:02:04,005\nworld\n\n'
+                         '3\n01:00:00,000 --> 01:00:01,000\nlate\n\n')
+        self.assertEqual(subtitles.convert(transcript, 'vtt').splitlines()[:4],
+                         ['WEBVTT', '', '0', '00:00:00.000 --> 00:00:01.500'])
+
+    def test_subtitle_fetcher(self):
+        sub_url = ('https://courses.edx.org/courses/X/Y/Z/xblock/1/handler/'
+                   'transcript/translation/en?videoId=abc')
+        self.assertEqual(subtitles.translation_url(sub_url, 'pt-br'),
+                         sub_url.replace('/en?', '/pt-br?'))
+        self.assertEqual(subtitles.translation_url('https://s/translation/en',
+                                                   'fr'),
+                         'https://s/translation/fr')
+        self.assertEqual(subtitles.subtitles_filename('01-a', 'en', 'srt',
+                                                      ['en']), '01-a.srt')
+        self.assertEqual([subtitles.subtitles_filename('01-a', language, 'vtt',
+                                                       ('en', 'es', 'zh'))
+                          for language in ('en', 'es', 'zh')],
+                         ['01-a.en.vtt', '01-a.es.vtt', '01-a.zh.vtt'])
+
+        fetched = []
+        lock = threading.Lock()
+
+        def fetch(url):
+            with lock:
+                fetched.append(url)
+            return {'url': url}
+        fetcher = subtitles.SubtitleFetcher(fetch, ['en', 'es'], workers=2)
+        self.addCleanup(fetcher.close)
+        submitted = []
+
+        def subtitles_job(job):
+            if job % 4 == 0:
+                return None
+            submitted.append(job)
+            return job, 'https://s/%d/translation/en' % job
+
+        # the transcripts of the next 3 jobs are submitted before each one
+        # is yielded, and the ones of the jobs without subtitles are not
+        for job in fetcher.prefetch(range(1, 11), subtitles_job, window=3):
+            self.assertEqual(submitted[-1],
+                             [j for j in range(1, min(job + 3, 10) + 1)
+                              if j % 4][-1])
+            if job % 4:
+                self.assertEqual(fetcher.transcripts(job, None), [
+                    ('en', {'url': 'https://s/%d/translation/en' % job}),
+                    ('es', {'url': 'https://s/%d/translation/es' % job})])
+        self.assertEqual(submitted, [1, 2, 3, 5, 6, 7, 9, 10])
+        self.assertEqual(len(fetched), 16)
+        # not submitted, fetched now
+        self.assertEqual(fetcher.transcripts(4, 'https://s/4/translation/en',
+                                             ['es']),
+                         [('es', {'url': 'https://s/4/translation/es'})])
+        self.assertEqual(len(fetched), 17)
+
+    def test_process_runner(self):
+        script = ('import sys, time\n'
+                  'sys.stderr.write("x" * 200000)\n'
+                  'sys.stdout.write("[download] Destination: a.mp4\\n")\n'
+                  'sys.stdout.write("\\r[download]  50.0% of 1.00MiB at 1.00MiB/s ETA 00:01")\n'
+                  'sys.stdout.flush()\n'
+                  'time.sleep(0.2)\n'
+                  'sys.stderr.write("WARNING: slow\\n" * 1000)\n'
+                  'sys.exit(3)\n')
+        runner = ProcessRunner(stream=open(os.devnull, 'w'))
+        try:
+            returncode, output = runner.run([sys.executable, '-c', script])
+        finally:
+            runner.close()
+        self.assertEqual(returncode, 3)
+        self.assertIn(b'[download] Destination: a.mp4', output)
+        self.assertNotIn(b'50.0%', output)
+        self.assertIn(b'WARNING: slow', output)
+
 if __name__ == '__main__':
     suite = unittest.TestLoader().loadTestsFromTestCase(TestEdX)
     unittest.TextTestRunner(verbosity=2).run(suite)